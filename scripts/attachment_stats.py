@@ -0,0 +1,156 @@
+# statistics of PP attachment datasets, computed over the integer-coded columns of an AttachmentTable and written as json
+
+import argparse
+import json
+import numpy as np
+
+from attachment_table import AttachmentTable, RaggedArray
+from utils import get_word_vectors
+
+STATS_SUFFIX = '.stats.json'
+MAX_PREPS = 100  # number of most frequent prepositions listed
+
+
+def count_types(ids, num_types):
+    """
+    Get the number of distinct ids among ids (all in range(num_types))
+    """
+
+    return int(np.count_nonzero(np.bincount(ids, minlength=num_types)))
+
+
+def get_histogram(values):
+    """
+    Get a {value: count} dict of non-negative integer values
+    """
+
+    counts = np.bincount(values) if len(values) else np.zeros(0, dtype=np.int64)
+    return dict((int(v), int(counts[v])) for v in np.flatnonzero(counts))
+
+
+def get_oov_stats(table, vocab):
+    """
+    Get the out-of-vocabulary rates of the table's words against vocab (anything supporting 'in', e.g. word vectors)
+
+    Rates are given over tokens and over types, per column, and over attachments (any word out of vocabulary)
+    """
+
+    num_types = len(table.words)
+    is_oov = np.array([w not in vocab for w in table.words], dtype=np.bool_)
+    columns = [('heads', table.heads.values), ('preps', table.preps), ('children', table.children)]
+    if table.pp_words is not None:
+        columns.append(('pp_words', table.pp_words.values))
+    stats = dict()
+    for name, ids in columns:
+        types = np.bincount(ids, minlength=num_types) > 0
+        stats[name] = {'token_rate': float(np.mean(is_oov[ids])) if len(ids) else 0.0, \
+                       'type_rate': float(np.mean(is_oov[types])) if types.any() else 0.0}
+    attachment_oov = np.bincount(table.heads.row_ids(), weights=is_oov[table.heads.values], minlength=len(table)) > 0
+    if table.pp_words is not None:
+        attachment_oov |= np.bincount(table.pp_words.row_ids(), weights=is_oov[table.pp_words.values], minlength=len(table)) > 0
+    else:
+        attachment_oov |= is_oov[table.preps] | is_oov[table.children]
+    stats['attachment_rate'] = float(np.mean(attachment_oov)) if len(table) else 0.0
+    return stats
+
+
+def get_attachment_stats(table, vocab=None, max_preps=MAX_PREPS):
+    """
+    Get statistics of an AttachmentTable as a json-serializable dict
+
+    Number of attachments, vocabulary sizes, histograms of the number of candidate heads and of the gold head position
+    (from the first candidate, and from the preposition back), gold head pos counts, most frequent prepositions, and
+    out-of-vocabulary rates if vocab is given (see get_oov_stats)
+    """
+
+    num_types = len(table.words)
+    nheads = table.get_nheads()
+    stats = dict()
+    stats['num_attachments'] = len(table)
+    stats['nheads_mean'] = float(np.mean(nheads)) if len(table) else 0.0
+    stats['nheads_std'] = float(np.std(nheads)) if len(table) else 0.0
+    stats['nheads_histogram'] = get_histogram(nheads)
+    stats['label_histogram'] = get_histogram(table.labels)
+    stats['label_from_end_histogram'] = get_histogram(nheads - table.labels + 1)  # 1 is the candidate closest to the preposition
+
+    vocab_sizes = dict()
+    vocab_sizes['heads'] = count_types(table.heads.values, num_types)
+    vocab_sizes['preps'] = count_types(table.preps, num_types)
+    vocab_sizes['child1'] = count_types(table.children, num_types)
+    if table.pp_words is not None:
+        # all PP words except the preposition
+        is_child = np.ones(len(table.pp_words.values), dtype=np.bool_)
+        is_child[table.pp_words.offsets[:-1]] = False
+        vocab_sizes['children'] = count_types(table.pp_words.values[is_child], num_types)
+        vocab_sizes['all'] = count_types(np.concatenate([table.heads.values, table.preps]), num_types)
+    else:
+        vocab_sizes['all'] = count_types(np.concatenate([table.heads.values, table.preps, table.children]), num_types)
+    stats['vocab_sizes'] = vocab_sizes
+
+    if table.heads_pos is not None and np.array_equal(table.heads_pos.lengths(), nheads) and len(table):
+        gold_pos = table.heads_pos.values[table.heads_pos.offsets[:-1] + table.labels - 1]
+        stats['gold_head_pos'] = dict((table.tags[t], n) for t, n in get_histogram(gold_pos).iteritems())
+
+    prep_counts = np.bincount(table.preps, minlength=num_types)
+    # ties are broken by word, so the list does not depend on how word ids were assigned
+    top_preps = sorted(np.flatnonzero(prep_counts), key=lambda i: (-prep_counts[i], table.words[i]))[:max_preps]
+    stats['prep_counts'] = [[table.words[i], int(prep_counts[i])] for i in top_preps]
+
+    if vocab is not None:
+        stats['oov'] = get_oov_stats(table, vocab)
+    return stats
+
+
+def write_attachment_stats(stats, filename):
+
+    with open(filename, 'w') as f:
+        json.dump(stats, f, indent=2, sort_keys=True)
+
+
+def read_pp_data_table(data_pref):
+    """
+    Read attachments in the released pp-data format (data_pref.heads.words, .preps.words, .children.words, .labels,
+    and .heads.pos if present) into an AttachmentTable
+    """
+
+    word_ids = dict()
+    get_word_id = lambda w: word_ids.setdefault(w, len(word_ids))
+    with open(data_pref + '.heads.words') as f:
+        heads = RaggedArray.from_lists([[get_word_id(h) for h in line.split()] for line in f])
+    with open(data_pref + '.preps.words') as f:
+        preps = np.array([get_word_id(line.strip()) for line in f], dtype=np.int32)
+    with open(data_pref + '.children.words') as f:
+        children = np.array([get_word_id(line.strip()) for line in f], dtype=np.int32)
+    labels = np.loadtxt(data_pref + '.labels', dtype=np.int32, ndmin=1)
+    columns = {'labels': labels, 'preps': preps, 'children': children, 'heads': heads, \
+               'prep_ids': np.full(len(labels), -1, dtype=np.int32), 'sentence_start_lines': np.full(len(labels), -1, dtype=np.int64)}
+    tags = []
+    try:
+        tag_ids = dict()
+        with open(data_pref + '.heads.pos') as f:
+            columns['heads_pos'] = RaggedArray.from_lists([[tag_ids.setdefault(t, len(tag_ids)) for t in line.split()] for line in f])
+        tags = sorted(tag_ids, key=tag_ids.get)
+    except IOError:
+        pass
+    words = sorted(word_ids, key=word_ids.get)
+    return AttachmentTable(words, tags, columns)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute statistics of a PP attachment dataset in the pp-data format and write them as json')
+    parser.add_argument('data_pref', help='Prefix of the dataset files (e.g. data/pp-data-english/wsj.2-21.txt.dep.pp)')
+    parser.add_argument('--output_file', help='Json output file (default: data_pref' + STATS_SUFFIX + ')')
+    parser.add_argument('--word_vectors_file', help='Word vectors file, for out-of-vocabulary rates')
+    parser.add_argument('--max_preps', type=int, default=MAX_PREPS)
+    args = parser.parse_args()
+
+    table = read_pp_data_table(args.data_pref)
+    vocab = get_word_vectors(args.word_vectors_file) if args.word_vectors_file else None
+    stats = get_attachment_stats(table, vocab, args.max_preps)
+    output_file = args.output_file or args.data_pref + STATS_SUFFIX
+    print 'writing statistics of', stats['num_attachments'], 'attachments to:', output_file
+    write_attachment_stats(stats, output_file)
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,357 @@
+# columnar storage of PP attachments: integer word ids, with CSR-style ragged arrays for the candidate heads
+
+import codecs
+import numpy as np
+
+WRITE_CHUNK_SIZE = 100000  # number of attachments formatted at a time when writing files
+
+
+class RaggedArray(object):
+    """
+    Variable length rows stored as one values array and row offsets (row i is values[offsets[i]:offsets[i+1]])
+    """
+
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    @classmethod
+    def from_lists(cls, rows, dtype=np.int32):
+        lengths = np.array([len(row) for row in rows], dtype=np.int64)
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        values = np.fromiter((v for row in rows for v in row), dtype=dtype, count=offsets[-1])
+        return cls(values, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def row(self, i):
+        return self.values[self.offsets[i]:self.offsets[i+1]]
+
+    def row_ids(self):
+        """
+        Get the row index of every value
+        """
+
+        return np.repeat(np.arange(len(self)), self.lengths())
+
+    def take(self, indices):
+        """
+        Get a new ragged array with the given rows
+        """
+
+        lengths = self.lengths()[indices]
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        positions = np.repeat(self.offsets[:-1][indices] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return RaggedArray(self.values[positions], offsets)
+
+    def to_padded(self, pad_value=-1, width=None):
+        """
+        Get a (num rows x width) matrix with each row padded by pad_value (width defaults to the longest row)
+        """
+
+        lengths = self.lengths()
+        if width is None:
+            width = lengths.max() if len(lengths) else 0
+        padded = np.full((len(self), width), pad_value, dtype=self.values.dtype)
+        cols = np.arange(len(self.values)) - np.repeat(self.offsets[:-1], lengths)
+        padded[self.row_ids(), cols] = self.values
+        return padded
+
+
+class AttachmentTable(object):
+    """
+    Columnar table of PP attachments
+
+    Words are stored as ids into self.words, tags (heads_pos, heads_next_pos) as ids into self.tags
+    Per-attachment columns: labels (1-based gold head), preps, children, prep_ids, sentence_start_lines
+    Ragged columns (one row per attachment): heads, heads_ids, heads_next, heads_pos, heads_next_pos,
+    and pp_words, pp_parents for attachments with a full PP (Attachment); columns are None when not available
+    """
+
+    def __init__(self, words, tags, columns):
+        self.words = words
+        self.tags = tags
+        self.labels = columns['labels']
+        self.preps = columns['preps']
+        self.children = columns['children']
+        self.prep_ids = columns['prep_ids']
+        self.sentence_start_lines = columns['sentence_start_lines']
+        self.heads = columns['heads']
+        self.heads_ids = columns.get('heads_ids')
+        self.heads_next = columns.get('heads_next')
+        self.heads_pos = columns.get('heads_pos')
+        self.heads_next_pos = columns.get('heads_next_pos')
+        self.pp_words = columns.get('pp_words')
+        self.pp_parents = columns.get('pp_parents')
+
+    @classmethod
+    def from_attachments(cls, attachments, vocabulary=None):
+        """
+        Build a table from a list of ConllAttachment (or EnglishAttachment) or Attachment instances
+
+        If vocabulary (a Vocabulary) is given, the attachments' words are its word ids, which are used as they are
+        and then compacted to the words that occur in the table
+        """
+
+        word_ids = dict()
+        tag_ids = dict()
+        if vocabulary is None:
+            get_word_id = lambda w: word_ids.setdefault(w, len(word_ids))
+            get_word_ids = lambda words: [get_word_id(w) for w in words]
+        else:
+            get_word_id = lambda w: w
+            get_word_ids = lambda words: words
+        get_tag_id = lambda t: tag_ids.setdefault(t, len(tag_ids))
+        # an empty table gets empty PP columns, so it can be written and filtered as either kind
+        has_pp = len(attachments) == 0 or hasattr(attachments[0], 'pp_words')
+        columns = dict()
+        columns['labels'] = np.array([a.label for a in attachments], dtype=np.int32)
+        columns['heads'] = RaggedArray.from_lists([get_word_ids(a.heads) for a in attachments])
+        if has_pp:
+            columns['pp_words'] = RaggedArray.from_lists([get_word_ids(a.pp_words) for a in attachments])
+            columns['pp_parents'] = RaggedArray.from_lists([a.pp_parents for a in attachments])
+            columns['preps'] = columns['pp_words'].values[columns['pp_words'].offsets[:-1]]
+            columns['children'] = columns['pp_words'].values[columns['pp_words'].offsets[:-1] + 1]
+        else:
+            columns['preps'] = np.array([get_word_id(a.prep) for a in attachments], dtype=np.int32)
+            columns['children'] = np.array([get_word_id(a.child) for a in attachments], dtype=np.int32)
+        columns['prep_ids'] = np.array([getattr(a, 'orig_prep_id', -1) for a in attachments], dtype=np.int32)
+        columns['sentence_start_lines'] = np.array([getattr(a, 'sentence_start_line', -1) for a in attachments], dtype=np.int64)
+        columns['heads_ids'] = RaggedArray.from_lists([getattr(a, 'orig_heads_ids', []) for a in attachments])
+        columns['heads_next'] = RaggedArray.from_lists([get_word_ids(getattr(a, 'heads_next', [])) for a in attachments])
+        columns['heads_pos'] = RaggedArray.from_lists([[get_tag_id(t) for t in getattr(a, 'heads_pos', [])] for a in attachments])
+        columns['heads_next_pos'] = RaggedArray.from_lists([[get_tag_id(t) for t in getattr(a, 'heads_next_pos', [])] for a in attachments])
+        if vocabulary is None:
+            words = [None] * len(word_ids)
+            for w, i in word_ids.iteritems():
+                words[i] = w
+        else:
+            words = compact_word_ids(columns, vocabulary.words)
+        tags = [None] * len(tag_ids)
+        for t, i in tag_ids.iteritems():
+            tags[i] = t
+        return cls(words, tags, columns)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def get_nheads(self):
+        return self.heads.lengths()
+
+    def select(self, indices):
+        """
+        Get a new table with the attachments at the given indices (or boolean mask)
+        """
+
+        indices = np.asarray(indices)
+        if indices.dtype == np.bool_:
+            indices = np.flatnonzero(indices)
+        columns = dict()
+        for name in ['labels', 'preps', 'children', 'prep_ids', 'sentence_start_lines']:
+            columns[name] = getattr(self, name)[indices]
+        for name in ['heads', 'heads_ids', 'heads_next', 'heads_pos', 'heads_next_pos', 'pp_words', 'pp_parents']:
+            column = getattr(self, name)
+            columns[name] = column.take(indices) if column is not None else None
+        return AttachmentTable(self.words, self.tags, columns)
+
+    def get_max_children_counts(self):
+        """
+        Get for each attachment the largest number of children of any word in the PP (including the PP root)
+        """
+
+        if self.pp_parents is None:
+            raise ValueError('attachments have no pp_parents')
+        parents = self.pp_parents.values.astype(np.int64)
+        rows = self.pp_parents.row_ids()
+        max_counts = np.zeros(len(self), dtype=np.int64)
+        if len(parents) == 0:
+            return max_counts
+        parents -= parents.min()
+        keys = rows * (parents.max() + 1) + parents
+        unique_keys, counts = np.unique(keys, return_counts=True)
+        np.maximum.at(max_counts, unique_keys // (parents.max() + 1), counts)
+        return max_counts
+
+    def get_words(self, ids):
+        return [self.words[i] for i in ids]
+
+
+def compact_word_ids(columns, words):
+    """
+    Renumber the word ids of table columns (in place) to range over only the words that occur in them
+
+    Return the list of occurring words, indexed by the new ids
+    """
+
+    ragged_names = [name for name in ['heads', 'heads_next', 'pp_words'] if name in columns]
+    word_columns = [columns[name].values for name in ragged_names] + [columns['preps'], columns['children']]
+    used = np.unique(np.concatenate(word_columns))
+    new_ids = np.zeros(len(words), dtype=np.int32)
+    new_ids[used] = np.arange(len(used), dtype=np.int32)
+    for name in ragged_names:
+        columns[name] = RaggedArray(new_ids[columns[name].values], columns[name].offsets)
+    for name in ['preps', 'children']:
+        columns[name] = new_ids[columns[name]]
+    return [words[i] for i in used]
+
+
+def format_ragged_rows(ragged, symbols, sep, start, end):
+    """
+    Format rows start:end of a ragged column as lines of sep-joined symbols
+    """
+
+    offsets = ragged.offsets[start:end+1]
+    values = symbols[ragged.values[offsets[0]:offsets[-1]]]
+    offsets = offsets - offsets[0]
+    return [sep.join(values[offsets[i]:offsets[i+1]]) + '\n' for i in xrange(len(offsets) - 1)]
+
+
+def format_numbers(numbers):
+    return ''.join([str(n) + '\n' for n in numbers.tolist()])
+
+
+def write_conll_attachment_table(table, output_pref, use_heads_next=False, use_heads_pos=False, use_heads_next_pos=False):
+    """
+    Write an attachment table to the text files loaded by matlab (same format as write_conll_attachments)
+    """
+
+    words = np.array(table.words + [''], dtype=object)[:-1]  # avoid numpy turning the words into a string array
+    tags = np.array(table.tags + [''], dtype=object)[:-1]
+    g_heads = codecs.open(output_pref + '.heads.words', 'w', encoding='utf-8')
+    g_nheads = open(output_pref + '.nheads', 'w')
+    g_labels = open(output_pref + '.labels', 'w')
+    g_preps = codecs.open(output_pref + '.preps.words', 'w', encoding='utf-8')
+    g_children = codecs.open(output_pref + '.children.words', 'w', encoding='utf-8')
+    if use_heads_next:
+        g_heads_next = codecs.open(output_pref + '.heads.next.words', 'w', encoding='utf-8')
+    if use_heads_pos:
+        g_heads_pos = open(output_pref + '.heads.pos', 'w')
+    if use_heads_next_pos:
+        g_heads_next_pos = open(output_pref + '.heads.next.pos', 'w')
+
+    nheads = table.get_nheads()
+    for start in xrange(0, len(table), WRITE_CHUNK_SIZE):
+        end = min(start + WRITE_CHUNK_SIZE, len(table))
+        g_heads.write(''.join(format_ragged_rows(table.heads, words, ' ', start, end)))
+        g_nheads.write(format_numbers(nheads[start:end]))
+        g_labels.write(format_numbers(table.labels[start:end]))
+        g_preps.write(''.join([w + '\n' for w in words[table.preps[start:end]]]))
+        g_children.write(''.join([w + '\n' for w in words[table.children[start:end]]]))
+        if use_heads_next:
+            g_heads_next.write(''.join(format_ragged_rows(table.heads_next, words, '\t', start, end)))
+        if use_heads_pos:
+            g_heads_pos.write(''.join(format_ragged_rows(table.heads_pos, tags, '\t', start, end)))
+        if use_heads_next_pos:
+            g_heads_next_pos.write(''.join(format_ragged_rows(table.heads_next_pos, tags, '\t', start, end)))
+
+    g_heads.close()
+    g_nheads.close()
+    g_labels.close()
+    g_preps.close()
+    g_children.close()
+    if use_heads_next:
+        g_heads_next.close()
+    if use_heads_pos:
+        g_heads_pos.close()
+    if use_heads_next_pos:
+        g_heads_next_pos.close()
+
+
+def write_attachment_table(table, output_pref, get_heads_next=False):
+    """
+    Write an attachment table with full PPs (same format as write_attachments)
+    """
+
+    words = np.array(table.words + [''], dtype=object)[:-1]
+    g_heads = open(output_pref + '.heads', 'w')
+    g_nheads = open(output_pref + '.nheads', 'w')
+    g_labels = open(output_pref + '.labels', 'w')
+    g_pp_words = open(output_pref + '.ppwords', 'w')
+    g_pp_parents = open(output_pref + '.ppparents', 'w')
+    if get_heads_next:
+        g_heads_next = open(output_pref + '.heads.next', 'w')
+
+    nheads = table.get_nheads()
+    pp_parents = RaggedArray(table.pp_parents.values.astype(str).astype(object), table.pp_parents.offsets)
+    identity = np.arange(len(pp_parents.values))
+    heads_next_lengths = table.heads_next.lengths()
+    for start in xrange(0, len(table), WRITE_CHUNK_SIZE):
+        end = min(start + WRITE_CHUNK_SIZE, len(table))
+        g_heads.write(''.join(format_ragged_rows(table.heads, words, ' ', start, end)))
+        g_nheads.write(format_numbers(nheads[start:end]))
+        g_labels.write(format_numbers(table.labels[start:end]))
+        g_pp_words.write(''.join(format_ragged_rows(table.pp_words, words, ' ', start, end)))
+        g_pp_parents.write(''.join(format_ragged_rows(RaggedArray(identity, pp_parents.offsets), pp_parents.values, ' ', start, end)))
+        if get_heads_next:
+            lines = format_ragged_rows(table.heads_next, words, '\t', start, end)
+            g_heads_next.write(''.join([line for line, length in zip(lines, heads_next_lengths[start:end]) if length > 0]))
+
+    g_heads.close()
+    g_nheads.close()
+    g_labels.close()
+    g_pp_words.close()
+    g_pp_parents.close()
+    if get_heads_next:
+        g_heads_next.close()
+
+
+def to_unicode_array(symbols):
+    return np.array([s if isinstance(s, unicode) else s.decode('utf-8') for s in symbols], dtype=np.unicode_)
+
+
+def write_attachment_bundle(table, filename, word_vectors=None, compressed=False):
+    """
+    Write an attachment table to one .npz bundle
+
+    Ragged columns are stored as padded matrices (num attachments x max # of heads) with -1 padding,
+    next to nheads, labels, preps, children, the words and tags vocabularies, and optionally the word vectors
+    of the vocabulary (row i is the vector of words[i], zeros and has_vector[i] = False if missing)
+    """
+
+    arrays = dict()
+    arrays['words'] = to_unicode_array(table.words)
+    arrays['tags'] = to_unicode_array(table.tags)
+    arrays['nheads'] = table.get_nheads().astype(np.int32)
+    for name in ['labels', 'preps', 'children', 'prep_ids', 'sentence_start_lines']:
+        arrays[name] = getattr(table, name)
+    max_nheads = arrays['nheads'].max() if len(table) else 0
+    for name in ['heads', 'heads_ids', 'heads_next', 'heads_pos', 'heads_next_pos']:
+        column = getattr(table, name)
+        if column is not None and len(column.values):
+            arrays[name] = column.to_padded(-1, max_nheads)
+    if table.pp_words is not None:
+        arrays['pp_nwords'] = table.pp_words.lengths().astype(np.int32)
+        arrays['pp_words'] = table.pp_words.to_padded()
+        arrays['pp_parents'] = table.pp_parents.to_padded()
+    if word_vectors:
+        has_vector = np.array([w in word_vectors for w in table.words], dtype=np.bool_)
+        dim = len(word_vectors[table.words[np.flatnonzero(has_vector)[0]]]) if has_vector.any() else 0
+        vectors = np.zeros((len(table.words), dim), dtype=np.float32)
+        for i in np.flatnonzero(has_vector):
+            vectors[i] = word_vectors[table.words[i]]
+        arrays['word_vectors'] = vectors
+        arrays['has_vector'] = has_vector
+    if compressed:
+        np.savez_compressed(filename, **arrays)
+    else:
+        np.savez(filename, **arrays)
+
+
+def load_attachment_bundle(filename):
+    """
+    Load a bundle written by write_attachment_bundle
+
+    Return a dict from array name to array, with 'words' and 'tags' as lists of unicode strings
+    """
+
+    with np.load(filename) as f:
+        bundle = dict((name, f[name]) for name in f.files)
+    bundle['words'] = bundle['words'].tolist()
+    bundle['tags'] = bundle['tags'].tolist()
+    return bundle
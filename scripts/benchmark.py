@@ -0,0 +1,360 @@
+# benchmark of the extraction, word vector loading, writing and evaluation hot paths on synthetic data built from the shipped pp-data statistics
+
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from extract_pp_attach_for_matlab import get_pp_attachments_from_wsj_sentence, write_conll_attachments, \
+    eval_pp_attachments_from_conll_pred_file
+from sentence import ENGLISH_POS_CLASSES, CONLL_POS_CLASSES, CONLL_LANG_ARABIC_SPMRL, POS_CLASS_OTHER
+from utils import read_wsj_dep_file, get_word_vectors
+
+try:
+    import tracemalloc  # python 3, or a python 2 build patched with pytracemalloc
+except ImportError:
+    tracemalloc = None
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'data')
+ENGLISH_DATA_PREF = os.path.join(DATA_DIR, 'pp-data-english', 'wsj.2-21.txt.dep.pp')
+ARABIC_DATA_PREF = os.path.join(DATA_DIR, 'pp-data-arabic', 'spmrl.train.lab.all.pp')
+MAX_HEAD_DISTANCE = 10
+MAX_CHILD_DISTANCE = 200
+STAGES = ['read_wsj_dep_file', 'get_word_vectors', 'get_pp_attachments_from_wsj_sentence', 'write_conll_attachments', \
+          'eval_pp_attachments_from_conll_pred_file']
+
+
+class SyntheticTreebank(object):
+    """
+    Generator of synthetic treebanks, sampling PP attachment instances from a pp-data prefix
+
+    Each sentence is a sequence of instances: the candidate heads (verbs or nouns, as in heads.pos), each followed by a
+    filler word when heads.next.pos has a non-candidate tag there, then the preposition and its child
+    The preposition attaches to its gold head (labels), the child to the preposition, and every other word to the word before it
+    """
+
+    def __init__(self, data_pref, pos_tags, pos_classes, seed=1):
+        """
+        pos_tags - tags to use for (verb, noun, prep) words
+        pos_classes - pos class table (as in sentence.py) of the treebank's tags, for choosing filler tags
+        """
+
+        self.verb_tag, self.noun_tag, self.prep_tag = pos_tags
+        self.pos_classes = pos_classes
+        self.random = random.Random(seed)
+        self.instances = []
+        with open(data_pref + '.heads.words') as heads_f, open(data_pref + '.heads.pos') as heads_pos_f, \
+                open(data_pref + '.heads.next.pos') as heads_next_pos_f, open(data_pref + '.preps.words') as preps_f, \
+                open(data_pref + '.children.words') as children_f, open(data_pref + '.labels') as labels_f:
+            for heads, heads_pos, heads_next_pos, prep, child, label in zip(heads_f, heads_pos_f, heads_next_pos_f, preps_f, children_f, labels_f):
+                self.instances.append((heads.split(), heads_pos.split(), heads_next_pos.rstrip('\n').split('\t'), \
+                                       prep.strip(), child.strip(), int(label)))
+
+    def get_vocab(self):
+        vocab = set()
+        for heads, _, heads_next_pos, prep, child, _ in self.instances:
+            vocab.update(heads)
+            vocab.update(self.get_filler(tag) for tag in heads_next_pos)
+            vocab.add(prep)
+            vocab.add(child)
+        return vocab
+
+    @staticmethod
+    def get_filler(tag):
+        return tag.lower()
+
+    def get_sentence_rows(self, num_instances):
+        """
+        Get (token, pos, parent) rows of a sentence made of num_instances random instances
+        """
+
+        rows = []
+        for _ in xrange(num_instances):
+            heads, heads_pos, heads_next_pos, prep, child, label = self.random.choice(self.instances)
+            heads_ids = []
+            for k, head in enumerate(heads):
+                rows.append([head, self.verb_tag if heads_pos[k] == '1' else self.noun_tag, len(rows)])
+                heads_ids.append(len(rows))
+                tag = heads_next_pos[k] if k < len(heads_next_pos) else ''
+                if tag and self.pos_classes.get(tag, POS_CLASS_OTHER) == POS_CLASS_OTHER:
+                    rows.append([self.get_filler(tag), tag, len(rows)])
+            rows.append([prep, self.prep_tag, heads_ids[label-1]])
+            rows.append([child, self.noun_tag, len(rows)])
+        return rows
+
+    def get_sentences(self, num_sentences, mean_instances):
+        for _ in xrange(num_sentences):
+            yield self.get_sentence_rows(self.random.randint(1, 2*mean_instances - 1))
+
+
+def write_wsj_dep_file(sentences, filename):
+
+    with open(filename, 'w') as f:
+        for rows in sentences:
+            for i, (token, pos, parent) in enumerate(rows):
+                f.write('\t'.join([str(i+1), token, '_', pos, '_', '_', str(parent), 'DEP', '_', '_']) + '\n')
+            f.write('\n')
+
+
+def write_conll_gold_pred_files(sentences, gold_filename, pred_filename, prep_tag, error_rate, seed=1):
+    """
+    Write sentences as a gold conll file, and as a predicted one where error_rate of the prepositions attach to the
+    word before them (or before their gold head, if that is the word before them)
+    """
+
+    rand = random.Random(seed)
+    with open(gold_filename, 'w') as gold_f, open(pred_filename, 'w') as pred_f:
+        for rows in sentences:
+            for i, (token, pos, parent) in enumerate(rows):
+                splt = [str(i+1), token, token, pos, pos, '_', str(parent), 'DEP', '_', '_']
+                gold_f.write('\t'.join(splt) + '\n')
+                if pos == prep_tag and rand.random() < error_rate:
+                    splt[6] = str(i if parent != i else i-1)
+                pred_f.write('\t'.join(splt) + '\n')
+            gold_f.write('\n')
+            pred_f.write('\n')
+
+
+def write_word_vectors_file(vocab, filename, num_words, dim, oov_rate, seed=1):
+    """
+    Write a word2vec text file with vectors for the vocabulary (except a random oov_rate of it), padded with
+    random words up to num_words
+    """
+
+    rand = random.Random(seed)
+    words = [w for w in sorted(vocab) if rand.random() >= oov_rate]
+    words += ['pad%d' % i for i in xrange(num_words - len(words))]
+    with open(filename, 'w') as f:
+        for word in words:
+            f.write(word + ' ' + ' '.join('%.6f' % rand.uniform(-1, 1) for _ in xrange(dim)) + '\n')
+
+
+def generate_data(args, work_dir):
+    """
+    Write the synthetic treebanks and word vectors files to work_dir and return their names
+    """
+
+    files = {'wsj_dep': os.path.join(work_dir, 'synthetic.wsj.dep'), 'english_vectors': os.path.join(work_dir, 'english.vectors.txt'), \
+             'conll_gold': os.path.join(work_dir, 'synthetic.arabic.conll'), 'conll_pred': os.path.join(work_dir, 'synthetic.arabic.pred.conll'), \
+             'arabic_vectors': os.path.join(work_dir, 'arabic.vectors.txt'), 'output_pref': os.path.join(work_dir, 'out', 'synthetic.wsj.dep')}
+    if not os.path.isdir(os.path.dirname(files['output_pref'])):
+        os.makedirs(os.path.dirname(files['output_pref']))
+    english = SyntheticTreebank(args.english_data_pref, ('VBD', 'NN', 'IN'), ENGLISH_POS_CLASSES, args.seed)
+    write_wsj_dep_file(english.get_sentences(args.sentences, args.pps_per_sentence), files['wsj_dep'])
+    write_word_vectors_file(english.get_vocab(), files['english_vectors'], args.vector_words, args.vector_dim, args.oov_rate, args.seed)
+    arabic = SyntheticTreebank(args.arabic_data_pref, ('V', 'N', 'P'), CONLL_POS_CLASSES[CONLL_LANG_ARABIC_SPMRL], args.seed)
+    write_conll_gold_pred_files(arabic.get_sentences(args.sentences, args.pps_per_sentence), files['conll_gold'], files['conll_pred'], \
+                                'P', args.error_rate, args.seed)
+    write_word_vectors_file(arabic.get_vocab(), files['arabic_vectors'], 0, args.vector_dim, args.oov_rate, args.seed)
+    return files
+
+
+def extract_wsj_attachments(sentences, word_vectors):
+
+    attachments = []
+    for sentence in sentences:
+        attachments += get_pp_attachments_from_wsj_sentence(sentence, MAX_HEAD_DISTANCE, MAX_CHILD_DISTANCE, word_vectors)
+    return attachments
+
+
+def prepare_stage(stage, files):
+    """
+    Load the inputs of a stage, and return a function running the stage once and returning its output and counts
+    (sentences, attachments and other processed items)
+    """
+
+    if stage == 'read_wsj_dep_file':
+        def run():
+            sentences = read_wsj_dep_file(files['wsj_dep'])
+            return sentences, {'sentences': len(sentences)}
+    elif stage == 'get_word_vectors':
+        def run():
+            word_vectors = get_word_vectors(files['english_vectors'])
+            return word_vectors, {'vectors': len(word_vectors)}
+    elif stage == 'get_pp_attachments_from_wsj_sentence':
+        sentences = read_wsj_dep_file(files['wsj_dep'])
+        word_vectors = get_word_vectors(files['english_vectors'])
+        def run():
+            attachments = extract_wsj_attachments(sentences, word_vectors)
+            return attachments, {'sentences': len(sentences), 'attachments': len(attachments)}
+    elif stage == 'write_conll_attachments':
+        attachments = extract_wsj_attachments(read_wsj_dep_file(files['wsj_dep']), get_word_vectors(files['english_vectors']))
+        def run():
+            write_conll_attachments(attachments, files['output_pref'])
+            return None, {'attachments': len(attachments)}
+    elif stage == 'eval_pp_attachments_from_conll_pred_file':
+        word_vectors = get_word_vectors(files['arabic_vectors'])
+        def run():
+            evaluation = eval_pp_attachments_from_conll_pred_file(files['conll_gold'], files['conll_pred'], CONLL_LANG_ARABIC_SPMRL, \
+                                                                  MAX_HEAD_DISTANCE, MAX_CHILD_DISTANCE, True, word_vectors)
+            return evaluation, {'attachments': evaluation.num_total}
+    else:
+        raise ValueError('unknown stage: ' + stage)
+    return run
+
+
+def get_peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0  # ru_maxrss is in kilobytes on linux
+
+
+def count_allocations(run):
+    """
+    Run a stage once and count its memory allocations
+
+    Report the gc-tracked objects held by the stage's output and the minor page faults of the run (memory newly
+    taken from the system); with tracemalloc, also the peak traced bytes and the number of blocks held by the output
+    """
+
+    allocations = {}
+    gc.collect()
+    num_objects = len(gc.get_objects())
+    minor_faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+    if tracemalloc:
+        tracemalloc.start()
+    output, _ = run()
+    allocations['minor_page_faults'] = resource.getrusage(resource.RUSAGE_SELF).ru_minflt - minor_faults
+    if tracemalloc:
+        allocations['traced_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        allocations['traced_blocks'] = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+        tracemalloc.stop()
+    gc.collect()
+    allocations['output_gc_objects'] = len(gc.get_objects()) - num_objects
+    del output
+    return allocations
+
+
+def run_stage(stage, files, repeat, conn):
+    """
+    Benchmark one stage (in its own process, so that peak memory is the stage's) and send the result through conn
+    """
+
+    sys.stdout = open(os.devnull, 'w')  # keep the stages' progress and report lines out of the benchmark's output
+    try:
+        run = prepare_stage(stage, files)
+        setup_rss = get_peak_rss_mb()
+        times = []
+        for _ in xrange(repeat):
+            start = time.time()
+            _, counts = run()
+            times.append(time.time() - start)
+        result = {'seconds': min(times), 'all_seconds': times, 'setup_peak_rss_mb': setup_rss, 'peak_rss_mb': get_peak_rss_mb()}
+        result['allocations'] = count_allocations(run)
+        for name, count in counts.iteritems():
+            result[name] = count
+            result[name + '_per_sec'] = count / min(times) if min(times) > 0 else None
+        conn.send(result)
+    except Exception as e:
+        conn.send({'error': repr(e)})
+    conn.close()
+
+
+def run_in_process(target, args):
+    """
+    Run target(*args, conn) in a child process and return what it sends through conn (None if it exits without sending)
+    """
+
+    parent_conn, child_conn = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=target, args=args + (child_conn,))
+    process.start()
+    child_conn.close()  # so that recv fails instead of blocking if the child dies
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        result = None
+    process.join()
+    return result
+
+
+def generate_data_in_process(args, work_dir, conn):
+
+    conn.send(generate_data(args, work_dir))
+    conn.close()
+
+
+def get_git_revision():
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(results, baseline):
+    """
+    Print the throughput ratios of each stage to a baseline results file (comparable across data sizes)
+    """
+
+    for stage, result in sorted(results['stages'].iteritems()):
+        base = baseline['stages'].get(stage)
+        if not base or 'error' in base or 'error' in result:
+            continue
+        ratios = ['%s: %.3f' % (name, result[name] / base[name]) for name in sorted(result) \
+                  if name.endswith('_per_sec') and result[name] and base.get(name)]
+        print stage + ':', ', '.join(ratios), '- peak rss (MB):', base['peak_rss_mb'], '->', result['peak_rss_mb']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the PP attachment hot paths on synthetic data and write the results as json')
+    parser.add_argument('output_file', help='Json results file')
+    parser.add_argument('--sentences', type=int, default=10000, help='Number of sentences in each synthetic treebank')
+    parser.add_argument('--pps_per_sentence', type=int, default=2, help='Mean number of PP instances per sentence')
+    parser.add_argument('--vector_words', type=int, default=100000, help='Number of words in the english word vectors file')
+    parser.add_argument('--vector_dim', type=int, default=25)
+    parser.add_argument('--oov_rate', type=float, default=0.05, help='Fraction of the vocabulary without word vectors')
+    parser.add_argument('--error_rate', type=float, default=0.2, help='Fraction of wrongly attached prepositions in the predicted conll file')
+    parser.add_argument('--english_data_pref', default=ENGLISH_DATA_PREF, help='pp-data prefix to sample english instances from')
+    parser.add_argument('--arabic_data_pref', default=ARABIC_DATA_PREF, help='pp-data prefix to sample arabic instances from')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs of each stage (the fastest is reported)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--work_dir', help='Directory for the synthetic data (default: a temporary directory, removed at the end)')
+    parser.add_argument('--baseline', help='Results file of a previous run to compare to')
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='pp_benchmark')
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    try:
+        print 'generating synthetic data in:', work_dir
+        start = time.time()
+        files = run_in_process(generate_data_in_process, (args, work_dir))
+        if files is None:
+            sys.stderr.write('Error: could not generate synthetic data\n')
+            sys.exit(1)
+        print 'generated data in', time.time() - start, 'seconds'
+        results = {'python': platform.python_version(), 'platform': platform.platform(), 'git_revision': get_git_revision(), \
+                   'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'tracemalloc': tracemalloc is not None, 'params': vars(args), \
+                   'file_sizes': dict((name, os.path.getsize(filename)) for name, filename in files.iteritems() if os.path.isfile(filename)), \
+                   'stages': {}}
+        for stage in args.stages:
+            print 'benchmarking:', stage
+            result = run_in_process(run_stage, (stage, files, args.repeat)) or {'error': 'stage process exited'}
+            if 'error' in result:
+                sys.stderr.write('Error: stage ' + stage + ' failed: ' + result['error'] + '\n')
+            else:
+                print stage + ':', result['seconds'], 'seconds,', 'peak rss (MB):', result['peak_rss_mb']
+            results['stages'][stage] = result
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir)
+
+    with open(args.output_file, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print 'wrote results to:', args.output_file
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare_results(results, json.load(f))
+
+
+if __name__=='__main__':
+    main()
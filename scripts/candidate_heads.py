@@ -0,0 +1,148 @@
+# vectorized discovery of the candidate heads of prepositions, over the pos classes of whole batches of sentences
+
+from array import array
+import numpy as np
+
+from attachment_table import RaggedArray
+from profiling import get_profiler
+from sentence import POS_CLASS_NOUN, POS_CLASS_VERB, POS_CLASS_PREP
+
+BATCH_SENTENCES = 1000  # number of sentences processed together by iter_sentence_candidate_heads
+
+
+class CandidateHeads(object):
+    """
+    Candidate heads of the prepositions in a batch of sentences
+
+    Positions index into the concatenation of the sentences' words (0-based)
+    preps - positions of the prepositions (the last word of a sentence is never taken)
+    heads - RaggedArray with the positions of each preposition's candidate heads: nouns and verbs among the
+    max_head_distance words before it in its sentence
+    gold_labels - 1-based index of the gold head (the preposition's parent) among the candidates, -1 if it is not a candidate
+    """
+
+    def __init__(self, preps, heads, gold_labels):
+        self.preps = preps
+        self.heads = heads
+        self.gold_labels = gold_labels
+
+    def get_nheads(self):
+        return self.heads.lengths()
+
+    def get_ambiguous(self):
+        """
+        Get a mask of the prepositions with more than one candidate head
+        """
+
+        return self.heads.lengths() > 1
+
+
+def find_candidate_heads(pos_classes, parents, sentence_starts, max_head_distance):
+    """
+    Find the candidate heads of all prepositions in concatenated sentences
+
+    pos_classes - pos class (POS_CLASS_*) of each word, parents - 1-based parent of each word within its sentence (0 is root)
+    sentence_starts - position of the first word of each sentence
+    Return a CandidateHeads
+    """
+
+    pos_classes = np.asarray(pos_classes)
+    parents = np.asarray(parents, dtype=np.int64)
+    sentence_starts = np.asarray(sentence_starts, dtype=np.int64)
+    num_words = len(pos_classes)
+    sentence_ends = np.append(sentence_starts[1:], num_words)[:len(sentence_starts)]
+    word_sentence_starts = np.repeat(sentence_starts, sentence_ends - sentence_starts)
+
+    is_candidate = (pos_classes == POS_CLASS_NOUN) | (pos_classes == POS_CLASS_VERB)
+    is_prep = pos_classes == POS_CLASS_PREP
+    is_prep[sentence_ends[sentence_ends > sentence_starts] - 1] = False
+    preps = np.flatnonzero(is_prep)
+
+    # num_before[k] is the number of candidates before position k, so the candidates of a window [start, end)
+    # are candidate_positions[num_before[start]:num_before[end]]
+    num_before = np.zeros(num_words + 1, dtype=np.int64)
+    np.cumsum(is_candidate, out=num_before[1:])
+    prep_sentence_starts = word_sentence_starts[preps]
+    window_starts = np.maximum(prep_sentence_starts, preps - max_head_distance)
+    first = num_before[window_starts]
+    nheads = num_before[preps] - first
+    offsets = np.zeros(len(preps) + 1, dtype=np.int64)
+    np.cumsum(nheads, out=offsets[1:])
+    candidate_positions = np.flatnonzero(is_candidate)
+    heads = RaggedArray(candidate_positions[np.repeat(first - offsets[:-1], nheads) + np.arange(offsets[-1])], offsets)
+
+    gold_heads = prep_sentence_starts + parents[preps] - 1
+    in_window = (parents[preps] > 0) & (gold_heads >= window_starts) & (gold_heads < preps)
+    in_window[in_window] = is_candidate[gold_heads[in_window]]
+    gold_labels = np.where(in_window, num_before[np.clip(gold_heads + 1, 0, num_words)] - first, -1)
+    return CandidateHeads(preps, heads, gold_labels)
+
+
+def get_batch_candidate_heads(sentences, max_head_distance, ambiguous_only=False):
+    """
+    Find the candidate heads of the prepositions in a list of sentences
+
+    Return a list with a dict for each sentence, from preposition index (0-based) to a list of
+    candidate head indices (0-based) and the gold head label (as in CandidateHeads)
+    Prepositions whose gold head is not a candidate never make a valid attachment, and are left out; if ambiguous_only,
+    so are prepositions with a single candidate head
+    """
+
+    pos_classes = array('b')
+    parents = array('i')
+    sentence_starts = []
+    for sentence in sentences:
+        sentence_starts.append(len(pos_classes))
+        pos_classes.extend(sentence.get_pos_classes())
+        parents.extend(sentence.parents)
+    candidates = find_candidate_heads(np.frombuffer(pos_classes, dtype=np.int8), np.frombuffer(parents, dtype=np.int32), \
+                                      sentence_starts, max_head_distance)
+
+    keep = candidates.gold_labels != -1
+    profiler = get_profiler()
+    profiler.count('sentences', len(sentences))
+    profiler.count('preps', len(candidates.preps))
+    profiler.reject('gold_not_candidate', len(keep) - int(np.count_nonzero(keep)))
+    if ambiguous_only:
+        num_kept = int(np.count_nonzero(keep))
+        keep &= candidates.get_ambiguous()
+        profiler.reject('unambiguous', num_kept - int(np.count_nonzero(keep)))
+    keep = np.flatnonzero(keep)
+    prep_positions = candidates.preps[keep]
+    heads = candidates.heads.take(keep)
+    sentence_starts = np.asarray(sentence_starts, dtype=np.int64)
+    sentence_ids = np.searchsorted(sentence_starts, prep_positions, side='right') - 1
+    # convert to indices within each sentence
+    preps = (prep_positions - sentence_starts[sentence_ids]).tolist()
+    heads_ids = (heads.values - sentence_starts[sentence_ids[heads.row_ids()]]).tolist()
+    offsets = heads.offsets.tolist()
+    gold_labels = candidates.gold_labels[keep].tolist()
+    sentence_candidates = [dict() for _ in sentences]
+    for k, sentence_id in enumerate(sentence_ids.tolist()):
+        sentence_candidates[sentence_id][preps[k]] = (heads_ids[offsets[k]:offsets[k+1]], gold_labels[k])
+    return sentence_candidates
+
+
+def get_sentence_candidate_heads(sentence, max_head_distance, ambiguous_only=False):
+    """
+    Find the candidate heads of the prepositions in one sentence (see get_batch_candidate_heads)
+    """
+
+    return get_batch_candidate_heads([sentence], max_head_distance, ambiguous_only)[0]
+
+
+def iter_sentence_candidate_heads(sentences, max_head_distance, ambiguous_only=False, batch_sentences=BATCH_SENTENCES):
+    """
+    Iterate over (sentence, candidates) pairs, finding the candidates for batch_sentences sentences at a time
+    """
+
+    batch = []
+    for sentence in sentences:
+        batch.append(sentence)
+        if len(batch) == batch_sentences:
+            for pair in zip(batch, get_batch_candidate_heads(batch, max_head_distance, ambiguous_only)):
+                yield pair
+            batch = []
+    if batch:
+        for pair in zip(batch, get_batch_candidate_heads(batch, max_head_distance, ambiguous_only)):
+            yield pair
@@ -0,0 +1,279 @@
+# columnar binary treebanks: whole corpora as integer columns in memory-mapped .npy files, for repeated extraction
+# without parsing text
+
+import argparse
+import json
+import os
+import shutil
+from array import array
+import numpy as np
+
+from sentence import Sentence
+from utils import iter_wsj_dep_file, iter_conll_file, iter_spmrl_file, iter_wsj_dep_column_sentences, iter_conll_column_sentences
+from vocabulary import Vocabulary
+
+TREEBANK_VERSION = 1  # bump when the treebank format changes
+TREEBANK_WSJ = 'wsj'
+TREEBANK_CONLL = 'conll'
+TREEBANK_SPMRL = 'spmrl'
+TREEBANK_KINDS = [TREEBANK_WSJ, TREEBANK_CONLL, TREEBANK_SPMRL]
+# string columns of the sentences of each kind, in the order of the blocks of utils.iter_conll_column_blocks
+STRING_COLUMNS = {TREEBANK_WSJ: ['tokens', 'poses', 'labels'], TREEBANK_CONLL: ['tokens', 'lemmas', 'poses', 'labels'], \
+                  TREEBANK_SPMRL: ['tokens', 'poses', 'labels', 'morphs']}
+SYMBOL_COLUMNS = ['poses', 'labels']  # columns stored as ids of symbols, the other string columns are ids of words
+BLOCK_SENTENCES = 10000  # number of sentences turned into python objects at a time
+META_FILENAME = 'meta.json'
+WORDS_FILENAME = 'words.txt'
+SYMBOLS_FILENAME = 'symbols.txt'
+
+
+def get_file_stamp(filename):
+    """
+    Get the size and modification time (microseconds) of a file, to tell if a treebank converted from it is up to date
+    """
+
+    stat = os.stat(filename)
+    return [stat.st_size, int(stat.st_mtime * 1e6)]
+
+
+def write_strings(strings, filename, encoding=None):
+    """
+    Write strings (which have no whitespace, e.g. conll fields) one per line
+    """
+
+    with open(filename, 'wb') as f:
+        for s in strings:
+            f.write((s.encode(encoding) if encoding else s) + '\n')
+
+
+def read_strings(filename, encoding=None):
+    """
+    Read strings written by write_strings into a numpy object array (for fast lookup of many ids at once)
+    """
+
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if encoding:
+        data = data.decode(encoding)
+    strings = data.split('\n')[:-1]
+    result = np.empty(len(strings), dtype=object)
+    result[:] = strings
+    return result
+
+
+def write_treebank(sentences, treebank_dir, kind, encoding=None, language=None, lower_case=False, source_filename=None):
+    """
+    Write sentences of one kind (see TREEBANK_KINDS) as a columnar treebank in the directory treebank_dir
+
+    The treebank has one int32 array per column, concatenated over all sentences: word ids (tokens, and lemmas or
+    morphs), symbol ids (poses, labels) and parents, with the sentence offsets and start lines
+    encoding - encoding of unicode strings in the sentences (None for byte strings)
+    language, lower_case - how the sentences were read, recorded for loading and for checking that the treebank is up to date
+    source_filename - file the sentences were read from, whose size and modification time are recorded
+    """
+
+    words = Vocabulary()
+    symbols = Vocabulary()
+    columns = dict((name, array('i')) for name in STRING_COLUMNS[kind] + ['parents'])
+    sentence_offsets = [0]
+    sentence_start_lines = []
+    for sentence in sentences:
+        for name in STRING_COLUMNS[kind]:
+            values = getattr(sentence, name)
+            if len(values) != len(sentence.parents):
+                raise ValueError('sentence starting at line ' + str(sentence.start_line) + ' has ' + str(len(values)) + ' ' + name + \
+                                 ' for ' + str(len(sentence.parents)) + ' words')
+            columns[name].extend((symbols if name in SYMBOL_COLUMNS else words).get_ids(values))
+        columns['parents'].extend(sentence.parents)
+        sentence_offsets.append(sentence_offsets[-1] + len(sentence.parents))
+        sentence_start_lines.append(sentence.start_line)
+
+    tmp_dir = treebank_dir.rstrip('/') + '.tmp' + str(os.getpid())
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    for name, values in columns.iteritems():
+        np.save(os.path.join(tmp_dir, name + '.npy'), np.frombuffer(values, dtype=np.int32) if len(values) else np.zeros(0, dtype=np.int32))
+    np.save(os.path.join(tmp_dir, 'sentence_offsets.npy'), np.array(sentence_offsets, dtype=np.int64))
+    np.save(os.path.join(tmp_dir, 'sentence_start_lines.npy'), np.array(sentence_start_lines, dtype=np.int64))
+    write_strings(words.words, os.path.join(tmp_dir, WORDS_FILENAME), encoding)
+    write_strings(symbols.words, os.path.join(tmp_dir, SYMBOLS_FILENAME), encoding)
+    meta = {'version': TREEBANK_VERSION, 'kind': kind, 'encoding': encoding, 'language': language, 'lower_case': lower_case, \
+            'source_stamp': get_file_stamp(source_filename) if source_filename else None, \
+            'num_sentences': len(sentence_start_lines), 'num_words': sentence_offsets[-1]}
+    with open(os.path.join(tmp_dir, META_FILENAME), 'w') as f:
+        json.dump(meta, f, indent=2)
+    if os.path.isdir(treebank_dir):
+        shutil.rmtree(treebank_dir)
+    os.rename(tmp_dir, treebank_dir)
+    return meta
+
+
+def convert_to_treebank(filename, treebank_dir, kind, language=None, lower_case=False):
+    """
+    Read a WSJ .dep, conll or SPMRL file (with morphs) and write it as a columnar treebank
+
+    Sentences are read as by the extraction functions for the file (lower_case applies to WSJ tokens, language to conll)
+    """
+
+    print 'converting', kind, 'file:', filename, 'to treebank:', treebank_dir
+    if kind == TREEBANK_WSJ:
+        return write_treebank(iter_wsj_dep_file(filename, lower_case), treebank_dir, kind, None, None, lower_case, filename)
+    if kind == TREEBANK_CONLL:
+        return write_treebank(iter_conll_file(filename, language), treebank_dir, kind, 'utf-8', language, False, filename)
+    if kind == TREEBANK_SPMRL:
+        return write_treebank(iter_spmrl_file(filename, True), treebank_dir, kind, None, None, False, filename)
+    raise ValueError('unknown treebank kind: ' + str(kind))
+
+
+def load_or_convert_treebank(filename, treebank_dir, kind, language=None, lower_case=False):
+    """
+    Open the columnar treebank of a file, converting the file first if the treebank is missing, was converted with
+    other options, or is older than the file
+    """
+
+    meta_filename = os.path.join(treebank_dir, META_FILENAME)
+    if os.path.isfile(meta_filename):
+        with open(meta_filename) as f:
+            meta = json.load(f)
+        if meta.get('version') == TREEBANK_VERSION and meta['kind'] == kind and meta['language'] == language and \
+                meta['lower_case'] == lower_case and meta['source_stamp'] == get_file_stamp(filename):
+            return open_treebank(treebank_dir)
+    convert_to_treebank(filename, treebank_dir, kind, language, lower_case)
+    _open_treebanks.pop(treebank_dir, None)
+    return open_treebank(treebank_dir)
+
+
+def iter_spmrl_column_sentences(blocks):
+    """
+    Yield SPMRL sentences (with morphs) from blocks of a treebank (see ColumnarTreebank.iter_blocks)
+    """
+
+    for start_lines, offsets, (tokens, poses, labels, morphs), parents in blocks:
+        for i, start_line in enumerate(start_lines):
+            start, end = offsets[i], offsets[i+1]
+            s = Sentence(tokens[start:end], poses[start:end], labels[start:end], parents[start:end], morphs[start:end])
+            s.set_start_line(start_line)
+            yield s
+
+
+class ColumnarTreebank(object):
+    """
+    Columnar treebank written by write_treebank, with its columns memory-mapped (so processes reading the same
+    treebank share one copy in the page cache)
+
+    Sentences are made on demand for any range of sentence ids (0-based)
+    """
+
+    def __init__(self, treebank_dir):
+        self.treebank_dir = treebank_dir
+        with open(os.path.join(treebank_dir, META_FILENAME)) as f:
+            self.meta = json.load(f)
+        if self.meta.get('version') != TREEBANK_VERSION:
+            raise ValueError('treebank ' + treebank_dir + ' has version ' + str(self.meta.get('version')) + ', expected ' + str(TREEBANK_VERSION))
+        self.kind = self.meta['kind']
+        self.language = self.meta['language']
+        encoding = self.meta['encoding']
+        self.words = read_strings(os.path.join(treebank_dir, WORDS_FILENAME), encoding)
+        self.symbols = read_strings(os.path.join(treebank_dir, SYMBOLS_FILENAME), encoding)
+        self.columns = dict((name, self.load_column(name)) for name in STRING_COLUMNS[self.kind] + ['parents'])
+        self.sentence_offsets = self.load_column('sentence_offsets')
+        self.sentence_start_lines = self.load_column('sentence_start_lines')
+
+    def load_column(self, name):
+        return np.load(os.path.join(self.treebank_dir, name + '.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.sentence_start_lines)
+
+    def get_sentence_shards(self, num_shards):
+        """
+        Split the sentences into about num_shards ranges with about the same number of words
+
+        Return a list of (start, end) sentence id ranges
+        """
+
+        num_words = self.sentence_offsets[-1]
+        bounds = np.searchsorted(self.sentence_offsets, np.linspace(0, num_words, max(1, num_shards) + 1)[1:-1])
+        bounds = np.unique(np.concatenate([[0], bounds, [len(self)]]))
+        return [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def get_word_ids(self, ids, vocabulary):
+        """
+        Get the ids in vocabulary of words given by their treebank ids (only the words that occur are added to it)
+        """
+
+        unique_ids, inverse = np.unique(ids, return_inverse=True)
+        vocabulary_ids = np.frombuffer(vocabulary.get_ids(self.words[unique_ids]), dtype=np.int32)
+        return vocabulary_ids[inverse]
+
+    def iter_blocks(self, start=0, end=None, vocabulary=None, block_sentences=BLOCK_SENTENCES):
+        """
+        Yield the sentences from start up to end (exclusive) in blocks of the format of utils.iter_conll_column_blocks,
+        with the fields of STRING_COLUMNS of the treebank's kind
+
+        If vocabulary (a Vocabulary) is given, word fields are its word ids
+        """
+
+        end = len(self) if end is None else end
+        for block_start in xrange(start, end, block_sentences):
+            block_end = min(block_start + block_sentences, end)
+            word_start, word_end = self.sentence_offsets[block_start], self.sentence_offsets[block_end]
+            fields = []
+            for name in STRING_COLUMNS[self.kind]:
+                ids = self.columns[name][word_start:word_end]
+                if name in SYMBOL_COLUMNS:
+                    fields.append(self.symbols[ids].tolist())
+                elif vocabulary is not None:
+                    fields.append(self.get_word_ids(ids, vocabulary).tolist())
+                else:
+                    fields.append(self.words[ids].tolist())
+            parents = array('i', self.columns['parents'][word_start:word_end].tostring())
+            offsets = (self.sentence_offsets[block_start:block_end+1] - word_start).tolist()
+            yield self.sentence_start_lines[block_start:block_end].tolist(), offsets, fields, parents
+
+    def iter_sentences(self, start=0, end=None, vocabulary=None):
+        """
+        Yield the sentences from start up to end (exclusive), the same as read from the converted file
+
+        If vocabulary (a Vocabulary) is given, tokens (and conll lemmas) are stored as its word ids (not for SPMRL)
+        """
+
+        blocks = self.iter_blocks(start, end, vocabulary if self.kind != TREEBANK_SPMRL else None)
+        if self.kind == TREEBANK_WSJ:
+            return iter_wsj_dep_column_sentences(blocks)
+        if self.kind == TREEBANK_CONLL:
+            return iter_conll_column_sentences(blocks, self.language)
+        return iter_spmrl_column_sentences(blocks)
+
+
+# treebanks opened by this process (worker processes started after opening a treebank inherit it)
+_open_treebanks = dict()
+
+
+def open_treebank(treebank_dir):
+    """
+    Get the ColumnarTreebank in treebank_dir, opening it only once per process
+    """
+
+    treebank = _open_treebanks.get(treebank_dir)
+    if treebank is None:
+        treebank = _open_treebanks[treebank_dir] = ColumnarTreebank(treebank_dir)
+    return treebank
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert a treebank file to a columnar treebank, for repeated extraction without parsing text')
+    parser.add_argument('kind', choices=TREEBANK_KINDS, help='Kind of input file: WSJ .dep, conll, or SPMRL (with morphs)')
+    parser.add_argument('input_file')
+    parser.add_argument('treebank_dir', help='Output directory')
+    parser.add_argument('--language', help='Language of a conll file (e.g. spanish)')
+    parser.add_argument('--lower_case', action='store_true', help='Lower case WSJ tokens (as extraction from WSJ .dep files does)')
+    args = parser.parse_args()
+
+    meta = convert_to_treebank(args.input_file, args.treebank_dir, args.kind, args.language, args.lower_case)
+    print 'wrote', meta['num_sentences'], 'sentences,', meta['num_words'], 'words'
+
+
+if __name__=='__main__':
+    main()
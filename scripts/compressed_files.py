@@ -0,0 +1,113 @@
+# transparent reading and writing of compressed files (gzip, bzip2, xz, zstandard), chosen by file extension
+
+import bz2
+import codecs
+import gzip
+import io
+import signal
+import subprocess
+
+BUFFER_SIZE = 1024**2  # bytes buffered when reading and writing files
+COMPRESSED_EXTENSIONS = ('.gz', '.bz2', '.xz', '.zst')
+# external commands for formats without a module in the standard library; they also run alongside the reading process
+DECOMPRESS_COMMANDS = {'.xz': ['xz', '-dc'], '.zst': ['zstd', '-dcq']}
+COMPRESS_COMMANDS = {'.xz': ['xz', '-c'], '.zst': ['zstd', '-cq']}
+
+
+def get_compression(filename):
+    """
+    Get the compression extension of a file name (one of COMPRESSED_EXTENSIONS), or None if not compressed
+    """
+
+    for extension in COMPRESSED_EXTENSIONS:
+        if filename.endswith(extension):
+            return extension
+    return None
+
+
+def is_compressed(filename):
+
+    return get_compression(filename) is not None
+
+
+def open_file(filename, mode='r', encoding=None, buffer_size=BUFFER_SIZE):
+    """
+    Open a file for reading ('r') or writing ('w'), decompressing or compressing it on the fly by its extension
+
+    Compressed files are streamed, never decompressed to disk, and can only be read or written sequentially
+    If encoding is given, lines are decoded when read and encoded when written (as with codecs.open)
+    """
+
+    compression = get_compression(filename)
+    writing = 'w' in mode or 'a' in mode
+    if compression is None:
+        f = open(filename, mode, buffer_size)
+    elif 'a' in mode:
+        raise ValueError('cannot append to compressed file ' + filename)
+    elif compression == '.gz':
+        # GzipFile reads lines in python; a buffered reader over it splits lines in C
+        f = gzip.GzipFile(filename, 'wb' if writing else 'rb')
+        f = io.BufferedWriter(f, buffer_size) if writing else io.BufferedReader(f, buffer_size)
+    elif compression == '.bz2':
+        f = bz2.BZ2File(filename, 'w' if writing else 'r', buffer_size)
+    else:
+        f = PipeFile(COMPRESS_COMMANDS[compression] if writing else DECOMPRESS_COMMANDS[compression], filename, writing, buffer_size)
+    if encoding:
+        f = codecs.getwriter(encoding)(f) if writing else codecs.getreader(encoding)(f)
+    return f
+
+
+def _restore_sigpipe():
+    # python ignores SIGPIPE, and child processes inherit this; restore it so a decompressor stops quietly when
+    # the file is closed before its end
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+
+class PipeFile(object):
+    """
+    File object reading the output of a decompression command, or writing to the input of a compression command
+    """
+
+    def __init__(self, command, filename, writing, buffer_size=BUFFER_SIZE):
+        self.name = filename
+        self.command = command[0]
+        self.output = None
+        try:
+            if writing:
+                self.output = open(filename, 'wb')
+                self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=self.output, bufsize=buffer_size, \
+                                                preexec_fn=_restore_sigpipe)
+                self.f = self.process.stdin
+            else:
+                open(filename, 'rb').close()  # fail here, as open would, if the file cannot be read
+                self.process = subprocess.Popen(command + [filename], stdout=subprocess.PIPE, bufsize=buffer_size, \
+                                                preexec_fn=_restore_sigpipe)
+                self.f = self.process.stdout
+        except OSError as e:
+            if self.output:
+                self.output.close()
+            raise IOError('cannot run ' + command[0] + ' for ' + filename + ': ' + str(e))
+
+    def __getattr__(self, name):
+        # read, readline, write, etc. go to the pipe
+        return getattr(self.f, name)
+
+    def __iter__(self):
+        return iter(self.f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.f.closed:
+            return
+        self.f.close()
+        returncode = self.process.wait()
+        if self.output:
+            self.output.close()
+        # a negative code means the command was stopped by a signal, e.g. when the file was closed before its end
+        if returncode > 0:
+            raise IOError(self.command + ' failed for ' + self.name)
@@ -0,0 +1,170 @@
+# random access to the lines and sentences of conll-like files (WSJ .dep, conll), through a sidecar byte-offset index
+
+import mmap
+import os
+import numpy as np
+
+from utils import iter_wsj_dep_sentences, iter_conll_sentences, is_compressed
+
+INDEX_SUFFIX = '.idx.npz'
+INDEX_VERSION = 1  # bump when the index format changes
+READ_BLOCK_SIZE = 16 * 1024**2  # bytes scanned at a time when building an index
+WHITESPACE_BYTES = np.array([ord(c) for c in ' \t\n\r\x0b\x0c'], dtype=np.uint8)
+
+
+def build_line_index(filename, block_size=READ_BLOCK_SIZE):
+    """
+    Scan a file for line starts
+
+    Return the byte offset where each line starts, followed by the file size, and a mask of the empty
+    (whitespace only) lines
+    """
+
+    newline_offsets = []
+    nonspace_counts = []  # number of non-whitespace bytes up to and including each newline
+    num_nonspace = 0
+    offset = 0
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            data = np.frombuffer(block, dtype=np.uint8)
+            cumulative_nonspace = np.cumsum(~np.in1d(data, WHITESPACE_BYTES))
+            newlines = np.flatnonzero(data == ord('\n'))
+            newline_offsets.append(newlines + offset)
+            nonspace_counts.append(cumulative_nonspace[newlines] + num_nonspace)
+            num_nonspace += cumulative_nonspace[-1]
+            offset += len(block)
+    newline_offsets = np.concatenate(newline_offsets) if newline_offsets else np.zeros(0, dtype=np.int64)
+    nonspace_counts = np.concatenate(nonspace_counts) if nonspace_counts else np.zeros(0, dtype=np.int64)
+    if offset > 0 and (len(newline_offsets) == 0 or newline_offsets[-1] != offset - 1):
+        # last line has no newline
+        newline_offsets = np.append(newline_offsets, offset - 1)
+        nonspace_counts = np.append(nonspace_counts, num_nonspace)
+    line_offsets = np.zeros(len(newline_offsets) + 1, dtype=np.int64)
+    line_offsets[1:] = newline_offsets + 1
+    empty_lines = np.diff(np.concatenate([[0], nonspace_counts])) == 0
+    return line_offsets, empty_lines
+
+
+class ConllFileIndex(object):
+    """
+    Line and sentence lookup in a conll-like file (sentences separated by empty lines), through a memory map
+
+    Line numbers and sentence ids are 0-based, and sentences are the same as with iter_conll_blocks
+    (sentence start lines are the ones recorded in sentences and attachments)
+    The index is kept in a sidecar file (filename + INDEX_SUFFIX) and rebuilt when the file's size or modification time change
+    """
+
+    def __init__(self, filename, encoding=None, write_sidecar=True):
+        if is_compressed(filename):
+            raise ValueError('cannot index compressed file ' + filename + ' (random access needs an uncompressed file)')
+        self.filename = filename
+        self.encoding = encoding
+        self.line_offsets, self.sentence_start_lines, self.sentence_end_lines = self.load_or_build(filename, write_sidecar)
+        self.f = open(filename, 'rb')
+        file_size = self.line_offsets[-1]
+        self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ) if file_size > 0 else ''
+
+    @staticmethod
+    def get_index_filename(filename):
+        return filename + INDEX_SUFFIX
+
+    @staticmethod
+    def load_or_build(filename, write_sidecar=True):
+        """
+        Get the line offsets and sentence start and end (exclusive) lines of a file, from its sidecar index if up to date
+        """
+
+        stat = os.stat(filename)
+        file_stamp = np.array([INDEX_VERSION, stat.st_size, int(stat.st_mtime * 1e6)], dtype=np.int64)
+        index_filename = ConllFileIndex.get_index_filename(filename)
+        if os.path.isfile(index_filename):
+            try:
+                with np.load(index_filename) as index:
+                    if np.array_equal(index['file_stamp'], file_stamp):
+                        return index['line_offsets'], index['sentence_start_lines'], index['sentence_end_lines']
+            except (IOError, ValueError, KeyError):
+                pass  # unreadable index, rebuild it
+        line_offsets, empty_lines = build_line_index(filename)
+        # every empty line ends a sentence, as in iter_conll_blocks (lines after the last empty line are ignored)
+        sentence_end_lines = np.flatnonzero(empty_lines)
+        sentence_start_lines = np.concatenate([[0], sentence_end_lines[:-1] + 1]) if len(sentence_end_lines) else sentence_end_lines
+        if write_sidecar:
+            tmp_filename = index_filename + '.tmp' + str(os.getpid()) + '.npz'
+            np.savez(tmp_filename, file_stamp=file_stamp, line_offsets=line_offsets, \
+                     sentence_start_lines=sentence_start_lines, sentence_end_lines=sentence_end_lines)
+            os.rename(tmp_filename, index_filename)
+        return line_offsets, sentence_start_lines, sentence_end_lines
+
+    def close(self):
+        if self.data:
+            self.data.close()
+        self.f.close()
+
+    def get_num_lines(self):
+        return len(self.line_offsets) - 1
+
+    def get_num_sentences(self):
+        return len(self.sentence_start_lines)
+
+    def decode(self, line):
+        return line.decode(self.encoding) if self.encoding else line
+
+    def get_line(self, line_number):
+        """
+        Get a line (including its newline)
+        """
+
+        return self.decode(self.data[self.line_offsets[line_number]:self.line_offsets[line_number+1]])
+
+    def get_lines(self, start_line, end_line):
+        """
+        Get the lines from start_line up to end_line (exclusive)
+        """
+
+        offsets = self.line_offsets[start_line:end_line+1].tolist()
+        block = self.data[offsets[0]:offsets[-1]] if offsets else ''
+        base = offsets[0] if offsets else 0
+        return [self.decode(block[offsets[i]-base:offsets[i+1]-base]) for i in xrange(len(offsets) - 1)]
+
+    def get_sentence_lines(self, sentence_id):
+        """
+        Get the lines of a sentence (without the empty line ending it)
+        """
+
+        return self.get_lines(self.sentence_start_lines[sentence_id], self.sentence_end_lines[sentence_id])
+
+    def get_sentence_id(self, line_number):
+        """
+        Get the id of the sentence containing a line (e.g. a sentence start line recorded in an attachment)
+        """
+
+        return int(np.searchsorted(self.sentence_start_lines, line_number, side='right')) - 1
+
+    def get_wsj_sentence(self, sentence_id, lower_case=False):
+        """
+        Parse a sentence of a WSJ .dep file as iter_wsj_dep_sentences does
+        """
+
+        lines = self.get_sentence_lines(sentence_id) + ['\n']
+        return next(iter_wsj_dep_sentences(lines, lower_case, int(self.sentence_start_lines[sentence_id])))
+
+    def get_conll_sentence(self, sentence_id, language):
+        """
+        Parse a sentence of a conll file as iter_conll_sentences does
+        """
+
+        lines = self.get_sentence_lines(sentence_id) + ['\n']
+        return next(iter_conll_sentences(lines, language, int(self.sentence_start_lines[sentence_id])))
+
+    def get_attachment_sentence_lines(self, attachment):
+        """
+        Get the lines of the sentence an attachment (with a recorded sentence start line) was extracted from
+        """
+
+        return self.get_sentence_lines(self.get_sentence_id(attachment.sentence_start_line))
+
+    def get_attachment_prep_line(self, attachment):
+        return self.get_line(attachment.sentence_start_line + attachment.orig_prep_id)
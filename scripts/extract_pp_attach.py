@@ -2,9 +2,27 @@
 
 import argparse
 
+from sentence import TreeIndex
+
 ATB_POS_TAGS = {'verb':['VB', 'VBD', 'VBN', 'VBP'], 'noun':['NN'], 'prep':['IN']}
 SPMRL_POS_TAGS = {'verb':['V'], 'noun':['N', 'PN', 'AB'], 'prep':['P']}
 ENGLISH_POS_TAGS = {'verb':['VB', 'VBD', 'VBN', 'VBP', 'VBZ'], 'noun':['NN'], 'prep':['IN', 'TO']}
+# the tag lists above compiled to sets, per corpus type
+CORPUS_POS_TAG_SETS = dict((corpus_type, dict((pos_type, frozenset(tags)) for pos_type, tags in pos_tags.iteritems()))
+                               for corpus_type, pos_tags in (('spmrl', SPMRL_POS_TAGS), ('atb', ATB_POS_TAGS), ('english', ENGLISH_POS_TAGS)))
+_noun_tags_cache = dict()  # (corpus_type, tag) -> is_noun_tag(corpus_type, tag)
+
+
+def is_noun_tag(corpus_type, tag):
+    """
+    Check if tag is a noun tag; for atb and english, any tag containing a noun tag (e.g. NNS, NNP) is a noun tag
+    """
+
+    if corpus_type == 'spmrl':
+        return tag in CORPUS_POS_TAG_SETS['spmrl']['noun']
+    elif corpus_type == 'atb' or corpus_type == 'english':
+        return any(noun_tag in tag for noun_tag in CORPUS_POS_TAG_SETS[corpus_type]['noun'])
+    return False
 
 
 class Sentence(object):
@@ -17,6 +35,7 @@ class Sentence(object):
                  # 0 means root
     morphs = []
     lemmas = []
+    tree_index = None # TreeIndex of the parents, built on first use
 
     def __init__(self, lines, sentence_id, corpus_type):
         if len(lines) != 5:
@@ -195,46 +214,18 @@ class Sentence(object):
 
     #### methods for determining pos tags for different data sets ####
     def is_prep(self, tag):
-        if self.corpus_type == 'spmrl':
-            if tag == SPMRL_POS_TAGS['prep'][0]:
-                return True
-        elif self.corpus_type == 'atb':
-            if tag == ATB_POS_TAGS['prep'][0]:
-                return True
-        elif self.corpus_type == 'english':
-            for prep_tag in ENGLISH_POS_TAGS['prep']:
-                if tag == prep_tag:
-                    return True
-        return False
+        pos_tag_sets = CORPUS_POS_TAG_SETS.get(self.corpus_type)
+        return pos_tag_sets is not None and tag in pos_tag_sets['prep']
 
     def is_verb(self, tag):
-        if self.corpus_type == 'spmrl':
-            if tag == SPMRL_POS_TAGS['verb'][0]:
-                return True
-        elif self.corpus_type == 'atb':
-            for verb_tag in ATB_POS_TAGS['verb']:
-                if tag == verb_tag:
-                    return True
-        elif self.corpus_type == 'english':
-            for verb_tag in ENGLISH_POS_TAGS['verb']:
-                if tag == verb_tag:
-                    return True
-        return False
+        pos_tag_sets = CORPUS_POS_TAG_SETS.get(self.corpus_type)
+        return pos_tag_sets is not None and tag in pos_tag_sets['verb']
 
     def is_noun(self, tag):
-        if self.corpus_type == 'spmrl':
-            for noun_tag in SPMRL_POS_TAGS['noun']:
-                if tag == noun_tag:
-                    return True
-        elif self.corpus_type == 'atb':
-            for noun_tag in ATB_POS_TAGS['noun']:
-                if noun_tag in tag:
-                    return True
-        elif self.corpus_type == 'english':
-            for noun_tag in ENGLISH_POS_TAGS['noun']:
-                if noun_tag in tag:
-                    return True
-        return False
+        key = (self.corpus_type, tag)
+        if key not in _noun_tags_cache:
+            _noun_tags_cache[key] = is_noun_tag(self.corpus_type, tag)
+        return _noun_tags_cache[key]
 
     def is_pos(self, candidate_tag, pos_tag):
         if pos_tag == 'prep':
@@ -288,9 +279,17 @@ class Sentence(object):
         out_file.write('\t'.join(self.morphs) + '\n')
         out_file.write('\n')
 
+    def get_tree_index(self):
+        """ Get the tree index of this sentence, building it on first use """
+
+        if self.tree_index is None:
+            self.tree_index = TreeIndex(self.parents)
+        return self.tree_index
+
     def is_projective(self):
         """ Check if the dependency tree is projective """
 
+        tree_index = self.get_tree_index()
         for i in xrange(len(self.tokens)):
             child = i+1
             parent = self.parents[i]
@@ -300,12 +299,12 @@ class Sentence(object):
             if parent < child:
                 # right arc
                 for j in xrange(parent+1, child):
-                    if not self.is_reachable(parent, j):
+                    if not tree_index.is_ancestor(parent, j):
                         return False
             elif parent > child:
                 # left arc
                 for j in xrange(child+1, parent):
-                    if not self.is_reachable(parent, j):
+                    if not tree_index.is_ancestor(parent, j):
                         return False
             else:  # parent = child
                 print 'Error: parent = child'
@@ -318,11 +317,7 @@ class Sentence(object):
         ancestor and node are 1-indexed
         """
 
-        if ancestor == node:
-            return True
-        if node == 0:
-            return False
-        return self.is_reachable(ancestor, self.parents[node-1])
+        return self.get_tree_index().is_ancestor(ancestor, node)
 
 #### end Sentence class ####
 
@@ -1,5 +1,6 @@
 # This version extracts a more elaborate context for each PP attachment
 import sys
+from itertools import izip, izip_longest, chain, repeat
 
 from sentence import *
 from utils import *
@@ -92,9 +93,8 @@ def extract_pp_attachments_from_file(spmrl_filename, max_distance, ext=False, to
     Return a list of lists of attachments
     """
 
-    sentences = read_spmrl_file(spmrl_filename, True)
     attachments = []
-    for sentence in sentences:
+    for sentence in iter_spmrl_file(spmrl_filename, True):
         cur_attachments = get_pp_attachments_from_sentence(sentence, max_distance, ext, tokens)
         attachments.append(cur_attachments)
     return attachments
@@ -105,14 +105,14 @@ def extract_pred_pp_attachments_from_file(gold_spmrl_filename, pred_spmrl_filena
     Get all valid PP attachments with predicted decisions
     """
 
-    gold_sentences = read_spmrl_file(gold_spmrl_filename, True)
-    pred_sentences = read_spmrl_file(pred_spmrl_filename, False)
-    if len(gold_sentences) != len(pred_sentences):
-        sys.stderr.write('Error: incompatible gold and pred files')
-        return
+    gold_sentences = iter_spmrl_file(gold_spmrl_filename, True)
+    pred_sentences = iter_spmrl_file(pred_spmrl_filename, False)
     attachments = []
-    for i in xrange(len(gold_sentences)):
-        cur_attachments = get_pred_pp_attachments_from_sentence(gold_sentences[i], pred_sentences[i], max_distance)
+    for gold_sentence, pred_sentence in izip_longest(gold_sentences, pred_sentences):
+        if gold_sentence is None or pred_sentence is None:
+            sys.stderr.write('Error: incompatible gold and pred files')
+            return
+        cur_attachments = get_pred_pp_attachments_from_sentence(gold_sentence, pred_sentence, max_distance)
         attachments.append(cur_attachments)
     return attachments
 
@@ -122,7 +122,7 @@ def write_attachments(attachments, output_filename):
     Write attachments to file
     """
 
-    g = open(output_filename, 'w')
+    g = open_file(output_filename, 'w')
     for i in xrange(len(attachments)):
         g.write('# sentence ' + str(i) + '\n')
         for a in attachments[i]:
@@ -130,6 +130,29 @@ def write_attachments(attachments, output_filename):
     g.close()
 
 
+def iter_sentence_predictions(pred_lines):
+    """
+    Group the lines of a matlab predictions file by sentence, in the same order as attachments are extracted
+
+    Sentences are separated by '# sentence' lines (the first line is skipped); a final sentence without
+    predictions is not yielded
+    """
+
+    cur_preds = []
+    start = True
+    for line in pred_lines:
+        if start:
+            start = False
+            continue
+        if line.startswith('# sentence'):
+            yield cur_preds
+            cur_preds = []
+        else:
+            cur_preds.append(line.strip())
+    if cur_preds:
+        yield cur_preds
+
+
 def write_matlab_predictions(spmrl_filename, spmrl_pp_pred_filename):
     """
     Write matlab predictions to new spmrl-conll-like file
@@ -148,53 +171,33 @@ def write_matlab_predictions(spmrl_filename, spmrl_pp_pred_filename):
     #         cur_prep_ids.append(prep_id)
     #     attachment_prep_ids.append(cur_prep_ids)
 
-    # collect predictions in the same order as attachments are extracted
-    pred_lines = open(spmrl_pp_pred_filename).readlines()
-    preds = []
-    cur_preds = []
-    start = True
-    for line in pred_lines:
-        if start:
-            start = False
-            continue
-        if line.startswith('# sentence'):
-            preds.append(cur_preds)
-            cur_preds = []
-        else:
-            cur_preds.append(line.strip())
-    if cur_preds:
-        preds.append(cur_preds)
-        cur_preds = []
-
-
-    # now extract attachments and write with predictions
+    # now extract attachments and write with predictions, reading the predictions of one sentence at a time
     print 'writing matlab predicted attachments to conll-like file:', spmrl_filename + '.pred.conll'
+    sentence_preds = chain(iter_sentence_predictions(open_file(spmrl_pp_pred_filename)), repeat([]))
     g = open(spmrl_filename + '.pred.conll', 'w')
-    sentences = read_spmrl_file(spmrl_filename, True)
-    for s in xrange(len(sentences)):
-        sentence = sentences[s]
+    for sentence, cur_preds in izip(iter_spmrl_file(spmrl_filename, True), sentence_preds):
         attachments = get_pp_attachments_from_sentence(sentence, 10, False, False)
-        cur_prep_ids = []
-        for a in attachments:
+        prep_id_locs = dict()  # prep id -> index of its first attachment
+        for loc, a in enumerate(attachments):
             prep_id = int(a[-2].split('-')[0]) + 1  # correct index (was probably decreased during extraction)
-            cur_prep_ids.append(prep_id)
+            prep_id_locs.setdefault(prep_id, loc)
+        lines = []
         for i in xrange(len(sentence.tokens)):
             pred = '_'
-            if i+1 in cur_prep_ids:
-                loc = cur_prep_ids.index(i+1)
-                predicted = preds[s][loc]
+            if i+1 in prep_id_locs:
+                predicted = cur_preds[prep_id_locs[i+1]]
                 if predicted != "#":
                     pred = str(int(predicted) + 1)  # again need to correct index
             # for now use pos for both cpos and pos
-            g.write(str(i+1) + '\t' + sentence.tokens[i] + '\t' + sentence.lemmas[i] + '\t' + \
-                    sentence.poses[i] + '\t' + sentence.poses[i] + '\t' + '_' + '\t' + str(sentence.parents[i]) + \
-                    '\t' + sentence.labels[i] + '\t' + '_' + '\t' + '_' + '\t' + pred + '\n')
-        g.write('\n')
+            lines.append(str(i+1) + '\t' + sentence.tokens[i] + '\t' + sentence.lemmas[i] + '\t' + \
+                         sentence.poses[i] + '\t' + sentence.poses[i] + '\t' + '_' + '\t' + str(sentence.parents[i]) + \
+                         '\t' + sentence.labels[i] + '\t' + '_' + '\t' + '_' + '\t' + pred + '\n')
+        lines.append('\n')
+        g.writelines(lines)
 
     g.close()
 
 
-
 GOLD_FILENAME = '/home/belinkov/Dropbox/school/arabic-parsing/data/spmrl/spmrl.train.lab.all'
 OUTPUT_FILENAME = '/home/belinkov/Dropbox/school/pp/data/spmrl.train.lab.all.pp'
 # attachments = extract_pp_attachments_from_file(GOLD_FILENAME, 10, False, False)
@@ -1,7 +1,21 @@
 # extract pp attachments from original files directly into files loaded by matlab
 
+import multiprocessing
+from itertools import izip_longest
+
 from sentence import *
 from utils import *
+from word_vectors import VocabularyCollector
+from vocabulary import Vocabulary
+from extraction_cache import ExtractionCache, hash_file_range, get_vocab_fingerprint
+from attachment_table import AttachmentTable, write_attachment_table, write_conll_attachment_table, write_attachment_bundle
+from attachment_stats import STATS_SUFFIX, get_attachment_stats, write_attachment_stats
+from candidate_heads import get_sentence_candidate_heads, iter_sentence_candidate_heads
+from profiling import Profiler, get_profiler, set_profiler, start_profiling, stop_profiling
+from columnar_treebank import TREEBANK_WSJ, TREEBANK_CONLL, TREEBANK_SPMRL, open_treebank, load_or_convert_treebank
+
+SHARDS_PER_PROCESS = 4  # more shards than processes to balance the load
+CACHE_SHARD_SIZE = 4 * 1024**2  # average size (bytes) of the input shards cached by ExtractionCache
 
 
 class Attachment(object):
@@ -88,6 +102,17 @@ class ConllAttachment(object):
     def set_sentence_start_line(self, sentence_start_line):
         self.sentence_start_line = sentence_start_line
 
+    def map_words(self, word_map):
+        """
+        Replace each word w of the attachment by word_map[w] (e.g. word ids of one Vocabulary by those of another)
+        """
+
+        self.heads = [word_map[h] for h in self.heads]
+        self.prep = word_map[self.prep]
+        self.child = word_map[self.child]
+        if hasattr(self, 'heads_next'):
+            self.heads_next = [word_map[w] for w in self.heads_next]
+
 
 class EnglishAttachment(ConllAttachment):
     """
@@ -96,108 +121,147 @@ class EnglishAttachment(ConllAttachment):
     pass
 
 
+class PPEvaluation(object):
+    """
+    Accumulate PP attachment accuracy, overall and broken down by preposition and by distance to the gold head
+    """
+
+    def __init__(self):
+        self.num_total = 0
+        self.num_correct = 0
+        self.prep_counts = dict()  # preposition -> [total, correct]
+        self.distance_counts = dict()  # distance (in words) from the preposition back to its gold head -> [total, correct]
+
+    def add(self, prep, distance, correct):
+        self.num_total += 1
+        self.num_correct += correct
+        for counts, key in [(self.prep_counts, prep), (self.distance_counts, distance)]:
+            if key not in counts:
+                counts[key] = [0, 0]
+            counts[key][0] += 1
+            counts[key][1] += correct
+
+    @staticmethod
+    def format_accuracy(total, correct):
+        return 'total: ' + str(total) + ' correct: ' + str(correct) + ' (' + ("%.2f" % (100.0*correct/total) if total else '-') + ' %)'
+
+    def print_report(self, max_preps=20):
+        print 'total valid attachments:', self.num_total, 'correct:', self.num_correct, \
+            '(', ("%.2f" % (100.0*self.num_correct/self.num_total) if self.num_total else '-'), '%)'
+        print 'accuracy by preposition (' + str(min(max_preps, len(self.prep_counts))), 'most frequent):'
+        for prep, (total, correct) in sorted(self.prep_counts.iteritems(), key=lambda item: -item[1][0])[:max_preps]:
+            print ' ', prep, self.format_accuracy(total, correct)
+        print 'accuracy by distance to gold head:'
+        for distance, (total, correct) in sorted(self.distance_counts.iteritems()):
+            print ' ', distance, self.format_accuracy(total, correct)
+
+
+def eval_attachments_against_pred_sentence(attachments, gold_sentence, pred_sentence, evaluation=None):
+    """
+    Count the attachments (extracted from gold_sentence) whose preposition has the gold head in pred_sentence
+    """
+
+    num_correct = 0
+    for a in attachments:
+        gold_prep_parent = gold_sentence.parents[a.orig_prep_id]
+        correct = gold_prep_parent == pred_sentence.parents[a.orig_prep_id]
+        num_correct += correct
+        if evaluation is not None:
+            evaluation.add(a.prep, a.orig_prep_id+1 - gold_prep_parent, correct)
+    return len(attachments), num_correct
+
+
+def eval_pred_sentences(gold_sentences, pred_sentences, eval_sentence, max_head_distance, ambiguous_only=False):
+    """
+    Evaluate predicted sentences against gold sentences in one pass over both streams
+
+    eval_sentence(gold_sentence, pred_sentence, evaluation, candidates) adds the attachments of one sentence to evaluation,
+    where candidates are the gold sentence's candidate heads, found in batches (see iter_sentence_candidate_heads)
+    Print and return the PPEvaluation, or None if the streams have different lengths
+    """
+
+    evaluation = PPEvaluation()
+    gold_candidates = iter_sentence_candidate_heads(gold_sentences, max_head_distance, ambiguous_only)
+    for gold, pred_sentence in izip_longest(gold_candidates, pred_sentences):
+        if gold is None or pred_sentence is None:
+            print 'Error: len of gold and pred sentences not equal'
+            return None
+        gold_sentence, candidates = gold
+        eval_sentence(gold_sentence, pred_sentence, evaluation, candidates)
+    evaluation.print_report()
+    return evaluation
+
+
 def get_pp_attachments_from_wsj_sentence(sentence, max_head_distance, max_child_distance, word_vectors=None, get_heads_next=False, \
-                                         use_heads_pos=False, use_heads_next_pos=False):
+                                         use_heads_pos=False, use_heads_next_pos=False, candidates=None):
     """
     Get all valid PP attachments from one (English) sentence
 
     max_distance is the maximum allowed distance of the candidate heads
     Current version only extracts candidate heads, prepositions, and first child of preposition
+    candidates - the sentence's candidate heads, if already found in a batch (see get_batch_candidate_heads, with ambiguous_only=True)
     """
 
     attachments = []
-    for i in xrange(len(sentence.poses)-1):
-        if EnglishSentence.is_prep(sentence.poses[i]):
-            children_indices = sentence.get_children(i+1)
-            for child_idx in children_indices:
-                if sentence.is_valid_attachment(i, child_idx-1, max_head_distance, max_child_distance):
-                    gold_prep_parent = sentence.parents[i]
-                    heads = []
-                    heads_next = []
-                    heads_pos = []
-                    heads_next_pos = []
-                    heads_ids = []
-                    prep = sentence.tokens[i]
-                    child = sentence.tokens[child_idx-1]
-                    gold_head_label = -1
-                    start = max(0, i - max_head_distance)
-                    for j in xrange(start, i):  # find candidate heads
-                        if EnglishSentence.is_noun(sentence.poses[j]) or EnglishSentence.is_verb(sentence.poses[j]):
-                            heads.append(sentence.tokens[j])
-                            heads_ids.append(j)
-                            if use_heads_pos:
-                                pos = sentence.poses[j]
-                                pos_num = 1 if pos in ENGLISH_POS_TAGS['verb'] else -1  # verb=1, noun=-1
-                                heads_pos.append(str(pos_num))
-                            if get_heads_next and j < i-1:
-                                heads_next.append(sentence.tokens[j+1])
-                            if use_heads_next_pos and j < i-1:
-                                heads_next_pos.append(sentence.poses[j+1])
-                        if gold_prep_parent == j+1:  # if current candidate is the gold head
-                            gold_head_label = len(heads)
-                    if gold_head_label == -1:
-                        sys.stderr.write('Error: could not find the gold head in sentence:\n' + str(sentence))
-
-                    if len(heads) > 1:  # don't take unambiguous cases
-                        if get_heads_next:
-                            attachment = EnglishAttachment(heads, gold_head_label, prep, child, heads_next=heads_next, heads_pos=heads_pos, heads_next_pos=heads_next_pos)
-                        else:
-                            attachment = EnglishAttachment(heads, gold_head_label, prep, child, heads_pos=heads_pos, heads_next_pos=heads_next_pos)
-                        attachment.set_prep_id(i)
-                        attachment.set_heads_ids(heads_ids)
-                        attachment.set_sentence_start_line(sentence.start_line)
-                        if word_vectors and attachment.has_word_vectors(word_vectors):
-                            attachments.append(attachment)
-                        # attachments.append(attachment)
+    if candidates is None:
+        candidates = get_sentence_candidate_heads(sentence, max_head_distance, ambiguous_only=True)
+    pos_classes = sentence.get_pos_classes()
+    profiler = get_profiler()
+    for i in sorted(candidates):
+        heads_ids, gold_head_label = candidates[i]
+        children_indices = sentence.get_children(i+1)
+        for child_idx in children_indices:
+            if sentence.is_valid_attachment(i, child_idx-1, max_head_distance, max_child_distance):
+                heads = [sentence.tokens[j] for j in heads_ids]
+                heads_next = []
+                heads_pos = []
+                heads_next_pos = []
+                prep = sentence.tokens[i]
+                child = sentence.tokens[child_idx-1]
+                for j in heads_ids:
+                    if use_heads_pos:
+                        pos_num = 1 if pos_classes[j] == POS_CLASS_VERB else -1  # verb=1, noun=-1
+                        heads_pos.append(str(pos_num))
+                    if get_heads_next and j < i-1:
+                        heads_next.append(sentence.tokens[j+1])
+                    if use_heads_next_pos and j < i-1:
+                        heads_next_pos.append(sentence.poses[j+1])
+
+                if len(heads) > 1:  # don't take unambiguous cases
+                    if get_heads_next:
+                        attachment = EnglishAttachment(heads, gold_head_label, prep, child, heads_next=heads_next, heads_pos=heads_pos, heads_next_pos=heads_next_pos)
+                    else:
+                        attachment = EnglishAttachment(heads, gold_head_label, prep, child, heads_pos=heads_pos, heads_next_pos=heads_next_pos)
+                    attachment.set_prep_id(i)
+                    attachment.set_heads_ids(list(heads_ids))
+                    attachment.set_sentence_start_line(sentence.start_line)
+                    if word_vectors and attachment.has_word_vectors(word_vectors):
+                        attachments.append(attachment)
+                    elif word_vectors:
+                        profiler.reject('no_word_vectors')
+                    # attachments.append(attachment)
+            elif profiler.enabled:
+                profiler.reject(sentence.get_invalid_attachment_reason(i, child_idx-1, max_head_distance, max_child_distance))
     return attachments
 
 
-def eval_pred_pp_attachments_from_wsj_sentence(gold_sentence, pred_sentence, max_head_distance, max_child_distance, word_vectors=None, get_heads_next=False):
+def eval_pred_pp_attachments_from_wsj_sentence(gold_sentence, pred_sentence, max_head_distance, max_child_distance, word_vectors=None, get_heads_next=False, \
+                                               evaluation=None, candidates=None):
     """
-    Get all valid PP attachments from one (English) sentence
+    Evaluate the predicted heads of all valid PP attachments in one (English) sentence
 
-    max_distance is the maximum allowed distance of the candidate heads
-    Current version only extracts candidate heads, prepositions, and first child of preposition
+    Attachments are extracted from the gold sentence as in get_pp_attachments_from_wsj_sentence
+    Return the number of attachments and the number correctly attached in pred_sentence
+    If evaluation (a PPEvaluation) is given, each attachment is also added to it
     """
 
-    num_total = 0
-    num_correct = 0
-    for i in xrange(len(gold_sentence.poses)-1):
-        if EnglishSentence.is_prep(gold_sentence.poses[i]):
-            children_indices = gold_sentence.get_children(i+1)
-            for child_idx in children_indices:
-                if gold_sentence.is_valid_attachment(i, child_idx-1, max_head_distance, max_child_distance):
-                    gold_prep_parent = gold_sentence.parents[i]
-                    pred_prep_parent = pred_sentence.parents[i]
-                    heads = []
-                    heads_next = []
-                    prep = gold_sentence.tokens[i]
-                    child = gold_sentence.tokens[child_idx-1]
-                    gold_head_label = -1
-                    start = max(0, i - max_head_distance)
-                    for j in xrange(start, i):  # find candidate heads
-                        if EnglishSentence.is_noun(gold_sentence.poses[j]) or EnglishSentence.is_verb(gold_sentence.poses[j]):
-                            heads.append(gold_sentence.tokens[j])
-                            if get_heads_next and j < i-1:
-                                heads_next.append(gold_sentence.tokens[j+1])
-                        if gold_prep_parent == j+1:  # if current candidate is the gold head
-                            gold_head_label = len(heads)
-                    if gold_head_label == -1:
-                        sys.stderr.write('Error: could not find the gold head in sentence:\n' + str(gold_sentence))
-
-                    if len(heads) > 1:  # don't take unambiguous cases
-                        if get_heads_next:
-                            attachment = EnglishAttachment(heads, gold_head_label, prep, child, heads_next)
-                        else:
-                            attachment = EnglishAttachment(heads, gold_head_label, prep, child)
-                        if word_vectors and attachment.has_word_vectors(word_vectors):
-                            num_total += 1
-                            if gold_prep_parent == pred_prep_parent:
-                                num_correct += 1
-    return num_total, num_correct
+    attachments = get_pp_attachments_from_wsj_sentence(gold_sentence, max_head_distance, max_child_distance, word_vectors, get_heads_next, \
+                                                       candidates=candidates)
+    return eval_attachments_against_pred_sentence(attachments, gold_sentence, pred_sentence, evaluation)
 
 
-def get_pp_attachments_from_sentence(sentence, max_distance, max_span, tokens=False, word_vectors=None, get_heads_next=False, get_heads_pos=False):
+def get_pp_attachments_from_sentence(sentence, max_distance, max_span, tokens=False, word_vectors=None, get_heads_next=False, get_heads_pos=False, \
+                                     candidates=None):
     """
     Get all valid PP attachments from one sentence, including full PP phrase
 
@@ -205,11 +269,15 @@ def get_pp_attachments_from_sentence(sentence, max_distance, max_span, tokens=Fa
     max_distance is the maximum allowed distance of the candidate heads
     max_span is the maximum allowed span of the PP
     if get_heads_next=True, will also extract words following the heads
+    candidates - the sentence's candidate heads, if already found in a batch (see get_batch_candidate_heads)
     """
 
     attachments = []
+    if candidates is None:
+        candidates = get_sentence_candidate_heads(sentence, max_distance)
+    tree_index = None  # built for the first PP, and shared by the others
     for i in xrange(len(sentence.poses) - 1):
-        if sentence.poses[i] == POS_PREP:
+        if i in candidates:
             # if abs(sentence.parents[i] - i) > max_distance:
             #     continue
             # if sentence.parents[i] - 1 > i:  # skip left arcs
@@ -220,40 +288,32 @@ def get_pp_attachments_from_sentence(sentence, max_distance, max_span, tokens=Fa
             # if sentence.poses[i+1] != POS_NOUN:  # only consider prep-noun phrases (ignore e.g. prep-pronoun)
             #     continue
             if sentence.is_valid_attachment(i, max_distance):
-                gold_prep_parent = sentence.parents[i]
                 pp_words = []
                 pp_parents = []
                 heads = []
                 heads_next = []
                 heads_pos = []
-                gold_head_label = -1
-                start = max(0, i - max_distance)
-                for j in xrange(start, i):  # find candidate heads
-                    if sentence.poses[j] == POS_NOUN or sentence.poses[j] == POS_VERB:
-                        if tokens:
-                            heads.append(sentence.tokens[j])
-                            if get_heads_next and j < i-1:
-                                heads_next.append(sentence.tokens[j+1])
-                            if get_heads_pos:
-                                heads_pos.append(sentence.poses[j])
-                        else:
-                            lemma = get_lemma_from_morph(sentence.morphs[j])
-                            if lemma[-1] == 'Y':
-                                lemma = lemma[:-1] + 'y'
-                            heads.append(lemma)
-                            if get_heads_next and j <i-1:
-                                next_lemma = get_lemma_from_morph(sentence.morphs[j+1])
-                                next_lemma = next_lemma.rstrip('+')
-                                if next_lemma[-1] == 'Y':
-                                    next_lemma = next_lemma[:-1] + 'y'
-                                heads_next.append(next_lemma)
-                            if get_heads_pos:
-                                heads_pos.append(sentence.poses[j])
-
-                        if gold_prep_parent == j+1:  # if current candidate is the gold head
-                            gold_head_label = len(heads)
-                if gold_head_label == -1:
-                    sys.stderr.write('Error: could not find the gold head in sentence:\n' + str(sentence))
+                heads_ids, gold_head_label = candidates[i]
+                for j in heads_ids:  # candidate heads
+                    if tokens:
+                        heads.append(sentence.tokens[j])
+                        if get_heads_next and j < i-1:
+                            heads_next.append(sentence.tokens[j+1])
+                        if get_heads_pos:
+                            heads_pos.append(sentence.poses[j])
+                    else:
+                        lemma = get_lemma_from_morph(sentence.morphs[j])
+                        if lemma[-1] == 'Y':
+                            lemma = lemma[:-1] + 'y'
+                        heads.append(lemma)
+                        if get_heads_next and j <i-1:
+                            next_lemma = get_lemma_from_morph(sentence.morphs[j+1])
+                            next_lemma = next_lemma.rstrip('+')
+                            if next_lemma[-1] == 'Y':
+                                next_lemma = next_lemma[:-1] + 'y'
+                            heads_next.append(next_lemma)
+                        if get_heads_pos:
+                            heads_pos.append(sentence.poses[j])
 
                 # first word in the PP is the preposition
                 if tokens:
@@ -265,9 +325,12 @@ def get_pp_attachments_from_sentence(sentence, max_distance, max_span, tokens=Fa
                         prep_lemma = prep_lemma[:-1] + 'y'
                     pp_words.append(prep_lemma)
                 pp_parents.append(0)  # and prep's parent is set to 0 (it's the root of the PP tree)
-                # now find pp subtree
-                for j in xrange(i+1, len(sentence.poses)):
-                    if sentence.is_reachable(i+1, j+1):
+                # now find pp subtree (no word after the subtree's span can be in it)
+                if tree_index is None:
+                    tree_index = sentence.get_tree_index()
+                subtree_end = tree_index.get_span(i+1)[1]
+                for j in xrange(i+1, subtree_end):
+                    if tree_index.is_ancestor(i+1, j+1):
                         if tokens:
                             pp_words.append(sentence.tokens[j])
                         else:
@@ -304,7 +367,8 @@ def get_pp_attachments_from_sentence(sentence, max_distance, max_span, tokens=Fa
     return attachments
 
 
-def eval_pred_pp_attachments_from_sentence(gold_sentence, pred_sentence, max_distance, tokens=False, word_vectors=None, get_heads_next=False, get_heads_pos=False):
+def eval_pred_pp_attachments_from_sentence(gold_sentence, pred_sentence, max_distance, tokens=False, word_vectors=None, get_heads_next=False, get_heads_pos=False, \
+                                           evaluation=None, candidates=None):
     """
     Get all valid PP attachments from one sentence, considering only prep child! (contrary to get_pp_attachments_from_sentence())
 
@@ -312,12 +376,15 @@ def eval_pred_pp_attachments_from_sentence(gold_sentence, pred_sentence, max_dis
     max_distance is the maximum allowed distance of the candidate heads
     max_span is the maximum allowed span of the PP
     if get_heads_next=True, will also extract words following the heads
+    If evaluation (a PPEvaluation) is given, each attachment is also added to it
     """
 
     num_total = 0
     num_correct = 0
+    if candidates is None:
+        candidates = get_sentence_candidate_heads(gold_sentence, max_distance)
     for i in xrange(len(gold_sentence.poses) - 1):
-        if gold_sentence.poses[i] == POS_PREP:
+        if i in candidates:
             # if abs(sentence.parents[i] - i) > max_distance:
             #     continue
             # if sentence.parents[i] - 1 > i:  # skip left arcs
@@ -335,34 +402,27 @@ def eval_pred_pp_attachments_from_sentence(gold_sentence, pred_sentence, max_dis
                 heads = []
                 heads_next = []
                 heads_pos = []
-                gold_head_label = -1
-                start = max(0, i - max_distance)
-                for j in xrange(start, i):  # find candidate heads
-                    if gold_sentence.poses[j] == POS_NOUN or gold_sentence.poses[j] == POS_VERB:
-                        if tokens:
-                            heads.append(gold_sentence.tokens[j])
-                            if get_heads_next and j < i-1:
-                                heads_next.append(gold_sentence.tokens[j+1])
-                            if get_heads_pos:
-                                heads_pos.append(gold_sentence.poses[j])
-                        else:
-                            lemma = gold_sentence.lemmas[j]
-                            if lemma[-1] == 'Y':
-                                lemma = lemma[:-1] + 'y'
-                            heads.append(lemma)
-                            if get_heads_next and j <i-1:
-                                next_lemma = gold_sentence.lemmas[j+1]
-                                next_lemma = next_lemma.rstrip('+')
-                                if next_lemma[-1] == 'Y':
-                                    next_lemma = next_lemma[:-1] + 'y'
-                                heads_next.append(next_lemma)
-                            if get_heads_pos:
-                                heads_pos.append(gold_sentence.poses[j])
-
-                        if gold_prep_parent == j+1:  # if current candidate is the gold head
-                            gold_head_label = len(heads)
-                if gold_head_label == -1:
-                    sys.stderr.write('Error: could not find the gold head in sentence:\n' + str(gold_sentence))
+                heads_ids, gold_head_label = candidates[i]
+                for j in heads_ids:  # candidate heads
+                    if tokens:
+                        heads.append(gold_sentence.tokens[j])
+                        if get_heads_next and j < i-1:
+                            heads_next.append(gold_sentence.tokens[j+1])
+                        if get_heads_pos:
+                            heads_pos.append(gold_sentence.poses[j])
+                    else:
+                        lemma = gold_sentence.lemmas[j]
+                        if lemma[-1] == 'Y':
+                            lemma = lemma[:-1] + 'y'
+                        heads.append(lemma)
+                        if get_heads_next and j <i-1:
+                            next_lemma = gold_sentence.lemmas[j+1]
+                            next_lemma = next_lemma.rstrip('+')
+                            if next_lemma[-1] == 'Y':
+                                next_lemma = next_lemma[:-1] + 'y'
+                            heads_next.append(next_lemma)
+                        if get_heads_pos:
+                            heads_pos.append(gold_sentence.poses[j])
 
                 # first word in the PP is the preposition
                 if tokens:
@@ -399,10 +459,13 @@ def eval_pred_pp_attachments_from_sentence(gold_sentence, pred_sentence, max_dis
                         num_total += 1
                         if gold_prep_parent == pred_prep_parent:
                             num_correct += 1
+                        if evaluation is not None:
+                            evaluation.add(pp_words[0], i+1 - gold_prep_parent, gold_prep_parent == pred_prep_parent)
     return num_total, num_correct
 
 
-def eval_pred_pp_attachments_from_stanford_atb_sentence(gold_sentence, pred_sentence, max_distance, word_vectors=None, get_heads_next=False, get_heads_pos=False):
+def eval_pred_pp_attachments_from_stanford_atb_sentence(gold_sentence, pred_sentence, max_distance, word_vectors=None, get_heads_next=False, get_heads_pos=False, \
+                                                        evaluation=None, candidates=None):
     """
     Get all valid PP attachments from one sentence, considering only prep child! (contrary to get_pp_attachments_from_sentence())
 
@@ -410,6 +473,7 @@ def eval_pred_pp_attachments_from_stanford_atb_sentence(gold_sentence, pred_sent
     This version uses only tokens (no lemma option)
     max_distance is the maximum allowed distance of the candidate heads
     if get_heads_next=True, will also extract words following the heads
+    If evaluation (a PPEvaluation) is given, each attachment is also added to it
     """
 
     if not type(gold_sentence) == ATBSentence:
@@ -417,8 +481,10 @@ def eval_pred_pp_attachments_from_stanford_atb_sentence(gold_sentence, pred_sent
 
     num_total = 0
     num_correct = 0
+    if candidates is None:
+        candidates = get_sentence_candidate_heads(gold_sentence, max_distance)
     for i in xrange(len(gold_sentence.poses) - 1):
-        if ATBSentence.is_prep(gold_sentence.poses[i]):
+        if i in candidates:
             if gold_sentence.is_valid_attachment(i, max_distance):
                 gold_prep_parent = gold_sentence.parents[i]
                 pred_prep_parent = pred_sentence.parents[i]
@@ -427,20 +493,13 @@ def eval_pred_pp_attachments_from_stanford_atb_sentence(gold_sentence, pred_sent
                 heads = []
                 heads_next = []
                 heads_pos = []
-                gold_head_label = -1
-                start = max(0, i - max_distance)
-                for j in xrange(start, i):  # find candidate heads
-                    if ATBSentence.is_noun(gold_sentence.poses[j]) or ATBSentence.is_verb(gold_sentence.poses[j]):
-                        heads.append(gold_sentence.tokens[j])
-                        if get_heads_next and j < i-1:
-                            heads_next.append(gold_sentence.tokens[j+1])
-                        if get_heads_pos:
-                            heads_pos.append(gold_sentence.poses[j])
-
-                        if gold_prep_parent == j+1:  # if current candidate is the gold head
-                            gold_head_label = len(heads)
-                if gold_head_label == -1:
-                    sys.stderr.write('Error: could not find the gold head in sentence:\n' + str(gold_sentence))
+                heads_ids, gold_head_label = candidates[i]
+                for j in heads_ids:  # candidate heads
+                    heads.append(gold_sentence.tokens[j])
+                    if get_heads_next and j < i-1:
+                        heads_next.append(gold_sentence.tokens[j+1])
+                    if get_heads_pos:
+                        heads_pos.append(gold_sentence.poses[j])
 
                 # first word in the PP is the preposition
                 pp_words.append(gold_sentence.tokens[i])
@@ -464,21 +523,26 @@ def eval_pred_pp_attachments_from_stanford_atb_sentence(gold_sentence, pred_sent
                         num_total += 1
                         if gold_prep_parent == pred_prep_parent:
                             num_correct += 1
+                        if evaluation is not None:
+                            evaluation.add(pp_words[0], i+1 - gold_prep_parent, gold_prep_parent == pred_prep_parent)
     return num_total, num_correct
 
 
-def get_pp_attachments_from_sentence_child_grandchild(sentence, max_distance, tokens=False, word_vectors=None, get_heads_next=False):
+def get_pp_attachments_from_sentence_child_grandchild(sentence, max_distance, tokens=False, word_vectors=None, get_heads_next=False, candidates=None):
     """
     Get all valid PP attachments from one sentence, including preposition's child and grandchild
 
     If tokens=True, word forms will be extracted, otherwise lemmas
     max_distance is the maximum allowed distance of the candidate heads
     if get_heads_next=True, will also extract words following the heads
+    candidates - the sentence's candidate heads, if already found in a batch (see get_batch_candidate_heads)
     """
 
     attachments = []
+    if candidates is None:
+        candidates = get_sentence_candidate_heads(sentence, max_distance)
     for i in xrange(len(sentence.poses) - 1):
-        if sentence.poses[i] == POS_PREP:
+        if i in candidates:
             # if abs(sentence.parents[i] - i) > max_distance:
             #     continue
             # if sentence.parents[i] - 1 > i:  # skip left arcs
@@ -489,7 +553,6 @@ def get_pp_attachments_from_sentence_child_grandchild(sentence, max_distance, to
             # if sentence.poses[i+1] != POS_NOUN:  # only consider prep-noun phrases (ignore e.g. prep-pronoun)
             #     continue
             if sentence.is_valid_attachment(i, max_distance):
-                gold_prep_parent = sentence.parents[i]
                 pp_words = []
                 pp_parents = []
                 prep = ''
@@ -497,30 +560,23 @@ def get_pp_attachments_from_sentence_child_grandchild(sentence, max_distance, to
                 prep_grandchild = ''
                 heads = []
                 heads_next = []
-                gold_head_label = -1
-                start = max(0, i - max_distance)
-                for j in xrange(start, i):  # find candidate heads
-                    if sentence.poses[j] == POS_NOUN or sentence.poses[j] == POS_VERB:
-                        if tokens:
-                            heads.append(sentence.tokens[j])
-                            if get_heads_next and j < i-1:
-                                heads_next.append(sentence.tokens[j+1])
-                        else:
-                            lemma = get_lemma_from_morph(sentence.morphs[j])
-                            if lemma[-1] == 'Y':
-                                lemma = lemma[:-1] + 'y'
-                            heads.append(lemma)
-                            if get_heads_next and j <i-1:
-                                next_lemma = get_lemma_from_morph(sentence.morphs[j+1])
-                                next_lemma = next_lemma.rstrip('+')
-                                if next_lemma[-1] == 'Y':
-                                    next_lemma = next_lemma[:-1] + 'y'
-                                heads_next.append(next_lemma)
-
-                        if gold_prep_parent == j+1:  # if current candidate is the gold head
-                            gold_head_label = len(heads)
-                if gold_head_label == -1:
-                    sys.stderr.write('Error: could not find the gold head in sentence:\n' + str(sentence))
+                heads_ids, gold_head_label = candidates[i]
+                for j in heads_ids:  # candidate heads
+                    if tokens:
+                        heads.append(sentence.tokens[j])
+                        if get_heads_next and j < i-1:
+                            heads_next.append(sentence.tokens[j+1])
+                    else:
+                        lemma = get_lemma_from_morph(sentence.morphs[j])
+                        if lemma[-1] == 'Y':
+                            lemma = lemma[:-1] + 'y'
+                        heads.append(lemma)
+                        if get_heads_next and j <i-1:
+                            next_lemma = get_lemma_from_morph(sentence.morphs[j+1])
+                            next_lemma = next_lemma.rstrip('+')
+                            if next_lemma[-1] == 'Y':
+                                next_lemma = next_lemma[:-1] + 'y'
+                            heads_next.append(next_lemma)
 
                 # first word in the PP is the preposition
                 if tokens:
@@ -573,21 +629,229 @@ def get_pp_attachments_from_sentence_child_grandchild(sentence, max_distance, to
     return attachments
 
 
-def extract_pp_attachments_from_file(spmrl_filename, max_distance, max_span, tokens=False, word_vectors=None, get_heads_next=False, only_child_grandchild=False):
+# word vectors of the current extraction worker process, set when the pool starts
+_shard_word_vectors = None
+
+
+def _set_shard_word_vectors(word_vectors):
+    global _shard_word_vectors
+    _shard_word_vectors = word_vectors
+
+
+def _extract_pp_attachments_from_shard(args):
+    """
+    Run a shard extractor in a worker process
+
+    Return the attachments, the vocabulary looked up if the word vectors are a VocabularyCollector, the
+    profiler counters of the shard if profiling (None otherwise), and the words of the shard's Vocabulary if
+    use_vocabulary (the attachments' words are then ids in it; None otherwise)
+    """
+
+    shard_extractor, filename, shard, extractor_args, use_vocabulary = args
+    parent_profiler = None
+    if get_profiler().enabled:
+        parent_profiler = set_profiler(Profiler())
+        # shards of files are byte ranges (with their start line), shards of treebanks are sentence ranges
+        get_profiler().count('shard_bytes' if len(shard) == 3 else 'shard_sentences', shard[1] - shard[0])
+    try:
+        vocab = None
+        word_vectors = _shard_word_vectors
+        if isinstance(word_vectors, VocabularyCollector):
+            word_vectors = collector = VocabularyCollector()
+        kwargs = dict()
+        if use_vocabulary:
+            kwargs['vocabulary'] = vocabulary = Vocabulary()
+            word_vectors = vocabulary.get_word_vectors_ids(word_vectors)
+        attachments = shard_extractor(filename, shard, word_vectors, *extractor_args, **kwargs)
+        if isinstance(_shard_word_vectors, VocabularyCollector):
+            vocab = collector.vocab
+        counters = get_profiler().counters if parent_profiler else None
+    finally:
+        if parent_profiler:
+            set_profiler(parent_profiler)
+    return attachments, vocab, counters, vocabulary.words if use_vocabulary else None
+
+
+def extract_shards(shard_extractor, filename, shards, num_processes, word_vectors, extractor_args, vocabulary=None):
+    """
+    Run a shard extractor on each shard, with a pool of processes if num_processes > 1
+
+    Return a list with the (attachments, vocab, words) result of each shard (see _extract_pp_attachments_from_shard)
+    If vocabulary is given, each shard is read with a Vocabulary of its own, whose words are returned for merging
+    The shards' profiler counters are added to the current profiler
+    """
+
+    tasks = [(shard_extractor, filename, shard, extractor_args, vocabulary is not None) for shard in shards]
+    if num_processes <= 1:
+        _set_shard_word_vectors(word_vectors)
+        results = map(_extract_pp_attachments_from_shard, tasks)
+    else:
+        pool = multiprocessing.Pool(num_processes, _set_shard_word_vectors, (word_vectors,))
+        try:
+            results = pool.map(_extract_pp_attachments_from_shard, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    profiler = get_profiler()
+    for _, _, counters, _ in results:
+        if counters:
+            profiler.merge_counters(counters)
+    return [(attachments, vocab, words) for attachments, vocab, _, words in results]
+
+
+def merge_shard_results(results, word_vectors, vocabulary=None):
+    """
+    Concatenate the attachments of shard results, moving their words to ids in vocabulary if the shards had their own
+    """
+
+    attachments = []
+    for shard_attachments, vocab, words in results:
+        if words is not None:
+            word_map = vocabulary.get_id_map(words)
+            for a in shard_attachments:
+                a.map_words(word_map)
+        attachments += shard_attachments
+        if vocab:
+            word_vectors.vocab.update(vocab)
+    return attachments
+
+
+def get_sharding_options(filename, num_processes, cache):
+    """
+    Get the num_processes and cache to extract from a file with
+
+    Shards are read by seeking, which compressed files do not support (see open_file), so these are read sequentially
+    and without the cache; a columnar treebank of a compressed file can be extracted from in parallel
+    """
+
+    if is_compressed(filename) and (num_processes > 1 or cache):
+        print 'reading compressed file sequentially, without shards:', filename
+        return 1, None
+    return num_processes, cache
+
+
+def extract_pp_attachments_in_parallel(shard_extractor, filename, num_processes, word_vectors, extractor_args, block_lines=None, vocabulary=None):
+    """
+    Extract attachments from a file with a pool of processes, each working on shards of whole sentences
+
+    shard_extractor - function called as shard_extractor(filename, shard, word_vectors, *extractor_args)
+    block_lines - number of lines per sentence for files without empty line separators (SPMRL)
+    vocabulary - if given, the words of the returned attachments are ids in it
+    Workers inherit word_vectors from the parent process (a memory-mapped WordVectors is shared, not copied)
+    Attachments are returned in file order, the same as with sequential extraction
+    """
+
+    shards = get_sentence_shards(filename, num_processes * SHARDS_PER_PROCESS, block_lines)
+    print 'extracting with', num_processes, 'processes from', len(shards), 'shards'
+    return merge_shard_results(extract_shards(shard_extractor, filename, shards, num_processes, word_vectors, extractor_args, vocabulary), \
+                               word_vectors, vocabulary)
+
+
+def extract_pp_attachments_with_cache(shard_extractor, filename, cache, num_processes, word_vectors, extractor_args, block_lines=None, vocabulary=None):
+    """
+    Extract attachments from a file, reusing the results cached for shards whose contents and parameters are unchanged
+
+    The file is split into content-defined shards (see get_content_defined_shards), so editing or appending sentences
+    only recomputes the shards around the change; these are extracted with num_processes processes
+    Cached attachments are stored with sentence start lines relative to their shard
+    """
+
+    shards = get_content_defined_shards(filename, CACHE_SHARD_SIZE, block_lines)
+    vocab_fingerprint = get_vocab_fingerprint(word_vectors)
+    params = extractor_args + (vocabulary is not None,)
+    keys = [cache.get_key(hash_file_range(filename, start_offset, end_offset), shard_extractor.__name__, params, vocab_fingerprint) \
+            for start_offset, end_offset, _ in shards]
+    results = [cache.get(key) for key in keys]
+    missing = [i for i in xrange(len(shards)) if results[i] is None]
+    print 'extraction cache: reusing', len(shards) - len(missing), 'of', len(shards), 'shards'
+    relative_shards = [(shards[i][0], shards[i][1], 0) for i in missing]
+    for i, result in zip(missing, extract_shards(shard_extractor, filename, relative_shards, num_processes, word_vectors, extractor_args, vocabulary)):
+        cache.put(keys[i], result)
+        results[i] = result
+    for (_, _, start_line), (shard_attachments, _, _) in zip(shards, results):
+        for a in shard_attachments:
+            if isinstance(a, ConllAttachment):
+                a.set_sentence_start_line(a.sentence_start_line + start_line)
+    return merge_shard_results(results, word_vectors, vocabulary)
+
+
+def extract_pp_attachments_from_treebank(treebank_dir, sentences_extractor, extractor_args, word_vectors=None, num_processes=1, vocabulary=None):
+    """
+    Extract attachments from a ColumnarTreebank, without parsing text
+
+    sentences_extractor - function called as sentences_extractor(sentences, word_vectors, *extractor_args), for the
+    treebank's kind (e.g. extract_pp_attachments_from_wsj_sentences)
+    vocabulary - if given, the words of the returned attachments are ids in it (not for SPMRL treebanks)
+    If num_processes > 1, extraction runs in parallel over sentence ranges; workers map the same treebank files,
+    so they share one copy of it
+    """
+
+    print 'extracting attachments from treebank:', treebank_dir
+    treebank = open_treebank(treebank_dir)
+    if num_processes > 1:
+        shards = treebank.get_sentence_shards(num_processes * SHARDS_PER_PROCESS)
+        print 'extracting with', num_processes, 'processes from', len(shards), 'shards'
+        results = extract_shards(extract_pp_attachments_from_treebank_shard, treebank_dir, shards, num_processes, word_vectors, \
+                                 (sentences_extractor, extractor_args), vocabulary)
+        return merge_shard_results(results, word_vectors, vocabulary)
+    if vocabulary is not None:
+        word_vectors = vocabulary.get_word_vectors_ids(word_vectors)
+    sentences = get_profiler().iter_stage('read', treebank.iter_sentences(vocabulary=vocabulary))
+    return sentences_extractor(sentences, word_vectors, *extractor_args)
+
+
+def extract_pp_attachments_from_treebank_shard(treebank_dir, shard, word_vectors, sentences_extractor, extractor_args, vocabulary=None):
+    """
+    Get all valid PP attachments from a range of sentences of a ColumnarTreebank (see get_sentence_shards)
+    """
+
+    start, end = shard
+    sentences = open_treebank(treebank_dir).iter_sentences(start, end, vocabulary)
+    return sentences_extractor(sentences, word_vectors, *extractor_args)
+
+
+def extract_pp_attachments_from_file(spmrl_filename, max_distance, max_span, tokens=False, word_vectors=None, get_heads_next=False, only_child_grandchild=False, \
+                                     num_processes=1, cache=None):
     """
     Get all valid PP attachments from a file
 
+    If cache (an ExtractionCache) is given, only shards not extracted before with the same parameters are processed
     Return a list of attachments
     """
 
     print 'extracting attachments from file:', spmrl_filename
-    sentences = read_spmrl_file(spmrl_filename, True)
+    num_processes, cache = get_sharding_options(spmrl_filename, num_processes, cache)
+    if cache:
+        return extract_pp_attachments_with_cache(extract_pp_attachments_from_spmrl_shard, spmrl_filename, cache, num_processes, word_vectors, \
+                                                 (max_distance, max_span, tokens, get_heads_next, only_child_grandchild), block_lines=6)
+    if num_processes > 1:
+        return extract_pp_attachments_in_parallel(extract_pp_attachments_from_spmrl_shard, spmrl_filename, num_processes, word_vectors, \
+                                                  (max_distance, max_span, tokens, get_heads_next, only_child_grandchild), block_lines=6)
+    sentences = get_profiler().iter_stage('read', iter_spmrl_file(spmrl_filename, True))
+    return extract_pp_attachments_from_spmrl_sentences(sentences, word_vectors, max_distance, max_span, tokens, get_heads_next, only_child_grandchild)
+
+
+def extract_pp_attachments_from_spmrl_shard(spmrl_filename, shard, word_vectors, max_distance, max_span, tokens, get_heads_next, only_child_grandchild):
+    """
+    Get all valid PP attachments from a shard of an SPMRL file (see get_sentence_shards)
+    """
+
+    start_offset, end_offset, start_line = shard
+    sentences = iter_spmrl_sentences(iter_file_lines(spmrl_filename, start_offset, end_offset), True)
+    return extract_pp_attachments_from_spmrl_sentences(sentences, word_vectors, max_distance, max_span, tokens, get_heads_next, only_child_grandchild)
+
+
+def extract_pp_attachments_from_spmrl_sentences(sentences, word_vectors, max_distance, max_span, tokens, get_heads_next, only_child_grandchild):
+    """
+    Get all valid PP attachments from SPMRL sentences (with morphs)
+    """
+
     attachments = []
-    for sentence in sentences:
+    for sentence, candidates in iter_sentence_candidate_heads(sentences, max_distance):
         if only_child_grandchild:
-            cur_attachments = get_pp_attachments_from_sentence_child_grandchild(sentence, max_distance, tokens, word_vectors, get_heads_next)
+            cur_attachments = get_pp_attachments_from_sentence_child_grandchild(sentence, max_distance, tokens, word_vectors, get_heads_next, candidates)
         else:
-            cur_attachments = get_pp_attachments_from_sentence(sentence, max_distance, max_span, tokens, word_vectors, get_heads_next)
+            cur_attachments = get_pp_attachments_from_sentence(sentence, max_distance, max_span, tokens, word_vectors, get_heads_next, candidates=candidates)
         attachments += cur_attachments
     return attachments
 
@@ -595,49 +859,73 @@ def extract_pp_attachments_from_file(spmrl_filename, max_distance, max_span, tok
 def eval_pp_attachments_from_pred_file(spmrl_conll_gold_filename, spmrl_conll_pred_filename, max_head_distance, tokens=False, word_vectors=None, use_heads_next=False):
 
     print 'extracting attachments from file:', spmrl_conll_gold_filename
-    gold_sentences = read_spmrl_conll_file(spmrl_conll_gold_filename)
-    pred_sentences = read_spmrl_conll_file(spmrl_conll_pred_filename)
-    num_total = 0
-    num_correct = 0
-    if len(gold_sentences) != len(pred_sentences):
-        print 'Error: len of gold and pred sentences not equal'
-        return
-    for i in xrange(len(gold_sentences)):
-        cur_total, cur_correct = eval_pred_pp_attachments_from_sentence(gold_sentences[i], pred_sentences[i], max_head_distance,  tokens, word_vectors, use_heads_next)
-        num_total += cur_total
-        num_correct += cur_correct
-
-    print 'total valid attachments:', num_total, 'correct:', num_correct, '(', "%.2f" %(100.0*num_correct/num_total), '%)'
+    return eval_pred_sentences(iter_spmrl_conll_file(spmrl_conll_gold_filename), iter_spmrl_conll_file(spmrl_conll_pred_filename), \
+                               lambda gold, pred, evaluation, candidates: \
+                               eval_pred_pp_attachments_from_sentence(gold, pred, max_head_distance, tokens, word_vectors, use_heads_next, \
+                                                                      evaluation=evaluation, candidates=candidates), \
+                               max_head_distance)
 
 
 def eval_pp_attachments_from_stanford_atb_pred_file(atb_conll_gold_filename, atb_conll_pred_filename, max_head_distance, word_vectors=None, use_heads_next=False):
 
     print 'extracting attachments from file:', atb_conll_gold_filename
-    gold_sentences = read_stanford_atb_conll_file(atb_conll_gold_filename)
-    pred_sentences = read_stanford_atb_conll_file(atb_conll_pred_filename)
-    num_total = 0
-    num_correct = 0
-    if len(gold_sentences) != len(pred_sentences):
-        print 'Error: len of gold and pred sentences not equal'
-        return
-    for i in xrange(len(gold_sentences)):
-        cur_total, cur_correct = eval_pred_pp_attachments_from_stanford_atb_sentence(gold_sentences[i], pred_sentences[i], max_head_distance, word_vectors, use_heads_next)
-        num_total += cur_total
-        num_correct += cur_correct
-
-    print 'total valid attachments:', num_total, 'correct:', num_correct, '(', "%.2f" %(100.0*num_correct/num_total), '%)'
+    return eval_pred_sentences(iter_stanford_atb_conll_file(atb_conll_gold_filename), iter_stanford_atb_conll_file(atb_conll_pred_filename), \
+                               lambda gold, pred, evaluation, candidates: \
+                               eval_pred_pp_attachments_from_stanford_atb_sentence(gold, pred, max_head_distance, word_vectors, use_heads_next, \
+                                                                                   evaluation=evaluation, candidates=candidates), \
+                               max_head_distance)
 
 
 def extract_pp_attachments_from_wsj_dep_file(wsj_dep_filename, max_head_distance, max_child_distance, word_vectors=None, \
-                                             use_heads_next=False, use_heads_pos=False, use_heads_next_pos=False):
+                                             use_heads_next=False, use_heads_pos=False, use_heads_next_pos=False, num_processes=1, cache=None, \
+                                             vocabulary=None):
+    """
+    Get all valid PP attachments from a WSJ .dep file
+
+    If vocabulary (a Vocabulary) is given, the attachments' words are its word ids
+    """
 
     print 'extracting attachments from file:', wsj_dep_filename
-    sentences = read_wsj_dep_file(wsj_dep_filename, True)
+    num_processes, cache = get_sharding_options(wsj_dep_filename, num_processes, cache)
+    if cache:
+        return extract_pp_attachments_with_cache(extract_pp_attachments_from_wsj_dep_shard, wsj_dep_filename, cache, num_processes, word_vectors, \
+                                                 (max_head_distance, max_child_distance, use_heads_next, use_heads_pos, use_heads_next_pos), \
+                                                 vocabulary=vocabulary)
+    if num_processes > 1:
+        return extract_pp_attachments_in_parallel(extract_pp_attachments_from_wsj_dep_shard, wsj_dep_filename, num_processes, word_vectors, \
+                                                  (max_head_distance, max_child_distance, use_heads_next, use_heads_pos, use_heads_next_pos), \
+                                                  vocabulary=vocabulary)
+    if vocabulary is not None:
+        word_vectors = vocabulary.get_word_vectors_ids(word_vectors)
+    sentences = get_profiler().iter_stage('read', iter_wsj_dep_file(wsj_dep_filename, True, vocabulary))
+    return extract_pp_attachments_from_wsj_sentences(sentences, word_vectors, max_head_distance, max_child_distance, \
+                                                     use_heads_next, use_heads_pos, use_heads_next_pos)
+
+
+def extract_pp_attachments_from_wsj_dep_shard(wsj_dep_filename, shard, word_vectors, max_head_distance, max_child_distance, \
+                                              use_heads_next, use_heads_pos, use_heads_next_pos, vocabulary=None):
+    """
+    Get all valid PP attachments from a shard of a WSJ .dep file (see get_sentence_shards)
+
+    Sentence start lines are relative to the whole file
+    """
+
+    sentences = iter_wsj_dep_file(wsj_dep_filename, True, vocabulary, shard)
+    return extract_pp_attachments_from_wsj_sentences(sentences, word_vectors, max_head_distance, max_child_distance, \
+                                                     use_heads_next, use_heads_pos, use_heads_next_pos)
+
+
+def extract_pp_attachments_from_wsj_sentences(sentences, word_vectors, max_head_distance, max_child_distance, \
+                                              use_heads_next, use_heads_pos, use_heads_next_pos):
+    """
+    Get all valid PP attachments from (English) WSJ sentences
+    """
+
     attachments = []
-    for sentence in sentences:
+    for sentence, candidates in iter_sentence_candidate_heads(sentences, max_head_distance, True):
         assert(type(sentence) == EnglishSentence)
         cur_attachments = get_pp_attachments_from_wsj_sentence(sentence, max_head_distance, max_child_distance, word_vectors, \
-                                                               use_heads_next, use_heads_pos, use_heads_next_pos)
+                                                               use_heads_next, use_heads_pos, use_heads_next_pos, candidates)
         attachments += cur_attachments
     return attachments
 
@@ -645,143 +933,136 @@ def extract_pp_attachments_from_wsj_dep_file(wsj_dep_filename, max_head_distance
 def eval_pp_attachments_from_wsj_pred_dep_file(wsj_gold_dep_filename, wsj_pred_dep_filename, max_head_distance, max_child_distance, word_vectors=None, use_heads_next=False):
 
     print 'extracting attachments from file:', wsj_gold_dep_filename
-    gold_sentences = read_wsj_dep_file(wsj_gold_dep_filename, True)
-    pred_sentences = read_wsj_dep_file(wsj_pred_dep_filename, True)
-    num_total = 0
-    num_correct = 0
-    if len(gold_sentences) != len(pred_sentences):
-        print 'Error: len of gold and pred sentences not equal'
-        return
-    for i in xrange(len(gold_sentences)):
-        cur_total, cur_correct = eval_pred_pp_attachments_from_wsj_sentence(gold_sentences[i], pred_sentences[i], max_head_distance, max_child_distance, word_vectors, use_heads_next)
-        num_total += cur_total
-        num_correct += cur_correct
+    return eval_pred_sentences(iter_wsj_dep_file(wsj_gold_dep_filename, True), iter_wsj_dep_file(wsj_pred_dep_filename, True), \
+                               lambda gold, pred, evaluation, candidates: \
+                               eval_pred_pp_attachments_from_wsj_sentence(gold, pred, max_head_distance, max_child_distance, word_vectors, \
+                                                                          use_heads_next, evaluation, candidates), \
+                               max_head_distance, ambiguous_only=True)
 
-    print 'total valid attachments:', num_total, 'correct:', num_correct, '(', "%.2f" %(100.0*num_correct/num_total), '%)'
 
-
-def eval_pred_pp_attachments_from_conll_sentence(gold_sentence, pred_sentence, max_head_distance, max_child_distance, use_tokens=True, word_vectors=None, get_heads_next=False):
+def eval_pred_pp_attachments_from_conll_sentence(gold_sentence, pred_sentence, max_head_distance, max_child_distance, use_tokens=True, word_vectors=None, get_heads_next=False, \
+                                                 evaluation=None, candidates=None):
     """
-    Eval all valid PP attachments from one (English) sentence
+    Eval all valid PP attachments from one conll sentence
 
-    max_distance is the maximum allowed distance of the candidate heads
-    Current version only extracts candidate heads, prepositions, and first child of preposition
+    Attachments are extracted from the gold sentence as in get_pp_attachments_from_conll_sentence
+    Return the number of attachments and the number correctly attached in pred_sentence
+    If evaluation (a PPEvaluation) is given, each attachment is also added to it
     """
 
-    if not type(gold_sentence) == ConllSentence:
-        print 'Warning: this method assumes sentence is ConllSentence, but it is instead:', str(type(gold_sentence))
-
-    num_total = 0
-    num_correct = 0
-    for i in xrange(len(gold_sentence.poses)-1):
-        if gold_sentence.is_prep(gold_sentence.poses[i]):
-            children_indices = gold_sentence.get_children(i+1)
-            for child_idx in children_indices:
-                if gold_sentence.is_valid_attachment(i, child_idx-1, max_head_distance, max_child_distance):
-                    gold_prep_parent = gold_sentence.parents[i]
-                    pred_prep_parent = pred_sentence.parents[i]
-                    heads = []
-                    heads_next = []
-                    prep = gold_sentence.tokens[i] if use_tokens else gold_sentence.lemmas[i]
-                    child = gold_sentence.tokens[child_idx-1] if use_tokens else gold_sentence.lemmas[child_idx-1]
-                    gold_head_label = -1
-                    start = max(0, i - max_head_distance)
-                    for j in xrange(start, i):  # find candidate heads
-                        if gold_sentence.is_noun(gold_sentence.poses[j]) or gold_sentence.is_verb(gold_sentence.poses[j]):
-                            if use_tokens:
-                                heads.append(gold_sentence.tokens[j])
-                            else:
-                                heads.append(gold_sentence.lemmas[j])
-                            if get_heads_next and j < i-1:
-                                heads_next.append(gold_sentence.tokens[j+1])
-                        if gold_prep_parent == j+1:  # if current candidate is the gold head
-                            gold_head_label = len(heads)
-                    if gold_head_label == -1:
-                        sys.stderr.write('Error: could not find the gold head in sentence:\n' + str(gold_sentence))
-
-                    if len(heads) > 1:  # don't take unambiguous cases
-                        if get_heads_next:
-                            attachment = ConllAttachment(heads, gold_head_label, prep, child, heads_next=heads_next)
-                        else:
-                            attachment = ConllAttachment(heads, gold_head_label, prep, child)
-                        if word_vectors and attachment.has_word_vectors(word_vectors):
-                            num_total += 1
-                            if gold_prep_parent == pred_prep_parent:
-                                num_correct += 1
-    return num_total, num_correct
+    attachments = get_pp_attachments_from_conll_sentence(gold_sentence, max_head_distance, max_child_distance, use_tokens, word_vectors, get_heads_next, \
+                                                         candidates=candidates)
+    return eval_attachments_against_pred_sentence(attachments, gold_sentence, pred_sentence, evaluation)
 
 
 def get_pp_attachments_from_conll_sentence(sentence, max_head_distance, max_child_distance, use_tokens=True, word_vectors=None, get_heads_next=False, \
-                                         use_heads_pos=False, use_heads_next_pos=False):
+                                         use_heads_pos=False, use_heads_next_pos=False, candidates=None):
     """
     Get all valid PP attachments from one (English) sentence
 
     max_distance is the maximum allowed distance of the candidate heads
     Current version only extracts candidate heads, prepositions, and first child of preposition
+    candidates - the sentence's candidate heads, if already found in a batch (see get_batch_candidate_heads, with ambiguous_only=True)
     """
 
     if not type(sentence) == ConllSentence:
         print 'Warning: this method assumes sentence is ConllSentence, but it is instead:', str(type(sentence))
 
     attachments = []
-    for i in xrange(len(sentence.poses)-1):
-        if sentence.is_prep(sentence.poses[i]):
-            children_indices = sentence.get_children(i+1)
-            for child_idx in children_indices:
-                if sentence.is_valid_attachment(i, child_idx-1, max_head_distance, max_child_distance):
-                    gold_prep_parent = sentence.parents[i]
-                    heads = []
-                    heads_next = []
-                    heads_pos = []
-                    heads_next_pos = []
-                    prep = sentence.tokens[i] if use_tokens else sentence.lemmas[i]
-                    child = sentence.tokens[child_idx-1] if use_tokens else sentence.lemmas[child_idx-1]
-                    gold_head_label = -1
-                    start = max(0, i - max_head_distance)
-                    for j in xrange(start, i):  # find candidate heads
-                        if sentence.is_noun(sentence.poses[j]) or sentence.is_verb(sentence.poses[j]):
-                            if use_tokens:
-                                heads.append(sentence.tokens[j])
-                            else:
-                                heads.append(sentence.lemmas[j])
-                            if use_heads_pos:
-                                pos = sentence.poses[j]
-                                pos_num = 1 if sentence.is_verb(pos) else -1  # verb=1, noun=-1
-                                heads_pos.append(str(pos_num))
-                            if get_heads_next and j < i-1:
-                                heads_next.append(sentence.tokens[j+1])
-                            if use_heads_next_pos and j < i-1:
-                                heads_next_pos.append(sentence.poses[j+1])
-                        if gold_prep_parent == j+1:  # if current candidate is the gold head
-                            gold_head_label = len(heads)
-                    if gold_head_label == -1:
-                        sys.stderr.write('Error: could not find the gold head in sentence:\n' + str(sentence))
-
-                    if len(heads) > 1:  # don't take unambiguous cases
-                        if get_heads_next:
-                            attachment = ConllAttachment(heads, gold_head_label, prep, child, heads_next=heads_next, heads_pos=heads_pos, heads_next_pos=heads_next_pos)
-                        else:
-                            attachment = ConllAttachment(heads, gold_head_label, prep, child, heads_pos=heads_pos, heads_next_pos=heads_next_pos)
-                        if word_vectors and attachment.has_word_vectors(word_vectors):
-                            attachments.append(attachment)
-                        # attachments.append(attachment)
+    if candidates is None:
+        candidates = get_sentence_candidate_heads(sentence, max_head_distance, ambiguous_only=True)
+    pos_classes = sentence.get_pos_classes()
+    profiler = get_profiler()
+    for i in sorted(candidates):
+        heads_ids, gold_head_label = candidates[i]
+        children_indices = sentence.get_children(i+1)
+        for child_idx in children_indices:
+            if sentence.is_valid_attachment(i, child_idx-1, max_head_distance, max_child_distance):
+                if use_tokens:
+                    heads = [sentence.tokens[j] for j in heads_ids]
+                else:
+                    heads = [sentence.lemmas[j] for j in heads_ids]
+                heads_next = []
+                heads_pos = []
+                heads_next_pos = []
+                prep = sentence.tokens[i] if use_tokens else sentence.lemmas[i]
+                child = sentence.tokens[child_idx-1] if use_tokens else sentence.lemmas[child_idx-1]
+                for j in heads_ids:
+                    if use_heads_pos:
+                        pos_num = 1 if pos_classes[j] == POS_CLASS_VERB else -1  # verb=1, noun=-1
+                        heads_pos.append(str(pos_num))
+                    if get_heads_next and j < i-1:
+                        heads_next.append(sentence.tokens[j+1])
+                    if use_heads_next_pos and j < i-1:
+                        heads_next_pos.append(sentence.poses[j+1])
+
+                if len(heads) > 1:  # don't take unambiguous cases
+                    if get_heads_next:
+                        attachment = ConllAttachment(heads, gold_head_label, prep, child, heads_next=heads_next, heads_pos=heads_pos, heads_next_pos=heads_next_pos)
+                    else:
+                        attachment = ConllAttachment(heads, gold_head_label, prep, child, heads_pos=heads_pos, heads_next_pos=heads_next_pos)
+                    attachment.set_prep_id(i)
+                    attachment.set_heads_ids(list(heads_ids))
+                    attachment.set_sentence_start_line(sentence.start_line)
+                    if word_vectors and attachment.has_word_vectors(word_vectors):
+                        attachments.append(attachment)
+                    elif word_vectors:
+                        profiler.reject('no_word_vectors')
+                    # attachments.append(attachment)
+            elif profiler.enabled:
+                profiler.reject(sentence.get_invalid_attachment_reason(i, child_idx-1, max_head_distance, max_child_distance))
     return attachments
 
 
 def extract_pp_attachments_from_conll_file(conll_filename, language, max_head_distance, max_child_distance, tokens=False, word_vectors=None, \
-                                           get_heads_next=False, use_heads_pos=False, use_heads_next_pos=False):
+                                           get_heads_next=False, use_heads_pos=False, use_heads_next_pos=False, num_processes=1, cache=None, \
+                                           vocabulary=None):
     """
     Get all valid PP attachments from a file
 
+    If cache (an ExtractionCache) is given, only shards not extracted before with the same parameters are processed
+    If vocabulary (a Vocabulary) is given, the attachments' words are its word ids
     Return a list of attachments
     """
 
     print 'extracting attachments from file:', conll_filename
-    sentences = read_conll_file(conll_filename, language)
+    num_processes, cache = get_sharding_options(conll_filename, num_processes, cache)
+    if cache:
+        return extract_pp_attachments_with_cache(extract_pp_attachments_from_conll_shard, conll_filename, cache, num_processes, word_vectors, \
+                                                 (language, max_head_distance, max_child_distance, tokens, get_heads_next, use_heads_pos, use_heads_next_pos), \
+                                                 vocabulary=vocabulary)
+    if num_processes > 1:
+        return extract_pp_attachments_in_parallel(extract_pp_attachments_from_conll_shard, conll_filename, num_processes, word_vectors, \
+                                                  (language, max_head_distance, max_child_distance, tokens, get_heads_next, use_heads_pos, use_heads_next_pos), \
+                                                  vocabulary=vocabulary)
+    if vocabulary is not None:
+        word_vectors = vocabulary.get_word_vectors_ids(word_vectors)
+    sentences = get_profiler().iter_stage('read', iter_conll_file(conll_filename, language, 'utf-8', vocabulary))
+    return extract_pp_attachments_from_conll_sentences(sentences, word_vectors, max_head_distance, max_child_distance, tokens, \
+                                                       get_heads_next, use_heads_pos, use_heads_next_pos)
+
+
+def extract_pp_attachments_from_conll_shard(conll_filename, shard, word_vectors, language, max_head_distance, max_child_distance, tokens, \
+                                            get_heads_next, use_heads_pos, use_heads_next_pos, vocabulary=None):
+    """
+    Get all valid PP attachments from a shard of a conll file (see get_sentence_shards)
+    """
+
+    sentences = iter_conll_file(conll_filename, language, 'utf-8', vocabulary, shard)
+    return extract_pp_attachments_from_conll_sentences(sentences, word_vectors, max_head_distance, max_child_distance, tokens, \
+                                                       get_heads_next, use_heads_pos, use_heads_next_pos)
+
+
+def extract_pp_attachments_from_conll_sentences(sentences, word_vectors, max_head_distance, max_child_distance, tokens, \
+                                                get_heads_next, use_heads_pos, use_heads_next_pos):
+    """
+    Get all valid PP attachments from conll sentences
+    """
+
     attachments = []
-    for sentence in sentences:
+    for sentence, candidates in iter_sentence_candidate_heads(sentences, max_head_distance, True):
         cur_attachments = get_pp_attachments_from_conll_sentence(sentence, max_head_distance, max_child_distance, tokens, word_vectors, \
-                                                                 get_heads_next, use_heads_pos, use_heads_next_pos)
+                                                                 get_heads_next, use_heads_pos, use_heads_next_pos, candidates)
         attachments += cur_attachments
     return attachments
 
@@ -790,135 +1071,57 @@ def eval_pp_attachments_from_conll_pred_file(conll_gold_filename, conll_pred_fil
                                              use_tokens=True, word_vectors=None, use_heads_next=False):
 
     print 'extracting attachments from file:', conll_gold_filename
-    gold_sentences = read_conll_file(conll_gold_filename, language)
-    pred_sentences = read_conll_file(conll_pred_filename, language)
-    num_total = 0
-    num_correct = 0
-    if len(gold_sentences) != len(pred_sentences):
-        print 'Error: len of gold and pred sentences not equal'
-        return
-    for i in xrange(len(gold_sentences)):
-        cur_total, cur_correct = eval_pred_pp_attachments_from_conll_sentence(gold_sentences[i], pred_sentences[i], max_head_distance, \
-                                                                              max_child_distance, use_tokens, word_vectors, use_heads_next)
-        num_total += cur_total
-        num_correct += cur_correct
-
-    print 'total valid attachments:', num_total, 'correct:', num_correct, '(', "%.2f" %(100.0*num_correct/num_total), '%)'
+    return eval_pred_sentences(iter_conll_file(conll_gold_filename, language), iter_conll_file(conll_pred_filename, language), \
+                               lambda gold, pred, evaluation, candidates: \
+                               eval_pred_pp_attachments_from_conll_sentence(gold, pred, max_head_distance, max_child_distance, use_tokens, \
+                                                                            word_vectors, use_heads_next, evaluation, candidates), \
+                               max_head_distance, ambiguous_only=True)
 
 
 def write_attachments(attachments, output_pref, get_heads_next=False):
 
     print 'writing attachments to files with prefix:', output_pref
-    g_heads = open(output_pref + '.heads', 'w')
-    g_nheads = open(output_pref + '.nheads', 'w')
-    g_labels = open(output_pref + '.labels', 'w')
-    g_pp_words = open(output_pref + '.ppwords', 'w')
-    g_pp_parents = open(output_pref + '.ppparents', 'w')
-    if get_heads_next:
-        g_heads_next = open(output_pref + '.heads.next', 'w')
-
-    for a in attachments:
-        g_heads.write(' '.join(a.heads) + '\n')
-        g_nheads.write(str(len(a.heads)) + '\n')
-        g_labels.write(str(a.label) + '\n')
-        g_pp_words.write(' '.join(a.pp_words) + '\n')
-        g_pp_parents.write(' '.join([str(p) for p in a.pp_parents]) + '\n')
-        if get_heads_next and a.heads_next:
-            g_heads_next.write('\t'.join(a.heads_next) + '\n')
-
-    g_heads.close()
-    g_nheads.close()
-    g_labels.close()
-    g_pp_words.close()
-    g_pp_parents.close()
-    if get_heads_next:
-        g_heads_next.close()
+    write_attachment_table(AttachmentTable.from_attachments(attachments), output_pref, get_heads_next)
 
 
-def write_wsj_attachments(attachments, output_pref, use_heads_next=False, use_heads_pos=False, use_heads_next_pos=False):
+def write_wsj_attachments(attachments, output_pref, use_heads_next=False, use_heads_pos=False, use_heads_next_pos=False, vocabulary=None):
 
-    write_conll_attachments(attachments, output_pref, use_heads_next, use_heads_pos, use_heads_next_pos)
+    write_conll_attachments(attachments, output_pref, use_heads_next, use_heads_pos, use_heads_next_pos, vocabulary)
 
 
-def write_conll_attachments(attachments, output_pref, use_heads_next=False, use_heads_pos=False, use_heads_next_pos=False):
+def write_conll_attachments(attachments, output_pref, use_heads_next=False, use_heads_pos=False, use_heads_next_pos=False, vocabulary=None):
 
     print 'writing attachments to files with prefix:', output_pref
-    g_heads = codecs.open(output_pref + '.heads.words', 'w', encoding='utf-8')
-    g_nheads = open(output_pref + '.nheads', 'w')
-    g_labels = open(output_pref + '.labels', 'w')
-    g_preps = codecs.open(output_pref + '.preps.words', 'w', encoding='utf-8')
-    g_children = codecs.open(output_pref + '.children.words', 'w', encoding='utf-8')
-    if use_heads_next:
-        g_heads_next = codecs.open(output_pref + '.heads.next.words', 'w', encoding='utf-8')
-    if use_heads_pos:
-        g_heads_pos = open(output_pref + '.heads.pos', 'w')
-    if use_heads_next_pos:
-        g_heads_next_pos = open(output_pref + '.heads.next.pos', 'w')
-
-    for a in attachments:
-        assert(isinstance(a, ConllAttachment))
-        g_heads.write(' '.join(a.heads) + '\n')
-        g_nheads.write(str(len(a.heads)) + '\n')
-        g_labels.write(str(a.label) + '\n')
-        g_preps.write(a.prep + '\n')
-        g_children.write(a.child + '\n')
-        if use_heads_next:
-            g_heads_next.write('\t'.join(a.heads_next) + '\n')
-        if use_heads_pos:
-            g_heads_pos.write('\t'.join(a.heads_pos) + '\n')
-        if use_heads_next_pos:
-            g_heads_next_pos.write('\t'.join(a.heads_next_pos) + '\n')
-
-    g_heads.close()
-    g_nheads.close()
-    g_labels.close()
-    g_preps.close()
-    g_children.close()
-    if use_heads_next:
-        g_heads_next.close()
-    if use_heads_pos:
-        g_heads_pos.close()
-    if use_heads_next_pos:
-        g_heads_next_pos.close()
+    write_conll_attachment_table(AttachmentTable.from_attachments(attachments, vocabulary), output_pref, use_heads_next, use_heads_pos, use_heads_next_pos)
 
 
 def filter_attachments_by_max_children_num(attachments, max_child_count):
 
     print 'filtering attachments, max_child_count:', max_child_count
-    filtered = []
-    for a in attachments:
-        child_count = np.bincount(np.bincount(a.pp_parents))
-        if len(child_count) <= max_child_count+1:
-            filtered.append(a)
-    return filtered
-
-
-def print_attachment_stats(attachments):
-
-    print 'number of all attachments:', len(attachments)
-    nheads = [len(a.heads) for a in attachments]
-    print 'average # of heads:', np.mean(nheads), 'std:', np.std(nheads)
-    nppwords = [len(a.pp_words) for a in attachments]
-    vocab_heads = set()
-    vocab_preps = set()
-    vocab_children = set()
-    vocab_child1 = set()
-    vocab_all = set()
-    for a in attachments:
-        for h in a.heads:
-            vocab_heads.add(h)
-            vocab_all.add(h)
-        vocab_preps.add(a.pp_words[0])
-        vocab_all.add(a.pp_words[0])
-        vocab_child1.add(a.pp_words[1])
-        for w in a.pp_words[1:]:
-            vocab_children.add(w)
-            # vocab_all.add(w)
-    print 'vocab sizes:'
-    print 'heads:', len(vocab_heads), 'preps:', len(vocab_preps), 'children:', len(vocab_children), 'first child:', len(vocab_child1), 'all (head+prep+child1):', len(vocab_all)
+    keep = AttachmentTable.from_attachments(attachments).get_max_children_counts() <= max_child_count
+    return [a for a, k in zip(attachments, keep) if k]
+
 
+def write_attachments_stats(attachments, output_pref, word_vectors=None, vocabulary=None):
+    """
+    Write statistics of the attachments to output_pref.stats.json (see attachment_stats.get_attachment_stats)
+
+    If word_vectors is given, out-of-vocabulary rates against it are included
+    """
+
+    stats = get_attachment_stats(AttachmentTable.from_attachments(attachments, vocabulary), word_vectors)
+    print 'number of all attachments:', stats['num_attachments']
+    print 'writing attachment statistics to:', output_pref + STATS_SUFFIX
+    write_attachment_stats(stats, output_pref + STATS_SUFFIX)
 
-def run_spmrl(spmrl_filename, output_pref, word_vectors_filename, max_distance, max_span, max_children=0, tokens=False, get_heads_next=False, only_child_grandchild=False):
+
+def run_spmrl(spmrl_filename, output_pref, word_vectors_filename, max_distance, max_span, max_children=0, tokens=False, get_heads_next=False, only_child_grandchild=False, \
+              num_processes=1, cache_dir=None, treebank_dir=None):
+    """
+    If cache_dir is given, extracted attachments are cached there per input shard (see ExtractionCache)
+    If treebank_dir is given, the input is converted there to a columnar treebank (once, while the input is unchanged),
+    and attachments are extracted from the treebank instead (see columnar_treebank; cache_dir is then not used)
+    """
 
     if only_child_grandchild and max_span > 0:
         sys.stderr.write('Error: cannot have positive max_span when only looking for child and grandchild (span ignored in this case)')
@@ -926,7 +1129,15 @@ def run_spmrl(spmrl_filename, output_pref, word_vectors_filename, max_distance,
     word_vectors = None
     # if len(word_vectors_filename):
     #     word_vectors = get_word_vectors(word_vectors_filename)
-    attachments = extract_pp_attachments_from_file(spmrl_filename, max_distance, max_span, tokens, word_vectors, get_heads_next, only_child_grandchild)
+    cache = ExtractionCache(cache_dir) if cache_dir else None
+    if treebank_dir:
+        load_or_convert_treebank(spmrl_filename, treebank_dir, TREEBANK_SPMRL)
+        attachments = extract_pp_attachments_from_treebank(treebank_dir, extract_pp_attachments_from_spmrl_sentences, \
+                                                           (max_distance, max_span, tokens, get_heads_next, only_child_grandchild), \
+                                                           word_vectors, num_processes)
+    else:
+        attachments = extract_pp_attachments_from_file(spmrl_filename, max_distance, max_span, tokens, word_vectors, get_heads_next, \
+                                                       only_child_grandchild, num_processes, cache)
     output_filename = output_pref
     if only_child_grandchild:
         output_filename += '.childgrandchild'
@@ -937,34 +1148,51 @@ def run_spmrl(spmrl_filename, output_pref, word_vectors_filename, max_distance,
             attachments = filter_attachments_by_max_children_num(attachments, max_children)
             output_filename += '.maxchildcount' + str(max_children)
     # write_attachments(attachments, output_filename, get_heads_next)
-    print_attachment_stats(attachments)
-
+    write_attachments_stats(attachments, output_filename)
 
-def print_english_attachment_stats(attachments):
 
-    print_conll_attachment_stats(attachments)
+def get_predicted_prep_heads(attachments, pp_pred_filename, include_ind_filename):
+    """
+    Read predictions from PP model and map them to prep line numbers and predicted heads (1-based word index)
 
+    The predictions and included indices files are read together, one line at a time
+    Return arrays of line numbers (sorted) and heads; when several attachments share a prep (one per child), the last
+    prediction is kept. Return None if the predictions don't match the attachments
+    """
 
-def print_conll_attachment_stats(attachments):
+    line_numbers = []
+    heads = []
+    num_preds = 0
+    max_orig_index = 0
+    with open_file(pp_pred_filename) as f_pred, open_file(include_ind_filename) as f_ind:
+        for pred, orig_index in izip_longest(f_pred, f_ind):
+            if pred is not None:
+                num_preds += 1
+            if pred is None or orig_index is None:
+                continue
+            orig_index = int(orig_index)
+            max_orig_index = max(max_orig_index, orig_index)
+            if orig_index > len(attachments):
+                continue
+            attachment = attachments[orig_index - 1]
+            line_numbers.append(attachment.sentence_start_line + attachment.orig_prep_id)
+            heads.append(attachment.orig_heads_ids[int(pred)-1] + 1)
+    # run some checks
+    if len(attachments) < num_preds:
+        sys.stderr.write('Error: number of extracted attachments cannot be smaller than predicted attachments from matlab code' + '\n')
+        return None
+    if len(attachments) < max_orig_index:
+        sys.stderr.write('Error: maximum original index cannot be greater than number of extracted attachments' + '\n')
+        return None
 
-    print 'number of all attachments:', len(attachments)
-    nheads = [len(a.heads) for a in attachments]
-    print 'average # of heads:', np.mean(nheads), 'std:', np.std(nheads)
-    vocab_heads = set()
-    vocab_preps = set()
-    vocab_child1 = set()
-    vocab_all = set()
-    for a in attachments:
-        for h in a.heads:
-            vocab_heads.add(h)
-            vocab_all.add(h)
-        vocab_preps.add(a.prep)
-        vocab_all.add(a.prep)
-        vocab_child1.add(a.child)
-        vocab_all.add(a.child)
-    print 'vocab sizes:'
-    print 'heads:', len(vocab_heads), 'preps:', len(vocab_preps), 'first child:', len(vocab_child1), 'all (head+prep+child1):', len(vocab_all)
-    print vocab_preps
+    line_numbers = np.array(line_numbers, dtype=np.int64)
+    heads = np.array(heads, dtype=np.int64)
+    order = np.argsort(line_numbers, kind='mergesort')  # stable, so the last prediction of each prep stays last
+    line_numbers = line_numbers[order]
+    heads = heads[order]
+    is_last = np.ones(len(line_numbers), dtype=np.bool_)
+    is_last[:-1] = line_numbers[1:] != line_numbers[:-1]
+    return line_numbers[is_last], heads[is_last]
 
 
 def write_pp_predictions_to_wsj_file(attachments, wsj_dep_filename, pp_pred_filename, include_ind_filename):
@@ -975,71 +1203,166 @@ def write_pp_predictions_to_wsj_file(attachments, wsj_dep_filename, pp_pred_file
     conll_filename - original conll_file, new file will be written to conll_filename.pred
     pp_pred_filename - file containing predictions from pp model, each line has number (1-indexed) of the predicted head (not word index; will be mapped to index)
     include_ind_filename - file containing indices of attachments included in pp model (1-indexing)
+    The original file is merged with the predictions sorted by line number, one line at a time
     """
 
-    lines = open(wsj_dep_filename).readlines()
-    preds = open(pp_pred_filename).readlines()
-    preds = [int(pred.strip()) for pred in preds]
-    orig_indices = open(include_ind_filename).readlines()
-    orig_indices = [int(orig_index.strip()) for orig_index in orig_indices]
-    # run some checks
-    if len(attachments) < len(preds):
-        sys.stderr.write('Error: number of extracted attachments cannot be smaller than predicted attachments from matlab code' + '\n')
-        return
-    if len(attachments) < max(orig_indices):
-        sys.stderr.write('Error: maximum original index cannot be greater than number of extracted attachments' + '\n')
+    predicted_prep_heads = get_predicted_prep_heads(attachments, pp_pred_filename, include_ind_filename)
+    if predicted_prep_heads is None:
         return
+    prep_line_numbers, predicted_head_indices = [a.tolist() for a in predicted_prep_heads]
+    prep_line_numbers.append(-1)  # sentinel
 
     print 'writing pp predictions to new wsj file:', wsj_dep_filename + '.pred'
+    k = 0
+    with open_file(wsj_dep_filename) as f, open(wsj_dep_filename + '.pred', 'w') as g:
+        for i, line in enumerate(f):
+            if i == prep_line_numbers[k]:
+                new_line = line.strip() + '\t' + str(predicted_head_indices[k]) + '\n'
+                k += 1
+            else:
+                new_line = line.strip() + '\t' + '_' + '\n'
+            g.write(new_line)
+
+
+def write_attachments_bundle(attachments, output_pref, word_vectors=None, vocabulary=None):
+    """
+    Write attachments to a single binary bundle output_pref.npz, loadable with load_attachment_bundle
+    """
 
-    # find predicted prep head indices
-    map_prep_line_number_to_predicted_head_index = dict()
-    for i in xrange(len(orig_indices)):
-        orig_index = orig_indices[i]
-        pred = preds[i]
-        attachment = attachments[orig_index - 1]
-        prep_line_number = attachment.sentence_start_line + attachment.orig_prep_id
-        predicted_head_index = attachment.orig_heads_ids[pred-1] + 1
-        map_prep_line_number_to_predicted_head_index[prep_line_number] = predicted_head_index
-    # write new lines
-    g = open(wsj_dep_filename + '.pred', 'w')
-    for i in xrange(len(lines)):
-        if i in map_prep_line_number_to_predicted_head_index:
-            predicted_head_index = map_prep_line_number_to_predicted_head_index[i]
-            new_line = lines[i].strip() + '\t' + str(predicted_head_index) + '\n'
-        else:
-            new_line = lines[i].strip() + '\t' + '_' + '\n'
-        g.write(new_line)
-    g.close()
+    print 'writing attachments bundle to:', output_pref + '.npz'
+    write_attachment_bundle(AttachmentTable.from_attachments(attachments, vocabulary), output_pref + '.npz', word_vectors)
+
+
+def filter_attachments_by_word_vectors_file(attachments, vocab, word_vectors_filename, encoding=None, output_pref=None, vocabulary=None):
+    """
+    Second pass of vocabulary-filtered extraction
+
+    attachments - attachments extracted with a VocabularyCollector in place of word vectors
+    vocab - the vocabulary recorded by the collector
+    Load vectors only for words in vocab and keep the attachments whose words all have vectors
+    If output_pref is given, the filtered vectors are also written to output_pref.vectors.txt
+    If vocabulary is given, the attachments' words are its word ids
+    Return the kept attachments and the loaded word vectors
+    """
+
+    output_filename = output_pref + '.vectors.txt' if output_pref else None
+    word_vectors = get_word_vectors_for_vocab(word_vectors_filename, vocab, encoding, output_filename)
+    word_vectors_ids = vocabulary.get_word_vectors_ids(word_vectors) if vocabulary is not None else word_vectors
+    attachments = [a for a in attachments if a.has_word_vectors(word_vectors_ids)]
+    return attachments, word_vectors
 
 
 def run_wsj(wsj_dep_filename, output_pref, word_vectors_filename, max_head_distance, max_child_distance, use_heads_next=False, \
-            use_heads_pos=False, use_heads_next_pos=False, pp_pred_filename=None, include_ind_filename=None):
+            use_heads_pos=False, use_heads_next_pos=False, pp_pred_filename=None, include_ind_filename=None, \
+            filter_word_vectors=False, write_filtered_word_vectors=False, num_processes=1, write_bundle=False, cache_dir=None, \
+            profile_filename=None, pstats_filename=None, treebank_dir=None):
+    """
+    If filter_word_vectors=True, run in two passes: first collect the vocabulary of the attachments,
+    then load only the vectors for that vocabulary (optionally writing them next to the output files)
+    If num_processes > 1, extraction runs in parallel over shards of the input file
+    If write_bundle=True, also write all attachment arrays and their word vectors to output_pref.npz
+    If cache_dir is given, extracted attachments are cached there per input shard (see ExtractionCache)
+    If profile_filename is given, stage times and counters are written there as json; if pstats_filename is given,
+    the run is profiled with cProfile (see profiling.Profiler)
+    If treebank_dir is given, the input is converted there to a columnar treebank (once, while the input is unchanged),
+    and attachments are extracted from the treebank instead (see columnar_treebank; cache_dir is then not used)
+    """
 
+    profiler = start_profiling(profile_filename, pstats_filename)
     word_vectors = None
-    if len(word_vectors_filename):
-        word_vectors = get_word_vectors(word_vectors_filename)
-    attachments = extract_pp_attachments_from_wsj_dep_file(wsj_dep_filename, max_head_distance, max_child_distance, word_vectors, \
-                                                           use_heads_next, use_heads_pos, use_heads_next_pos)
-    write_wsj_attachments(attachments, output_pref, use_heads_next, use_heads_pos, use_heads_next_pos)
-    print_english_attachment_stats(attachments)
+    with profiler.stage('load_vectors'):
+        if len(word_vectors_filename):
+            if filter_word_vectors:
+                word_vectors = VocabularyCollector()
+            else:
+                word_vectors = get_word_vectors(word_vectors_filename)
+    cache = ExtractionCache(cache_dir) if cache_dir else None
+    vocabulary = Vocabulary()
+    if treebank_dir:
+        with profiler.stage('convert'):
+            load_or_convert_treebank(wsj_dep_filename, treebank_dir, TREEBANK_WSJ, lower_case=True)
+    with profiler.stage('extract'):
+        if treebank_dir:
+            attachments = extract_pp_attachments_from_treebank(treebank_dir, extract_pp_attachments_from_wsj_sentences, \
+                                                               (max_head_distance, max_child_distance, use_heads_next, use_heads_pos, use_heads_next_pos), \
+                                                               word_vectors, num_processes, vocabulary)
+        else:
+            attachments = extract_pp_attachments_from_wsj_dep_file(wsj_dep_filename, max_head_distance, max_child_distance, word_vectors, \
+                                                                   use_heads_next, use_heads_pos, use_heads_next_pos, num_processes, cache, vocabulary)
+    profiler.count('vocabulary_size', len(vocabulary))
+    profiler.count('attachments_extracted', len(attachments))
+    if isinstance(word_vectors, VocabularyCollector):
+        with profiler.stage('vector_filter'):
+            encoding = 'utf-8' if 'utf8' in word_vectors_filename else None
+            num_attachments = len(attachments)
+            attachments, word_vectors = filter_attachments_by_word_vectors_file(attachments, word_vectors.vocab, word_vectors_filename, encoding, \
+                                                                                output_pref if write_filtered_word_vectors else None, vocabulary)
+            profiler.reject('no_word_vectors', num_attachments - len(attachments))
+    with profiler.stage('write'):
+        write_wsj_attachments(attachments, output_pref, use_heads_next, use_heads_pos, use_heads_next_pos, vocabulary)
+        if write_bundle:
+            write_attachments_bundle(attachments, output_pref, word_vectors, vocabulary)
+    with profiler.stage('stats'):
+        write_attachments_stats(attachments, output_pref, word_vectors, vocabulary)
     if pp_pred_filename and include_ind_filename:
-        write_pp_predictions_to_wsj_file(attachments, wsj_dep_filename, pp_pred_filename, include_ind_filename)
+        with profiler.stage('write'):
+            write_pp_predictions_to_wsj_file(attachments, wsj_dep_filename, pp_pred_filename, include_ind_filename)
+    stop_profiling(profiler, profile_filename, pstats_filename)
 
 
 def run_conll(conll_filename, language, output_pref, word_vectors_filename, max_head_distance, max_child_distance, use_tokens=True, use_heads_next=False, \
-            use_heads_pos=False, use_heads_next_pos=False):
+            use_heads_pos=False, use_heads_next_pos=False, filter_word_vectors=False, write_filtered_word_vectors=False, num_processes=1, \
+            write_bundle=False, cache_dir=None, profile_filename=None, pstats_filename=None, treebank_dir=None):
+    """
+    If filter_word_vectors=True, run in two passes (see run_wsj)
+    If num_processes > 1, extraction runs in parallel over shards of the input file
+    If write_bundle=True, also write all attachment arrays and their word vectors to output_pref.npz
+    If cache_dir is given, extracted attachments are cached there per input shard (see ExtractionCache)
+    If profile_filename or pstats_filename is given, the run is profiled (see run_wsj)
+    If treebank_dir is given, attachments are extracted from a columnar treebank of the input (see run_wsj)
+    """
+
+    profiler = start_profiling(profile_filename, pstats_filename)
     word_vectors = None
-    if len(word_vectors_filename):
-        # if language == 'catalan':
-        #     word_vectors = get_word_vectors_utf8(word_vectors_filename, 'latin-1')
-        # else:
-        word_vectors = get_word_vectors_utf8(word_vectors_filename)
-        print len(word_vectors)
-    attachments = extract_pp_attachments_from_conll_file(conll_filename, language, max_head_distance, max_child_distance, use_tokens, word_vectors, \
-                                                           use_heads_next, use_heads_pos, use_heads_next_pos)
-    write_conll_attachments(attachments, output_pref, use_heads_next, use_heads_pos, use_heads_next_pos)
-    print_conll_attachment_stats(attachments)
+    with profiler.stage('load_vectors'):
+        if len(word_vectors_filename):
+            if filter_word_vectors:
+                word_vectors = VocabularyCollector()
+            else:
+                # if language == 'catalan':
+                #     word_vectors = get_word_vectors_utf8(word_vectors_filename, 'latin-1')
+                # else:
+                word_vectors = get_word_vectors_utf8(word_vectors_filename)
+                print len(word_vectors)
+    cache = ExtractionCache(cache_dir) if cache_dir else None
+    vocabulary = Vocabulary()
+    if treebank_dir:
+        with profiler.stage('convert'):
+            load_or_convert_treebank(conll_filename, treebank_dir, TREEBANK_CONLL, language)
+    with profiler.stage('extract'):
+        if treebank_dir:
+            attachments = extract_pp_attachments_from_treebank(treebank_dir, extract_pp_attachments_from_conll_sentences, \
+                                                               (max_head_distance, max_child_distance, use_tokens, use_heads_next, use_heads_pos, \
+                                                                use_heads_next_pos), word_vectors, num_processes, vocabulary)
+        else:
+            attachments = extract_pp_attachments_from_conll_file(conll_filename, language, max_head_distance, max_child_distance, use_tokens, \
+                                                                 word_vectors, use_heads_next, use_heads_pos, use_heads_next_pos, num_processes, cache, \
+                                                                 vocabulary)
+    profiler.count('vocabulary_size', len(vocabulary))
+    profiler.count('attachments_extracted', len(attachments))
+    if isinstance(word_vectors, VocabularyCollector):
+        with profiler.stage('vector_filter'):
+            num_attachments = len(attachments)
+            attachments, word_vectors = filter_attachments_by_word_vectors_file(attachments, word_vectors.vocab, word_vectors_filename, 'utf-8', \
+                                                                                output_pref if write_filtered_word_vectors else None, vocabulary)
+            profiler.reject('no_word_vectors', num_attachments - len(attachments))
+    with profiler.stage('write'):
+        write_conll_attachments(attachments, output_pref, use_heads_next, use_heads_pos, use_heads_next_pos, vocabulary)
+        if write_bundle:
+            write_attachments_bundle(attachments, output_pref, word_vectors, vocabulary)
+    with profiler.stage('stats'):
+        write_attachments_stats(attachments, output_pref, word_vectors, vocabulary)
+    stop_profiling(profiler, profile_filename, pstats_filename)
 
 
 SPMRL_FILE = '/home/belinkov/Dropbox/school/arabic-parsing/data/spmrl/spmrl.train.lab.all'
@@ -1058,7 +1381,8 @@ MAX_CHILD_DISTANCE = 200
 GET_HEADS_NEXT = False
 GET_HEADS_POS = True
 GET_HEADS_NEXT_POS = True
-run_wsj(WSJ_FILE, OUTPUT_PREF, WORD_VECTORS_FILE, MAX_HEAD_DISTANCE, MAX_CHILD_DISTANCE, GET_HEADS_NEXT, GET_HEADS_POS, GET_HEADS_NEXT_POS)
+if __name__=='__main__':
+    run_wsj(WSJ_FILE, OUTPUT_PREF, WORD_VECTORS_FILE, MAX_HEAD_DISTANCE, MAX_CHILD_DISTANCE, GET_HEADS_NEXT, GET_HEADS_POS, GET_HEADS_NEXT_POS)
 # MATLAB_PRED_FILE = '/mnt/scratch/belinkov/pp/data/matlab/wsj.2-21.txt.dep.pp.out'
 # MATLAB_INCLUDE_IND_FILE = '/mnt/scratch/belinkov/pp/data/matlab/wsj.2-21.txt.dep.pp.includeInd'
 #run_wsj(WSJ_FILE, OUTPUT_PREF, WORD_VECTORS_FILE, MAX_HEAD_DISTANCE, MAX_CHILD_DISTANCE, GET_HEADS_NEXT, GET_HEADS_POS, GET_HEADS_NEXT_POS, \
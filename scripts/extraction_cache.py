@@ -0,0 +1,140 @@
+# on-disk cache of extracted attachments, keyed by the contents of an input shard and the extraction parameters
+
+import cPickle
+import errno
+import hashlib
+import os
+
+CACHE_VERSION = 2  # bump when the extraction code changes in a way that invalidates cached attachments
+DEFAULT_MAX_SIZE = 2 * 1024**3  # bytes
+
+
+def hash_file_range(filename, start_offset, end_offset, block_size=1 << 20):
+    """
+    Get the sha1 hex digest of the bytes of a file between two offsets
+    """
+
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        f.seek(start_offset)
+        remaining = end_offset - start_offset
+        while remaining > 0:
+            block = f.read(min(block_size, remaining))
+            if not block:
+                break
+            sha.update(block)
+            remaining -= len(block)
+    return sha.hexdigest()
+
+
+def get_vocab_fingerprint(word_vectors):
+    """
+    Get a fingerprint of the vocabulary of a word vectors map (attachments without vectors are filtered out,
+    so the vocabulary is part of the cache key)
+
+    Word vectors converted by convert_word_vectors_to_npy carry the fingerprint computed at conversion time
+    """
+
+    if word_vectors is None:
+        return 'none'
+    if getattr(word_vectors, 'fingerprint', None):
+        return word_vectors.fingerprint
+    if not hasattr(word_vectors, 'keys'):  # e.g. a VocabularyCollector, which accepts every word
+        return type(word_vectors).__name__
+    sha = hashlib.sha1()
+    for word in sorted(word_vectors.keys()):
+        sha.update(word.encode('utf-8') if isinstance(word, unicode) else word)
+        sha.update('\n')
+    return sha.hexdigest()
+
+
+def remove_if_exists(filename):
+    """
+    Remove a file, unless another process sharing the cache already removed it
+    """
+
+    try:
+        os.remove(filename)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+class ExtractionCache(object):
+    """
+    Directory of pickled extraction results, one file per key
+
+    Reading an entry marks it as recently used; after each write, least recently used entries are removed
+    until the directory is at most max_size bytes
+    """
+
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    @staticmethod
+    def get_key(content_hash, extractor_name, params, vocab_fingerprint):
+        """
+        Combine the hash of a shard's contents with everything else that determines its extracted attachments
+        """
+
+        sha = hashlib.sha1()
+        sha.update(repr((CACHE_VERSION, content_hash, extractor_name, params, vocab_fingerprint)))
+        return sha.hexdigest()
+
+    def get_filename(self, key):
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def get(self, key):
+        """
+        Return the cached value for key, or None if it is not in the cache
+        """
+
+        filename = self.get_filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                value = cPickle.load(f)
+        except IOError:
+            return None
+        except (EOFError, cPickle.UnpicklingError):
+            remove_if_exists(filename)  # written by an interrupted run
+            return None
+        try:
+            os.utime(filename, None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None  # evicted by another process meanwhile
+        return value
+
+    def put(self, key, value):
+        filename = self.get_filename(key)
+        tmp_filename = filename + '.tmp' + str(os.getpid())
+        with open(tmp_filename, 'wb') as f:
+            cPickle.dump(value, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_filename, filename)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache is at most max_size bytes
+        """
+
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.pkl'):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    continue  # removed by another process since listed
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            remove_if_exists(os.path.join(self.cache_dir, name))
+            total_size -= size
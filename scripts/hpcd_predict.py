@@ -0,0 +1,187 @@
+# batched numpy inference for the trained HPCD model (port of code/singleWordPPHeadDistDropoutPredict.m)
+
+import argparse
+import numpy as np
+
+from attachment_table import AttachmentTable, load_attachment_bundle
+from utils import get_word_vectors, get_word_vectors_utf8
+
+NUM_DISTANCES = 5  # hard coded in the matlab code as well
+DROPOUT = 0.5  # params.dropout in code/run.m
+BATCH_SIZE = 10000  # number of attachments scored at a time
+
+
+class HPCDModel(object):
+    """
+    Head-Prep-Child-Dist model parameters, as saved by code/saveParameters.m
+
+    W - N x 2N composition matrix for the preposition and its child, b - N bias
+    Wdists - numDistances*N x 2N composition matrices for the head and the PP, one block per head distance,
+    bdists - numDistances*N biases, w - N scoring vector
+    The dropout scaling is applied to W and Wdists once, at construction
+    """
+
+    def __init__(self, W, Wdists, b, bdists, w, dropout=DROPOUT, scale_parents=1, num_distances=NUM_DISTANCES):
+        input_size = W.shape[0]
+        self.input_size = input_size
+        self.num_distances = num_distances
+        self.scale_parents = scale_parents
+        W = dropout * np.asarray(W, dtype=np.float64)
+        Wdists = dropout * np.asarray(Wdists, dtype=np.float64).reshape(num_distances, input_size, 2*input_size)
+        # split the concatenation [first; second] into two matrices, so the PP term is shared by all heads
+        self.W_prep = W[:, :input_size].T.copy()
+        self.W_child = W[:, input_size:].T.copy()
+        self.b = np.ravel(b)
+        self.Wdists_head = np.ascontiguousarray(Wdists[:, :, :input_size].transpose(0, 2, 1))
+        self.Wdists_pp = np.ascontiguousarray(Wdists[:, :, input_size:].transpose(0, 2, 1))
+        self.bdists = np.ravel(bdists).reshape(num_distances, input_size)
+        self.w = np.ravel(w)
+
+    @classmethod
+    def from_mat(cls, params_filename, dropout=DROPOUT, scale_parents=1, num_distances=NUM_DISTANCES):
+        """
+        Load parameters saved by matlab (e.g. paramOpt.mat)
+        """
+
+        import scipy.io
+        params = scipy.io.loadmat(params_filename)
+        return cls(params['W'], params['Wdists'], params['b'], params['bdists'], params['w'], dropout, scale_parents, num_distances)
+
+    def get_pp_parents(self, preps, children):
+        """
+        Compose each preposition (M x N) with its child (M x N)
+        """
+
+        return self.scale_parents * np.tanh(preps.dot(self.W_prep) + children.dot(self.W_child) + self.b)
+
+    def score(self, heads, preps, children):
+        """
+        Score candidate heads (M x H x N) for PPs with prepositions and children (M x N)
+
+        Return an M x H matrix of scores; heads at distance >= numDistances share the last distance parameters
+        """
+
+        pp_parents = self.get_pp_parents(preps, children)
+        num_heads = heads.shape[1]
+        scores = np.empty(heads.shape[:2])
+        for d in xrange(min(self.num_distances, num_heads)):
+            if d < self.num_distances - 1:
+                positions = slice(d, d+1)
+            else:
+                positions = slice(d, num_heads)
+            pp_term = pp_parents.dot(self.Wdists_pp[d]) + self.bdists[d]
+            composed = np.tanh(heads[:, positions].dot(self.Wdists_head[d]) + pp_term[:, np.newaxis])
+            scores[:, positions] = composed.dot(self.w)
+        return scores
+
+    def predict(self, heads, preps, children, nheads):
+        """
+        Predict the head (1-based, as in the labels files) of each PP, among its first nheads candidates
+        """
+
+        scores = self.score(heads, preps, children)
+        scores[np.arange(scores.shape[1]) >= np.asarray(nheads)[:, np.newaxis]] = -np.inf
+        return np.argmax(scores, axis=1) + 1
+
+
+def get_vocab_vectors(words, word_vectors, input_size=None):
+    """
+    Get a vocab size x N matrix of the vectors for words (zeros if missing), and a mask of the words that have vectors
+    """
+
+    has_vector = np.array([w in word_vectors for w in words], dtype=np.bool_)
+    if input_size is None:
+        input_size = len(word_vectors[words[np.flatnonzero(has_vector)[0]]])
+    vectors = np.zeros((len(words), input_size))
+    for i in np.flatnonzero(has_vector):
+        vectors[i] = word_vectors[words[i]]
+    return vectors, has_vector
+
+
+def predict_from_ids(model, heads, nheads, preps, children, vectors, has_vector, scale_vectors=1, batch_size=BATCH_SIZE):
+    """
+    Predict heads for attachments given as word ids into vectors (padded heads matrix with -1 padding)
+
+    Attachments with a word missing from has_vector are not scored, as in the matlab code
+    Return the predictions and the indices of the scored attachments (both 0-based arrays)
+    """
+
+    # append a zero vector for the padding id (-1)
+    vectors = scale_vectors * np.vstack([vectors, np.zeros((1, vectors.shape[1]))])
+    has_vector = np.append(has_vector, True)
+    include_ind = np.flatnonzero(has_vector[heads].all(axis=1) & has_vector[preps] & has_vector[children])
+    preds = np.empty(len(include_ind), dtype=np.int32)
+    for start in xrange(0, len(include_ind), batch_size):
+        batch = include_ind[start:start+batch_size]
+        preds[start:start+batch_size] = model.predict(vectors[heads[batch]], vectors[preps[batch]], vectors[children[batch]], nheads[batch])
+    return preds, include_ind
+
+
+def predict_bundle(model, bundle, word_vectors=None, scale_vectors=1, batch_size=BATCH_SIZE):
+    """
+    Predict heads for a bundle loaded by load_attachment_bundle
+
+    Uses the vectors embedded in the bundle unless word_vectors is given
+    """
+
+    if word_vectors is not None:
+        vectors, has_vector = get_vocab_vectors(bundle['words'], word_vectors, model.input_size)
+    elif 'word_vectors' not in bundle:
+        raise ValueError('bundle has no word vectors; pass word_vectors')
+    else:
+        vectors, has_vector = bundle['word_vectors'], bundle['has_vector']
+    return predict_from_ids(model, bundle['heads'], bundle['nheads'], bundle['preps'], bundle['children'], vectors, has_vector, \
+                            scale_vectors, batch_size)
+
+
+def predict_attachments(model, attachments, word_vectors, scale_vectors=1, batch_size=BATCH_SIZE):
+    """
+    Predict heads for a list of ConllAttachment instances
+    """
+
+    table = AttachmentTable.from_attachments(attachments)
+    vectors, has_vector = get_vocab_vectors(table.words, word_vectors, model.input_size)
+    return predict_from_ids(model, table.heads.to_padded(), table.get_nheads(), table.preps, table.children, vectors, has_vector, \
+                            scale_vectors, batch_size)
+
+
+def write_predictions(preds, include_ind, pp_pred_filename, include_ind_filename):
+    """
+    Write predictions in the format read by write_pp_predictions_to_wsj_file (1-based heads and indices)
+    """
+
+    with open(pp_pred_filename, 'w') as g:
+        g.writelines([str(pred) + '\n' for pred in preds.tolist()])
+    with open(include_ind_filename, 'w') as g:
+        g.writelines([str(ind + 1) + '\n' for ind in include_ind.tolist()])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Predict PP attachments with a trained HPCD model')
+    parser.add_argument('params_file', help='Model parameters saved by matlab (paramOpt.mat)')
+    parser.add_argument('bundle_file', help='Attachments bundle (.npz) written with write_bundle=True')
+    parser.add_argument('output_pref', help='Write predictions to output_pref.out and included indices to output_pref.includeInd')
+    parser.add_argument('--word_vectors_file', help='Word vectors file (default: vectors embedded in the bundle)')
+    parser.add_argument('--utf8', action='store_true', help='Word vectors file is in utf-8')
+    parser.add_argument('--dropout', type=float, default=DROPOUT)
+    parser.add_argument('--scale_vectors', type=float, default=1)
+    parser.add_argument('--batch_size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    model = HPCDModel.from_mat(args.params_file, args.dropout, args.scale_vectors)
+    bundle = load_attachment_bundle(args.bundle_file)
+    word_vectors = None
+    if args.word_vectors_file:
+        word_vectors = get_word_vectors_utf8(args.word_vectors_file) if args.utf8 else get_word_vectors(args.word_vectors_file)
+    elif 'word_vectors' not in bundle:
+        parser.error('bundle has no word vectors; pass --word_vectors_file')
+    preds, include_ind = predict_bundle(model, bundle, word_vectors, args.scale_vectors, args.batch_size)
+    print 'predicted', len(preds), 'out of', len(bundle['labels']), 'attachments'
+    labels = bundle['labels'][include_ind]
+    if len(labels):
+        print 'accuracy:', np.mean(preds == labels)
+    write_predictions(preds, include_ind, args.output_pref + '.out', args.output_pref + '.includeInd')
+
+
+if __name__=='__main__':
+    main()
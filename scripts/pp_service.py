@@ -0,0 +1,229 @@
+# long-lived PP attachment service: POST parsed conll sentences, get them back with the PP heads re-attached by the HPCD model
+
+import argparse
+import BaseHTTPServer
+import Queue
+import SocketServer
+import sys
+import threading
+import time
+
+from candidate_heads import get_batch_candidate_heads
+from extract_pp_attach_for_matlab import get_pp_attachments_from_conll_sentence
+from hpcd_predict import HPCDModel, DROPOUT, predict_attachments
+from utils import iter_conll_sentences, get_word_vectors_utf8
+
+MAX_BATCH_SENTENCES = 256  # maximum number of sentences scored together
+MAX_LATENCY = 0.01  # maximum time (seconds) a request waits for other requests to join its batch
+
+
+class AttachmentScorer(object):
+    """
+    Extract PP attachments from conll sentences and predict their heads
+    """
+
+    def __init__(self, model, word_vectors, max_head_distance, max_child_distance, use_tokens=False, scale_vectors=1):
+        self.model = model
+        self.word_vectors = word_vectors
+        self.max_head_distance = max_head_distance
+        self.max_child_distance = max_child_distance
+        self.use_tokens = use_tokens
+        self.scale_vectors = scale_vectors
+
+    def reattach(self, sentences):
+        """
+        Get for each sentence a dict from preposition index (0-based) to its predicted head (1-based word index)
+        """
+
+        attachments = []
+        sentence_indices = []
+        sentence_candidates = get_batch_candidate_heads(sentences, self.max_head_distance, ambiguous_only=True)
+        for i, sentence in enumerate(sentences):
+            cur_attachments = get_pp_attachments_from_conll_sentence(sentence, self.max_head_distance, self.max_child_distance, \
+                                                                     self.use_tokens, self.word_vectors, candidates=sentence_candidates[i])
+            attachments += cur_attachments
+            sentence_indices += [i] * len(cur_attachments)
+        new_heads = [dict() for _ in sentences]
+        if not attachments:
+            return new_heads
+        preds, include_ind = predict_attachments(self.model, attachments, self.word_vectors, self.scale_vectors)
+        for pred, ind in zip(preds, include_ind):
+            attachment = attachments[ind]
+            new_heads[sentence_indices[ind]][attachment.orig_prep_id] = attachment.orig_heads_ids[pred-1] + 1
+        return new_heads
+
+
+class PendingRequest(object):
+    """
+    Sentences waiting to be scored, and their result once done
+    """
+
+    def __init__(self, sentences):
+        self.sentences = sentences
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher(threading.Thread):
+    """
+    Collect concurrent requests into batches and score each batch with one call to the scorer
+
+    A batch is scored once it has max_batch_sentences sentences or its first request has waited max_latency seconds
+    """
+
+    def __init__(self, scorer, max_batch_sentences=MAX_BATCH_SENTENCES, max_latency=MAX_LATENCY):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.scorer = scorer
+        self.max_batch_sentences = max_batch_sentences
+        self.max_latency = max_latency
+        self.queue = Queue.Queue()
+
+    def submit(self, sentences):
+        """
+        Score sentences as part of the next batch and wait for the result (see AttachmentScorer.reattach)
+        """
+
+        request = PendingRequest(sentences)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error:
+            raise request.error
+        return request.result
+
+    def get_batch(self):
+        batch = [self.queue.get()]
+        num_sentences = len(batch[0].sentences)
+        deadline = time.time() + self.max_latency
+        while num_sentences < self.max_batch_sentences:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=remaining)
+            except Queue.Empty:
+                break
+            batch.append(request)
+            num_sentences += len(request.sentences)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.get_batch()
+            sentences = [s for request in batch for s in request.sentences]
+            try:
+                new_heads = self.scorer.reattach(sentences)
+            except Exception:
+                # score each request on its own, so only the requests that fail get the error
+                for request in batch:
+                    try:
+                        request.result = self.scorer.reattach(request.sentences)
+                    except Exception as e:
+                        request.error = e
+                    request.done.set()
+                continue
+            start = 0
+            for request in batch:
+                request.result = new_heads[start:start+len(request.sentences)]
+                start += len(request.sentences)
+                request.done.set()
+
+
+def reattach_conll_lines(lines, sentences, new_heads):
+    """
+    Replace the head column of re-attached prepositions in the conll lines the sentences were read from
+
+    Columns are split on any whitespace, as when parsing; re-attached lines are written back tab-separated
+    """
+
+    lines = list(lines)
+    for sentence, cur_new_heads in zip(sentences, new_heads):
+        for prep_id, head in cur_new_heads.iteritems():
+            line_number = sentence.start_line + prep_id
+            splt = lines[line_number].split()
+            splt[6] = str(head)
+            lines[line_number] = '\t'.join(splt) + '\n'
+    return lines
+
+
+class PPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    POST a utf-8 conll document (sentences separated by empty lines) and get it back with the predicted PP heads
+    """
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.getheader('content-length', 0))
+            text = self.rfile.read(length).decode('utf-8')
+            lines = text.splitlines(True)
+            if lines and lines[-1].strip() != '':
+                lines.append('\n')  # the last sentence needs a terminating empty line
+            sentences = list(iter_conll_sentences(lines, self.server.language))
+        except (ValueError, IndexError) as e:
+            self.send_error(400, 'could not parse conll input: ' + str(e))
+            return
+        try:
+            new_heads = self.server.batcher.submit(sentences)
+            response = ''.join(reattach_conll_lines(lines, sentences, new_heads)).encode('utf-8')
+        except Exception as e:
+            # the client must get an answer, even if scoring its batch failed
+            sys.stderr.write('Error: could not re-attach PPs: ' + repr(e) + '\n')
+            self.send_error(500, 'could not re-attach PPs: ' + ' '.join(str(e).split()))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded HTTP server sharing one model and batcher across requests
+    """
+
+    daemon_threads = True
+    request_queue_size = 128  # many parser clients may connect at once
+
+    def __init__(self, address, batcher, language):
+        BaseHTTPServer.HTTPServer.__init__(self, address, PPRequestHandler)
+        self.batcher = batcher
+        self.language = language
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve PP attachment predictions for conll sentences over HTTP')
+    parser.add_argument('params_file', help='Model parameters saved by matlab (paramOpt.mat)')
+    parser.add_argument('word_vectors_file', help='Word vectors file (utf-8)')
+    parser.add_argument('language', help='Conll language (e.g. spanish, catalan, arabic_spmrl)')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max_head_distance', type=int, default=10)
+    parser.add_argument('--max_child_distance', type=int, default=200)
+    parser.add_argument('--use_tokens', action='store_true', help='Use tokens instead of lemmas')
+    parser.add_argument('--dropout', type=float, default=DROPOUT)
+    parser.add_argument('--scale_vectors', type=float, default=1)
+    parser.add_argument('--max_batch_sentences', type=int, default=MAX_BATCH_SENTENCES)
+    parser.add_argument('--max_latency_ms', type=float, default=MAX_LATENCY*1000)
+    args = parser.parse_args()
+
+    model = HPCDModel.from_mat(args.params_file, args.dropout, args.scale_vectors)
+    word_vectors = get_word_vectors_utf8(args.word_vectors_file)
+    scorer = AttachmentScorer(model, word_vectors, args.max_head_distance, args.max_child_distance, args.use_tokens, args.scale_vectors)
+    batcher = MicroBatcher(scorer, args.max_batch_sentences, args.max_latency_ms / 1000.0)
+    batcher.start()
+    server = PPServer((args.host, args.port), batcher, args.language)
+    print 'serving PP attachments on:', args.host + ':' + str(args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+        sys.exit(0)
+
+
+if __name__=='__main__':
+    main()
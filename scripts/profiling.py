@@ -0,0 +1,231 @@
+# opt-in instrumentation of the extraction pipeline: wall and cpu time per stage, counters, and optional cProfile stats
+
+import cProfile
+import json
+import resource
+import time
+from collections import OrderedDict
+
+PROC_IO_FILENAME = '/proc/self/io'  # bytes read and written by this process (linux only)
+
+
+def get_cpu_time():
+    """
+    Get the cpu time of this process and its finished child processes (e.g. extraction workers)
+    """
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime + children_usage.ru_utime + children_usage.ru_stime
+
+
+def get_io_bytes():
+    """
+    Get the (read, written) bytes of this process so far, or None if not available
+    """
+
+    try:
+        with open(PROC_IO_FILENAME) as f:
+            io = dict(line.split(':') for line in f)
+        return int(io['rchar']), int(io['wchar'])
+    except (IOError, KeyError, ValueError):
+        return None
+
+
+class Profiler(object):
+    """
+    Record the wall and cpu time and bytes read and written of named pipeline stages, and named counters
+
+    Stages may nest (e.g. reading sentences is timed as 'read' within 'extract')
+    Counters of rejected attachments are named 'rejected_' + reason
+    If use_cprofile, a cProfile of everything between start and stop is also kept, for write_pstats
+    """
+
+    enabled = True
+
+    def __init__(self, use_cprofile=False):
+        self.stages = OrderedDict()
+        self.counters = dict()
+        self.cprofile = cProfile.Profile() if use_cprofile else None
+
+    def start(self):
+        if self.cprofile:
+            self.cprofile.enable()
+
+    def stop(self):
+        if self.cprofile:
+            self.cprofile.disable()
+
+    def add_stage_time(self, name, wall_seconds, cpu_seconds, io_start=None, io_end=None):
+        if name not in self.stages:
+            self.stages[name] = {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'bytes_read': None, 'bytes_written': None}
+        stage = self.stages[name]
+        stage['calls'] += 1
+        stage['wall_seconds'] += wall_seconds
+        stage['cpu_seconds'] += cpu_seconds
+        if io_start and io_end:
+            stage['bytes_read'] = (stage['bytes_read'] or 0) + io_end[0] - io_start[0]
+            stage['bytes_written'] = (stage['bytes_written'] or 0) + io_end[1] - io_start[1]
+
+    def stage(self, name):
+        """
+        Get a context manager timing a stage (a stage entered several times is accumulated)
+        """
+
+        return _Stage(self, name)
+
+    def iter_stage(self, name, iterable):
+        """
+        Iterate over iterable, timing the calls to its next as a stage (e.g. reading sentences while extracting from them)
+        """
+
+        iterator = iter(iterable)
+        while True:
+            wall, cpu = time.time(), get_cpu_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_stage_time(name, time.time() - wall, get_cpu_time() - cpu)
+                return
+            self.add_stage_time(name, time.time() - wall, get_cpu_time() - cpu)
+            yield item
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def reject(self, reason, n=1):
+        self.count('rejected_' + reason, n)
+
+    def merge_counters(self, counters):
+        for name, n in counters.iteritems():
+            self.count(name, n)
+
+    def to_dict(self):
+        return {'stages': self.stages, 'counters': self.counters}
+
+    def write_json(self, filename):
+
+        print 'writing profile to:', filename
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def write_pstats(self, filename):
+        """
+        Write the cProfile stats (readable with pstats.Stats(filename))
+        """
+
+        if self.cprofile:
+            print 'writing cProfile stats to:', filename
+            self.cprofile.dump_stats(filename)
+
+    def print_report(self):
+        for name, stage in self.stages.iteritems():
+            print 'stage:', name, 'wall:', '%.3f' % stage['wall_seconds'], 'cpu:', '%.3f' % stage['cpu_seconds'], \
+                'read:', stage['bytes_read'], 'written:', stage['bytes_written']
+        for name in sorted(self.counters):
+            print 'count:', name, self.counters[name]
+
+
+class _Stage(object):
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.io = get_io_bytes()
+        self.wall, self.cpu = time.time(), get_cpu_time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.add_stage_time(self.name, time.time() - self.wall, get_cpu_time() - self.cpu, self.io, get_io_bytes())
+
+
+class NullProfiler(object):
+    """
+    Profiler that records nothing, used when profiling is off
+    """
+
+    enabled = False
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def stage(self, name):
+        return _NULL_STAGE
+
+    def iter_stage(self, name, iterable):
+        return iterable
+
+    def count(self, name, n=1):
+        pass
+
+    def reject(self, reason, n=1):
+        pass
+
+    def merge_counters(self, counters):
+        pass
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+NULL_PROFILER = NullProfiler()
+
+# profiler of the current run, used by the extraction functions
+_profiler = NULL_PROFILER
+
+
+def get_profiler():
+    return _profiler
+
+
+def set_profiler(profiler):
+    """
+    Set the profiler of the current run (None turns profiling off) and return the previous one
+    """
+
+    global _profiler
+    previous = _profiler
+    _profiler = profiler or NULL_PROFILER
+    return previous
+
+
+def start_profiling(json_filename=None, pstats_filename=None):
+    """
+    Start profiling a run if json_filename or pstats_filename is given (with cProfile if pstats_filename is given)
+
+    Return the profiler of the run (a NullProfiler if not profiling)
+    """
+
+    if not json_filename and not pstats_filename:
+        return NULL_PROFILER
+    profiler = Profiler(use_cprofile=pstats_filename is not None)
+    set_profiler(profiler)
+    profiler.start()
+    return profiler
+
+
+def stop_profiling(profiler, json_filename=None, pstats_filename=None):
+    """
+    Stop profiling a run started with start_profiling, and write and print its results
+    """
+
+    if not profiler.enabled:
+        return
+    profiler.stop()
+    set_profiler(None)
+    profiler.print_report()
+    if json_filename:
+        profiler.write_json(json_filename)
+    if pstats_filename:
+        profiler.write_pstats(pstats_filename)
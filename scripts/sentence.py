@@ -1,6 +1,7 @@
 # Sentence class
 
 import sys
+from array import array
 
 # for now, SPMRL tag set
 POS_PREP = 'P'
@@ -23,28 +24,159 @@ CONLL_LANG_SPANISH = 'spanish'
 CONLL_LANG_CATALAN = 'catalan'
 CONLL_LANG_ARABIC_SPMRL = 'arabic_spmrl'  # for spmrl file converted to conll format (spmrl.*.conll)
 
+# integer-coded pos classes, used instead of matching tags against the tag lists above
+POS_CLASS_OTHER = 0
+POS_CLASS_NOUN = 1
+POS_CLASS_VERB = 2
+POS_CLASS_PREP = 3
+
+# reasons for rejecting an attachment (see EnglishSentence.get_invalid_attachment_reason)
+ATTACHMENT_CHILD_PARENT = 'child_parent'  # the child does not depend on the preposition
+ATTACHMENT_HEAD_DISTANCE = 'head_distance'
+ATTACHMENT_CHILD_DISTANCE = 'child_distance'
+ATTACHMENT_LEFT_ARC = 'left_arc'  # the head is after the preposition
+ATTACHMENT_HEAD_POS = 'head_pos'  # the head is not a noun or verb
+ATTACHMENT_CHILD_POS = 'child_pos'  # the child is not a noun
+
+
+def compile_pos_classes(pos_tags):
+    """
+    Compile a map from pos type ('verb', 'noun', 'prep') to tags into a map from tag to pos class
+    """
+
+    pos_classes = dict()
+    for pos_type, pos_class in (('noun', POS_CLASS_NOUN), ('verb', POS_CLASS_VERB), ('prep', POS_CLASS_PREP)):
+        for tag in pos_tags[pos_type]:
+            pos_classes[tag] = pos_class
+    return pos_classes
+
+
+SPMRL_POS_CLASSES = compile_pos_classes({'verb': [POS_VERB], 'noun': [POS_NOUN], 'prep': [POS_PREP]})
+ENGLISH_POS_CLASSES = compile_pos_classes(ENGLISH_POS_TAGS)
+ATB_POS_CLASSES = compile_pos_classes(ATB_POS_TAGS)
+CONLL_POS_CLASSES = {CONLL_LANG_SPANISH: compile_pos_classes(CONLL_SPANISH_POS_TAGS), \
+                     CONLL_LANG_CATALAN: compile_pos_classes(CONLL_SPANISH_POS_TAGS), \
+                     CONLL_LANG_ARABIC_SPMRL: compile_pos_classes(CONLL_ARABIC_SPMRL_POS_TAGS)}
+
+
+# pos tags and labels come from small vocabularies, so all sentences share one string object per symbol
+_symbols = dict()
+
+
+def intern_symbols(symbols):
+    """
+    Return a list where each symbol is replaced by a shared copy
+
+    Works for both str and unicode symbols (unlike the intern builtin)
+    """
+
+    return map(_symbols.setdefault, symbols, symbols)
+
+
+class TreeIndex(object):
+    """
+    Index of a dependency tree for fast structural queries
+
+    Built from the parents (1-indexed, 0 means root): children lists, and on the first ancestor or span query,
+    Euler tour in/out times for constant time ancestor queries and the span (first and last word) of every subtree
+    Words that are not connected to the root (e.g. on a cycle) are only their own ancestors
+    """
+
+    __slots__ = ('children', 'time_in', 'time_out', 'span_start', 'span_end')
+
+    def __init__(self, parents):
+        n = len(parents)
+        self.children = [[] for _ in xrange(n+1)]  # children of the root are in self.children[0]
+        for i in xrange(n):
+            if 0 <= parents[i] <= n:
+                self.children[parents[i]].append(i+1)
+        self.time_in = None
+
+    def traverse(self):
+        """
+        Compute the Euler tour times and subtree spans
+        """
+
+        n = len(self.children) - 1
+        self.time_in = [-1] * (n+1)
+        self.time_out = [-1] * (n+1)
+        self.span_start = range(n+1)
+        self.span_end = range(n+1)
+        # iterative depth first traversal from the root, so deep trees do not hit the recursion limit
+        time = 0
+        self.time_in[0] = time
+        stack = [(0, iter(self.children[0]))]
+        while stack:
+            node, children_iter = stack[-1]
+            child = next(children_iter, None)
+            if child is None:
+                stack.pop()
+                time += 1
+                self.time_out[node] = time
+                if stack:
+                    parent = stack[-1][0]
+                    self.span_start[parent] = min(self.span_start[parent], self.span_start[node])
+                    self.span_end[parent] = max(self.span_end[parent], self.span_end[node])
+            elif self.time_in[child] == -1:
+                time += 1
+                self.time_in[child] = time
+                stack.append((child, iter(self.children[child])))
+
+    def get_children(self, idx):
+        """
+        Get children of word idx (1-indexed, 0 means root)
+        """
+
+        if 0 <= idx < len(self.children):
+            return list(self.children[idx])
+        return []
+
+    def is_ancestor(self, ancestor, node):
+        """
+        Check if node is in the subtree of ancestor (both 1-indexed, 0 means root)
+        """
+
+        if ancestor == node:
+            return True
+        if self.time_in is None:
+            self.traverse()
+        if not (0 <= ancestor < len(self.time_in) and 0 <= node < len(self.time_in)):
+            return False
+        if self.time_in[ancestor] == -1 or self.time_in[node] == -1:
+            return False
+        return self.time_in[ancestor] < self.time_in[node] and self.time_out[node] < self.time_out[ancestor]
+
+    def get_span(self, idx):
+        """
+        Get the first and last word in the subtree of word idx (1-indexed, inclusive)
+        """
+
+        if self.time_in is None:
+            self.traverse()
+        return self.span_start[idx], self.span_end[idx]
+
 
 class Sentence(object):
-    """ Store a fully annotated sentence """
+    """
+    Store a fully annotated sentence
 
-    tokens = []
-    poses = []
-    labels = [] # dependency labels, "---" means root
-    parents = [] # indices of parents, starting with 1
-                 # 0 means root
-    morphs = []
-    lemmas = []
-    sentence_id = -1  # 0-based indexing
+    Sentences use __slots__, parents are stored in an int array and pos tags and labels are interned,
+    to keep whole corpora compact in memory
+    """
+
+    __slots__ = ('tokens', 'poses', 'labels', 'parents', 'morphs', 'lemmas', 'sentence_id', 'start_line', 'pos_classes')
+    # tokens, poses, labels (dependency labels, "---" means root)
+    # parents - indices of parents, starting with 1; 0 means root
+    # sentence_id - 0-based indexing
+    # start_line - line where sentence starts in its file (0-indexing), if known
+    # pos_classes - pos class of each word (POS_CLASS_*), computed on first use
+
+    pos_class_table = SPMRL_POS_CLASSES  # map from tag to pos class
 
     def __init__(self, tokens, poses, labels, parents, morphs=[]):
-        if len(tokens) != len(poses) or len(poses) != len(labels) or len(labels) != len(parents):
-            print 'Error: bad arguments to Sentence.__init__'
-            return
-        self.tokens = tokens
-        self.poses = poses
-        self.labels = labels
-        self.parents = parents
-        self.morphs = morphs
+        self.init_fields(tokens, poses, labels, parents)
+        self.morphs = morphs if self.tokens else []
+        self.lemmas = []
         if self.morphs != []:
             # morph examples: L:|xar_1||C:g, L:mim~A_2
             #self.lemmas = self.get_lemmas(self.morphs)
@@ -52,6 +184,22 @@ class Sentence(object):
                             else morph[2:morph.find('|')] \
                                 for morph in morphs]
 
+    def init_fields(self, tokens, poses, labels, parents):
+        """
+        Set the fields shared by all sentence types (all empty if the arguments are inconsistent)
+        """
+
+        self.sentence_id = -1
+        self.start_line = -1
+        self.pos_classes = None
+        if len(tokens) != len(poses) or len(poses) != len(labels) or len(labels) != len(parents):
+            print 'Error: bad arguments to Sentence.__init__'
+            tokens, poses, labels, parents = [], [], [], []
+        self.tokens = tokens
+        self.poses = intern_symbols(poses)
+        self.labels = intern_symbols(labels)
+        self.parents = array('i', parents)
+
     def __str__(self):
         res = '\t'.join(self.tokens) + '\n'
         res += '\t'.join(self.poses) + '\n'
@@ -80,6 +228,23 @@ class Sentence(object):
             return True
         return False
 
+    def get_tree_index(self):
+        """
+        Build a tree index of this sentence, for several structural queries (it is not kept on the sentence)
+        """
+
+        return TreeIndex(self.parents)
+
+    def get_pos_classes(self):
+        """
+        Get the pos class (POS_CLASS_*) of each word, computing them on first use
+        """
+
+        if self.pos_classes is None:
+            pos_class_table = self.pos_class_table
+            self.pos_classes = array('b', [pos_class_table.get(pos, POS_CLASS_OTHER) for pos in self.poses])
+        return self.pos_classes
+
     def get_children(self, idx):
         """
         Get children for word in index idx
@@ -87,11 +252,7 @@ class Sentence(object):
         idx starts with 1, zero meaning root
         """
 
-        children = []  # will have indices with 1 indexing
-        for i in xrange(len(self.parents)):
-            if self.parents[i] == idx:
-                children.append(i+1)
-        return children
+        return [i+1 for i, parent in enumerate(self.parents) if parent == idx]
 
     def is_reachable(self, ancestor, node):
         """ Check if node is reachable from ancestor
@@ -99,11 +260,14 @@ class Sentence(object):
         ancestor and node are 1-indexed
         """
 
-        if ancestor == node:
-            return True
-        if node == 0:
-            return False
-        return self.is_reachable(ancestor, self.parents[node-1])
+        return self.get_tree_index().is_ancestor(ancestor, node)
+
+    def get_subtree_span(self, idx):
+        """
+        Get the first and last word in the subtree of word idx (1-indexed, inclusive)
+        """
+
+        return self.get_tree_index().get_span(idx)
 
     def set_lemmas(self, lemmas):
         # use to set lemmas directly (not through initialization)
@@ -115,6 +279,10 @@ class Sentence(object):
 
 class EnglishSentence(Sentence):
 
+    __slots__ = ()
+
+    pos_class_table = ENGLISH_POS_CLASSES
+
     # static class variables
     # ideally we'd do the same for the Sentence class (with SPMRL tags), but for now they are global variables
     POS_PREP = 'P'
@@ -124,44 +292,42 @@ class EnglishSentence(Sentence):
     #### methods for determining pos tags ####
     @staticmethod
     def is_prep(tag):
-        for prep_tag in ENGLISH_POS_TAGS['prep']:
-            if tag == prep_tag:
-                return True
-        return False
+        return ENGLISH_POS_CLASSES.get(tag) == POS_CLASS_PREP
 
     @staticmethod
     def is_verb(tag):
-        for verb_tag in ENGLISH_POS_TAGS['verb']:
-            if tag == verb_tag:
-                return True
-        return False
+        return ENGLISH_POS_CLASSES.get(tag) == POS_CLASS_VERB
 
     @staticmethod
     def is_noun(tag):
-        for noun_tag in ENGLISH_POS_TAGS['noun']:
-            if noun_tag == tag:
-                return True
-        return False
+        return ENGLISH_POS_CLASSES.get(tag) == POS_CLASS_NOUN
 
-    def is_valid_attachment(self, prep_idx, child_idx, max_head_distance, max_child_distance):
+    def get_invalid_attachment_reason(self, prep_idx, child_idx, max_head_distance, max_child_distance):
         """
+        Get why an attachment is not valid (one of the ATTACHMENT_* reasons), or None if it is valid
+
         here indices are 0-based
         """
         if self.parents[child_idx] - 1 != prep_idx:
-            sys.stderr.write('Error: parent of child is not prep' + '\n')
-            return False
+            return ATTACHMENT_CHILD_PARENT
         if abs(self.parents[prep_idx] - 1 - prep_idx) > max_head_distance:
-            return False
+            return ATTACHMENT_HEAD_DISTANCE
         if abs(prep_idx - child_idx) > max_child_distance:
-            return False
+            return ATTACHMENT_CHILD_DISTANCE
         if self.parents[prep_idx] - 1 > prep_idx:  # skip left arcs
-            return False
+            return ATTACHMENT_LEFT_ARC
         parent_pos = self.poses[self.parents[prep_idx] - 1] if self.parents[prep_idx] > 0 else 'ROOT'
         if not (self.is_verb(parent_pos) or self.is_noun(parent_pos)):  # only consider noun or verb parents
-            return False
+            return ATTACHMENT_HEAD_POS
         if not self.is_noun(self.poses[child_idx]):  # only consider prep-noun phrases (ignore e.g. prep-pronoun)
-            return False
-        return True
+            return ATTACHMENT_CHILD_POS
+        return None
+
+    def is_valid_attachment(self, prep_idx, child_idx, max_head_distance, max_child_distance):
+        reason = self.get_invalid_attachment_reason(prep_idx, child_idx, max_head_distance, max_child_distance)
+        if reason == ATTACHMENT_CHILD_PARENT:
+            sys.stderr.write('Error: parent of child is not prep' + '\n')
+        return reason is None
 
 
 class ATBSentence(Sentence):
@@ -170,27 +336,22 @@ class ATBSentence(Sentence):
     Store an ATB sentence (preprocessed with stanford scripts and converted for conll format with pennconverter)
     """
 
+    __slots__ = ()
+
+    pos_class_table = ATB_POS_CLASSES
+
     #### methods for determining pos tags ####
     @staticmethod
     def is_prep(tag):
-        for prep_tag in ATB_POS_TAGS['prep']:
-            if tag == prep_tag:
-                return True
-        return False
+        return ATB_POS_CLASSES.get(tag) == POS_CLASS_PREP
 
     @staticmethod
     def is_verb(tag):
-        for verb_tag in ATB_POS_TAGS['verb']:
-            if tag == verb_tag:
-                return True
-        return False
+        return ATB_POS_CLASSES.get(tag) == POS_CLASS_VERB
 
     @staticmethod
     def is_noun(tag):
-        for noun_tag in ATB_POS_TAGS['noun']:
-            if noun_tag == tag:
-                return True
-        return False
+        return ATB_POS_CLASSES.get(tag) == POS_CLASS_NOUN
 
     def is_valid_attachment(self, prep_idx, max_distance):
         if abs(self.parents[prep_idx] - 1 - prep_idx) > max_distance:
@@ -209,62 +370,55 @@ class ConllSentence(Sentence):
     Store a fully annotated conll sentence
     """
 
+    __slots__ = ('language', 'pos_class_table')
+
     def __init__(self, tokens, poses, labels, parents, lemmas, language):
-        if len(tokens) != len(poses) or len(poses) != len(labels) or len(labels) != len(parents):
-            print 'Error: bad arguments to Sentence.__init__'
-            return
-        self.tokens = tokens
-        self.poses = poses
-        self.labels = labels
-        self.parents = parents
-        self.lemmas = lemmas
+        self.init_fields(tokens, poses, labels, parents)
+        self.morphs = []
+        self.lemmas = lemmas if self.tokens else []
         self.language = language
+        if language in CONLL_POS_CLASSES:
+            self.pos_class_table = CONLL_POS_CLASSES[language]
+        else:
+            sys.stderr.write('Error: unsupported language ' + language + ' in ConllSentence')
+            self.pos_class_table = dict()
 
     #### methods for determining pos tags ####
     @staticmethod
     def is_pos_lang(tag, pos_type, pos_map):
-        for possible_tag in pos_map[pos_type]:
-            if tag == possible_tag:
-                return True
-        return False
+        return tag in pos_map[pos_type]
 
     def is_prep(self, tag):
-        if self.language == CONLL_LANG_SPANISH or self.language == CONLL_LANG_CATALAN:
-            return self.is_pos_lang(tag, 'prep', CONLL_SPANISH_POS_TAGS)
-        elif self.language == CONLL_LANG_ARABIC_SPMRL:
-            return self.is_pos_lang(tag, 'prep', CONLL_ARABIC_SPMRL_POS_TAGS)
-        else:
-            sys.stderr.write('Error: unsupported language ' + self.language + ' in ConllSentence')
+        return self.pos_class_table.get(tag) == POS_CLASS_PREP
 
     def is_verb(self, tag):
-        if self.language == CONLL_LANG_SPANISH or self.language == CONLL_LANG_CATALAN:
-            return self.is_pos_lang(tag, 'verb', CONLL_SPANISH_POS_TAGS)
-        elif self.language == CONLL_LANG_ARABIC_SPMRL:
-            return self.is_pos_lang(tag, 'verb', CONLL_ARABIC_SPMRL_POS_TAGS)
-        else:
-            sys.stderr.write('Error: unsupported language ' + self.language + ' in ConllSentence')
+        return self.pos_class_table.get(tag) == POS_CLASS_VERB
 
     def is_noun(self, tag):
-        if self.language == CONLL_LANG_SPANISH or self.language == CONLL_LANG_CATALAN:
-            return self.is_pos_lang(tag, 'noun', CONLL_SPANISH_POS_TAGS)
-        elif self.language == CONLL_LANG_ARABIC_SPMRL:
-            return self.is_pos_lang(tag, 'noun', CONLL_ARABIC_SPMRL_POS_TAGS)
-        else:
-            sys.stderr.write('Error: unsupported language ' + self.language + ' in ConllSentence')
+        return self.pos_class_table.get(tag) == POS_CLASS_NOUN
+
+    def get_invalid_attachment_reason(self, prep_idx, child_idx, max_head_distance, max_child_distance):
+        """
+        Get why an attachment is not valid (see EnglishSentence.get_invalid_attachment_reason)
+        """
 
-    def is_valid_attachment(self, prep_idx, child_idx, max_head_distance, max_child_distance):
         if self.parents[child_idx] - 1 != prep_idx:
-            sys.stderr.write('Error: parent of child is not prep' + '\n')
-            return False
+            return ATTACHMENT_CHILD_PARENT
         if abs(self.parents[prep_idx] - 1 - prep_idx) > max_head_distance:
-            return False
+            return ATTACHMENT_HEAD_DISTANCE
         if abs(prep_idx - child_idx) > max_child_distance:
-            return False
+            return ATTACHMENT_CHILD_DISTANCE
         if self.parents[prep_idx] - 1 > prep_idx:  # skip left arcs
-            return False
+            return ATTACHMENT_LEFT_ARC
         parent_pos = self.poses[self.parents[prep_idx] - 1] if self.parents[prep_idx] > 0 else 'ROOT'
         if not (self.is_verb(parent_pos) or self.is_noun(parent_pos)):  # only consider noun or verb parents
-            return False
+            return ATTACHMENT_HEAD_POS
         if not self.is_noun(self.poses[child_idx]):  # only consider prep-noun phrases (ignore e.g. prep-pronoun)
-            return False
-        return True
+            return ATTACHMENT_CHILD_POS
+        return None
+
+    def is_valid_attachment(self, prep_idx, child_idx, max_head_distance, max_child_distance):
+        reason = self.get_invalid_attachment_reason(prep_idx, child_idx, max_head_distance, max_child_distance)
+        if reason == ATTACHMENT_CHILD_PARENT:
+            sys.stderr.write('Error: parent of child is not prep' + '\n')
+        return reason is None
@@ -0,0 +1,77 @@
+# parity of the batched HPCD predictor with a per-example loop over candidate heads (as in code/singleWordPPHeadDistDropoutPredict.m)
+
+import unittest
+import numpy as np
+
+from hpcd_predict import HPCDModel, NUM_DISTANCES, predict_bundle
+
+INPUT_SIZE = 4
+MAX_NUM_HEADS = NUM_DISTANCES + 3  # heads beyond numDistances share the last distance parameters
+NUM_EXAMPLES = 20
+
+
+def get_random_params(rng, input_size=INPUT_SIZE, num_distances=NUM_DISTANCES):
+    W = rng.randn(input_size, 2*input_size)
+    Wdists = rng.randn(num_distances*input_size, 2*input_size)
+    b = rng.randn(input_size, 1)
+    bdists = rng.randn(num_distances*input_size, 1)
+    w = rng.randn(input_size, 1)
+    return W, Wdists, b, bdists, w
+
+
+def loop_predict(params, heads, preps, children, nheads, dropout, scale_parents, num_distances=NUM_DISTANCES):
+    """
+    Score each candidate head of each example on its own and return the (1-based) best head and all scores
+    """
+
+    W, Wdists, b, bdists, w = params
+    input_size = W.shape[0]
+    W = dropout * W
+    Wdists = dropout * Wdists
+    scores = np.zeros(heads.shape[:2])
+    preds = []
+    for i in xrange(len(preps)):
+        pp_parent = scale_parents * np.tanh(W.dot(np.concatenate([preps[i], children[i]])) + b.ravel())
+        for h in xrange(heads.shape[1]):
+            dist = min(h + 1, num_distances)
+            rows = slice((dist-1)*input_size, dist*input_size)
+            head_pp_parent = np.tanh(Wdists[rows].dot(np.concatenate([heads[i, h], pp_parent])) + bdists[rows].ravel())
+            scores[i, h] = w.ravel().dot(head_pp_parent)
+        preds.append(np.argmax(scores[i, :nheads[i]]) + 1)
+    return np.array(preds), scores
+
+
+class HPCDPredictTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.params = get_random_params(rng)
+        self.heads = rng.randn(NUM_EXAMPLES, MAX_NUM_HEADS, INPUT_SIZE)
+        self.preps = rng.randn(NUM_EXAMPLES, INPUT_SIZE)
+        self.children = rng.randn(NUM_EXAMPLES, INPUT_SIZE)
+        self.nheads = rng.randint(1, MAX_NUM_HEADS + 1, NUM_EXAMPLES)
+
+    def test_scores_match_loop(self):
+        for dropout, scale_parents in [(0.5, 1), (1, 2)]:
+            model = HPCDModel(*self.params, dropout=dropout, scale_parents=scale_parents)
+            preds, scores = loop_predict(self.params, self.heads, self.preps, self.children, self.nheads, dropout, scale_parents)
+            np.testing.assert_allclose(model.score(self.heads, self.preps, self.children), scores, rtol=1e-10)
+            np.testing.assert_array_equal(model.predict(self.heads, self.preps, self.children, self.nheads), preds)
+
+    def test_fewer_heads_than_distances(self):
+        model = HPCDModel(*self.params)
+        heads = self.heads[:, :2]
+        nheads = np.minimum(self.nheads, 2)
+        preds, scores = loop_predict(self.params, heads, self.preps, self.children, nheads, 0.5, 1)
+        np.testing.assert_allclose(model.score(heads, self.preps, self.children), scores, rtol=1e-10)
+        np.testing.assert_array_equal(model.predict(heads, self.preps, self.children, nheads), preds)
+
+    def test_bundle_without_word_vectors(self):
+        model = HPCDModel(*self.params)
+        bundle = {'words': [u'a'], 'heads': np.zeros((1, 1), dtype=np.int32), 'nheads': np.ones(1, dtype=np.int32), \
+                  'preps': np.zeros(1, dtype=np.int32), 'children': np.zeros(1, dtype=np.int32)}
+        self.assertRaises(ValueError, predict_bundle, model, bundle)
+
+
+if __name__=='__main__':
+    unittest.main()
@@ -1,15 +1,31 @@
 # various utilities
-import subprocess
 import sys
-import operator
+import os
+import re
+import zlib
+import warnings
+from array import array
 from sentence import Sentence, EnglishSentence, ATBSentence, ConllSentence
+from word_vectors import load_word_vectors_npy, NearestNeighbors
+from attachment_table import RaggedArray
+from compressed_files import open_file, is_compressed
 import numpy as np
-import codecs
 
 BW_CHARS = {'\'', '|', '>', '&', '<', '}', 'A', 'b', 'p', 't', 'v', 'j', 'H', 'x', 'd', '*', 'r', 'z', 's', \
             '$', 'D', 'T', 'Z', 'E', 'g', 'f', 'q', 'k', 'l', 'm', 'n','h', 'w', 'y', 'Y', 'F', 'N', 'K', 'a', \
             'i', 'o', '~', 'I', 'O', 'W'}
 
+READ_BLOCK_SIZE = 4 * 1024**2  # bytes read at a time by iter_conll_column_blocks
+# a line that is empty after strip(), with the newline before it (the lookahead is faster than matching at line starts)
+BLANK_LINE_RE = re.compile(r'\n[ \t\r\x0b\x0c]*(?=\n)')
+# 0-based conll columns read for each file type (the parent column is always read)
+CONLL_ID_COLUMN = 0
+CONLL_PARENT_COLUMN = 6
+CONLL_COLUMNS = (1, 2, 4, 7)  # token, lemma, pos (not cpos), label
+SPMRL_CONLL_COLUMNS = CONLL_COLUMNS
+ATB_CONLL_COLUMNS = (1, 3, 7)  # token, pos, label
+WSJ_DEP_COLUMNS = (1, 3, 7)
+
 
 def increment_dict(dic, key):
     update_dict(dic, key, 1)
@@ -27,29 +43,244 @@ def update_dict_from_dict(dic, new_dic):
         update_dict(dic, key, val)
 
 
+def iter_spmrl_sentences(lines, has_morphs):
+    """
+    Yield sentences from the lines of an SPMRL file (any iterable of lines)
+
+    Only the lines of the current sentence are held in memory
+    """
+
+    num_lines = 6 if has_morphs else 5  # number of lines per sentence
+    block = []
+    for line in lines:
+        block.append(line)
+        if len(block) == num_lines:
+            yield get_sentence_from_spmrl_block(block, has_morphs)
+            block = []
+    # last sentence may lack its trailing separator line
+    if len(block) >= num_lines - 1:
+        yield get_sentence_from_spmrl_block(block, has_morphs)
+
+
+def iter_spmrl_file(spmrl_filename, has_morphs):
+    """
+    Read an SPMRL file (possibly compressed, see open_file) and yield sentences one at a time
+    """
+
+    with open_file(spmrl_filename) as f:
+        for s in iter_spmrl_sentences(f, has_morphs):
+            yield s
+
+
+def get_sentence_from_spmrl_block(block, has_morphs):
+    """
+    Make a sentence from the lines of one SPMRL sentence block
+    """
+
+    tokens = block[0].strip().split()
+    poses = block[1].strip().split()
+    labels = block[2].strip().split()
+    parents = [int(parent) for parent in block[3].strip().split()]
+    if has_morphs:
+        morphs = block[4].strip().split()
+        return Sentence(tokens, poses, labels, parents, morphs)
+    return Sentence(tokens, poses, labels, parents)
+
+
 def read_spmrl_file(spmrl_filename, has_morphs):
     """
     Read an SPMRL file and return list of sentences
     """
 
-    f = open(spmrl_filename)
-    lines = f.readlines()
-    f.close()
-    num_lines = 6 if has_morphs else 5  # number of lines per sentence
-    sentences = []
-    for i in xrange(len(lines)):
-        if i % num_lines == 0:
-            tokens = lines[i].strip().split()
-            poses = lines[i + 1].strip().split()
-            labels = lines[i + 2].strip().split()
-            parents = [int(parent) for parent in lines[i + 3].strip().split()]
-            if has_morphs:
-                morphs = lines[i + 4].strip().split()
-                s = Sentence(tokens, poses, labels, parents, morphs)
-            else:
-                s = Sentence(tokens, poses, labels, parents)
-            sentences.append(s)
-    return sentences
+    return list(iter_spmrl_file(spmrl_filename, has_morphs))
+
+
+def iter_conll_blocks(lines, first_line=0):
+    """
+    Group conll-like lines into sentences separated by empty lines
+
+    Yield (start_line, splits) pairs, where start_line is the 0-based line number of the sentence's first line
+    (counting from first_line) and splits has the whitespace-split fields of each line
+    Lines following the last empty line are ignored
+    """
+
+    splits = []
+    start_line = first_line
+    for i, line in enumerate(lines, first_line):
+        if line.strip() == '':
+            yield start_line, splits
+            splits = []
+            start_line = i + 1
+        else:
+            splits.append(line.strip().split())
+
+
+def iter_conll_line_blocks(lines, columns, first_line=0):
+    """
+    Yield the sentences of conll-like lines (any iterable of lines) one at a time, in the format of iter_conll_column_blocks
+    """
+
+    for start_line, splits in iter_conll_blocks(lines, first_line):
+        fields = [[splt[c] for splt in splits] for c in columns]
+        parents = array('i', [int(splt[CONLL_PARENT_COLUMN]) for splt in splits])
+        yield [start_line], [0, len(splits)], fields, parents
+
+
+def parse_int_fields(fields):
+    """
+    Parse integer fields in one pass, returning an int32 numpy array, or None if some field is not an integer
+    """
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # numpy warns when it stops at a non-integer field
+        values = np.fromstring(' '.join(fields), dtype=np.int32, sep=' ')
+    return values if len(values) == len(fields) else None
+
+
+def get_conll_chunk_columns(chunk, offsets, columns):
+    """
+    Split the lines of a chunk of whole conll-like sentences into columns
+
+    offsets - word offsets of the sentences in the chunk (see iter_conll_column_blocks)
+    Return a list with the fields of each of the given columns, and an int array('i') with the parent column
+    The chunk is split at once if all its lines have the same number of fields, checked by the word ids (1, 2, ...
+    in each sentence); otherwise each line is split by itself
+    """
+
+    num_words = offsets[-1]
+    fields = chunk.split()
+    num_columns = len(fields) // num_words if num_words else 0
+    if num_words and len(fields) == num_columns * num_words and num_columns > max(columns + (CONLL_PARENT_COLUMN,)):
+        ids = parse_int_fields(fields[CONLL_ID_COLUMN::num_columns])
+        parents = parse_int_fields(fields[CONLL_PARENT_COLUMN::num_columns])
+        lengths = np.diff(offsets)
+        if ids is not None and parents is not None and \
+                np.array_equal(ids, np.arange(num_words) - np.repeat(offsets[:-1], lengths) + 1):
+            return [fields[c::num_columns] for c in columns], array('i', parents.tostring())
+    splits = [line.split() for line in chunk.split('\n') if line.strip()]
+    return [[splt[c] for splt in splits] for c in columns], array('i', [int(splt[CONLL_PARENT_COLUMN]) for splt in splits])
+
+
+def decode_fields(fields, encoding):
+    """
+    Decode a list of byte string fields at once (encoding must be ascii-compatible, e.g. utf-8)
+    """
+
+    if not fields:
+        return []
+    return '\n'.join(fields).decode(encoding).split(u'\n')
+
+
+def iter_conll_column_blocks(f, columns, encoding=None, first_line=0, size=None, block_size=READ_BLOCK_SIZE):
+    """
+    Read the sentences of a conll-like file in large blocks, keeping only some of its columns
+
+    Faster equivalent of iter_conll_blocks: each block of bytes is split into fields at once, only the given (0-based)
+    columns are kept and decoded (if encoding is given), and the parent column is parsed into ints
+
+    f - file open in binary mode, read from its current position (size bytes if given, otherwise to the end)
+    Yield (start_lines, offsets, fields, parents) for each block of sentences, where sentence i starts at line start_lines[i]
+    (counting from first_line) and has words offsets[i] to offsets[i+1], fields[k] has the fields of column columns[k]
+    of all words, and parents is an int array('i') with their parents
+    Lines following the last empty line are ignored
+    """
+
+    columns = tuple(columns)
+    line_num = first_line
+    leftover = ''
+    remaining = size
+    while True:
+        read_size = block_size if remaining is None else min(block_size, remaining)
+        data = f.read(read_size) if read_size > 0 else ''
+        if remaining is not None:
+            remaining -= len(data)
+        if data:
+            data = leftover + data
+        elif leftover and not leftover.endswith('\n'):
+            data = leftover + '\n'  # last line without a newline
+        else:
+            return
+        start_lines = []
+        offsets = [0]
+        start = 0
+        # with a newline prepended, each match spans exactly a blank line of data (with its newline)
+        for match in BLANK_LINE_RE.finditer('\n' + data):
+            num_lines = data.count('\n', start, match.start())
+            start_lines.append(line_num)
+            offsets.append(offsets[-1] + num_lines)
+            line_num += num_lines + 1
+            start = match.end()
+        leftover = data[start:]
+        if start_lines:
+            fields, parents = get_conll_chunk_columns(data[:start], offsets, columns)
+            if encoding:
+                fields = [decode_fields(column, encoding) for column in fields]
+            yield start_lines, offsets, fields, parents
+
+
+def iter_conll_file_column_blocks(filename, columns, encoding=None, shard=None):
+    """
+    Read a conll-like file, or only a shard of it (see get_sentence_shards), with iter_conll_column_blocks
+
+    The whole of a compressed file can be read (see open_file), but not a shard of it
+    """
+
+    start_offset, end_offset, start_line = shard if shard else (0, None, 0)
+    with open_file(filename, 'rb') as f:
+        if start_offset:
+            f.seek(start_offset)
+        size = end_offset - start_offset if end_offset is not None else None
+        for block in iter_conll_column_blocks(f, columns, encoding, start_line, size):
+            yield block
+
+
+def read_conll_parents(conll_filename):
+    """
+    Read only the parent column of a conll-like file, without building sentences
+
+    Return a RaggedArray with the parents of each sentence (1-based, 0 means root)
+    """
+
+    parents = array('i')
+    offsets = [0]
+    for _, block_offsets, _, block_parents in iter_conll_file_column_blocks(conll_filename, ()):
+        parents.extend(block_parents)
+        base = offsets[-1]
+        offsets.extend(base + offset for offset in block_offsets[1:])
+    return RaggedArray(np.frombuffer(parents, dtype=np.int32), np.array(offsets, dtype=np.int64))
+
+
+def iter_spmrl_conll_column_sentences(blocks):
+    """
+    Yield sentences from blocks of a SPMRL .conll file (see iter_conll_column_blocks, with SPMRL_CONLL_COLUMNS)
+    """
+
+    for start_lines, offsets, (tokens, lemmas, poses, labels), parents in blocks:
+        for i, start_line in enumerate(start_lines):
+            start, end = offsets[i], offsets[i+1]
+            s = Sentence(tokens[start:end], poses[start:end], labels[start:end], parents[start:end])
+            s.set_lemmas(lemmas[start:end])
+            s.set_start_line(start_line)
+            yield s
+
+
+def iter_spmrl_conll_sentences(lines, first_line=0):
+    """
+    Yield sentences from the lines of a SPMRL .conll file (any iterable of lines)
+    """
+
+    return iter_spmrl_conll_column_sentences(iter_conll_line_blocks(lines, SPMRL_CONLL_COLUMNS, first_line))
+
+
+def iter_spmrl_conll_file(spmrl_conll_filename):
+    """
+    Read a SPMRL .conll file and yield sentences one at a time
+
+    The input file is a SPMRL file converted to conll format by the convert_mst.py script
+    Legacy code (try to use iter_conll_file instead)
+    """
+
+    return iter_spmrl_conll_column_sentences(iter_conll_file_column_blocks(spmrl_conll_filename, SPMRL_CONLL_COLUMNS))
 
 
 def read_spmrl_conll_file(spmrl_conll_filename):
@@ -60,68 +291,86 @@ def read_spmrl_conll_file(spmrl_conll_filename):
     Legacy code (try to use read_conll_file instead)
     """
 
-    f = codecs.open(spmrl_conll_filename)
-    lines = f.readlines()
-    f.close()
-    sentences = []
-    tokens = []
-    lemmas = []
-    poses = []
-    labels = []
-    parents = []
-    for line in lines:
-        if line.strip() == '':
-            s = Sentence(tokens, poses, labels, parents)
-            s.set_lemmas(lemmas)
-            sentences.append(s)
-            tokens = []
-            lemmas = []
-            poses = []
-            labels = []
-            parents = []
-        else:
-            splt = line.strip().split()
-            tokens.append(splt[1])
-            lemmas.append(splt[2])
-            poses.append(splt[4])  # use pos and not cpos
-            labels.append(splt[7])
-            parents.append(int(splt[6]))
-    return sentences
+    return list(iter_spmrl_conll_file(spmrl_conll_filename))
+
 
+def iter_conll_column_sentences(blocks, language, vocabulary=None):
+    """
+    Yield sentences from blocks of a conll file (see iter_conll_column_blocks, with CONLL_COLUMNS)
 
-def read_conll_file(conll_filename, language, encoding='utf-8'):
+    If vocabulary (a Vocabulary) is given, tokens and lemmas are stored as its word ids
+    """
+
+    for start_lines, offsets, (tokens, lemmas, poses, labels), parents in blocks:
+        if vocabulary is not None:
+            tokens = vocabulary.get_ids(tokens)
+            lemmas = vocabulary.get_ids(lemmas)
+        for i, start_line in enumerate(start_lines):
+            start, end = offsets[i], offsets[i+1]
+            s = ConllSentence(tokens[start:end], poses[start:end], labels[start:end], parents[start:end], lemmas[start:end], language)
+            s.set_start_line(start_line)
+            yield s
+
+
+def iter_conll_sentences(lines, language, first_line=0, vocabulary=None):
+    """
+    Yield sentences from the lines of a conll file (any iterable of lines)
+
+    If vocabulary (a Vocabulary) is given, tokens and lemmas are stored as its word ids
+    """
+
+    return iter_conll_column_sentences(iter_conll_line_blocks(lines, CONLL_COLUMNS, first_line), language, vocabulary)
+
+
+def iter_conll_file(conll_filename, language, encoding='utf-8', vocabulary=None, shard=None):
+    """
+    Read a conll file, or only a shard of it (see get_sentence_shards), and yield sentences one at a time
+
+    Input file is a file in conllx format from the conll shared task
+    """
+
+    return iter_conll_column_sentences(iter_conll_file_column_blocks(conll_filename, CONLL_COLUMNS, encoding, shard), language, vocabulary)
+
+
+def read_conll_file(conll_filename, language, encoding='utf-8', vocabulary=None):
     """
     Read a conll file and return list of sentences
 
     Input file is a file in conllx format from the conll shared task
     """
 
-    f = codecs.open(conll_filename, encoding=encoding)
-    lines = f.readlines()
-    f.close()
-    sentences = []
-    tokens = []
-    lemmas = []
-    poses = []
-    labels = []
-    parents = []
-    for line in lines:
-        if line.strip() == '':
-            s = ConllSentence(tokens, poses, labels, parents, lemmas, language)
-            sentences.append(s)
-            tokens = []
-            lemmas = []
-            poses = []
-            labels = []
-            parents = []
-        else:
-            splt = line.strip().split()
-            tokens.append(splt[1])
-            lemmas.append(splt[2])
-            poses.append(splt[4])  # use pos and not cpos
-            labels.append(splt[7])
-            parents.append(int(splt[6]))
-    return sentences
+    return list(iter_conll_file(conll_filename, language, encoding, vocabulary))
+
+
+def iter_stanford_atb_conll_column_sentences(blocks):
+    """
+    Yield sentences from blocks of an ATB .dep file (see iter_conll_column_blocks, with ATB_CONLL_COLUMNS)
+    """
+
+    for start_lines, offsets, (tokens, poses, labels), parents in blocks:
+        for i, start_line in enumerate(start_lines):
+            start, end = offsets[i], offsets[i+1]
+            s = ATBSentence(tokens[start:end], poses[start:end], labels[start:end], parents[start:end])
+            s.set_start_line(start_line)
+            yield s
+
+
+def iter_stanford_atb_conll_sentences(lines, first_line=0):
+    """
+    Yield sentences from the lines of an ATB .dep file (any iterable of lines)
+    """
+
+    return iter_stanford_atb_conll_column_sentences(iter_conll_line_blocks(lines, ATB_CONLL_COLUMNS, first_line))
+
+
+def iter_stanford_atb_conll_file(atb_conll_filename):
+    """
+    Read a .dep file and yield sentences one at a time
+
+    The input file is an ATB file, prepared by stanford preprocessing scripts, then converted to conll format by the pennconverter tools
+    """
+
+    return iter_stanford_atb_conll_column_sentences(iter_conll_file_column_blocks(atb_conll_filename, ATB_CONLL_COLUMNS, 'utf-8'))
 
 
 def read_stanford_atb_conll_file(atb_conll_filename):
@@ -131,68 +380,176 @@ def read_stanford_atb_conll_file(atb_conll_filename):
     The input file is an ATB file, prepared by stanford preprocessing scripts, then converted to conll format by the pennconverter tools
     """
 
-    f = codecs.open(atb_conll_filename, encoding='utf-8')
-    lines = f.readlines()
-    f.close()
-    sentences = []
-    tokens = []
-    poses = []
-    labels = []
-    parents = []
-    for line in lines:
-        if line.strip() == '':
-            s = ATBSentence(tokens, poses, labels, parents)
-            sentences.append(s)
-            tokens = []
-            poses = []
-            labels = []
-            parents = []
-        else:
-            splt = line.strip().split()
-            tokens.append(splt[1])
-            poses.append(splt[3])
-            labels.append(splt[7])
-            parents.append(int(splt[6]))
-    return sentences
+    return list(iter_stanford_atb_conll_file(atb_conll_filename))
+
+
+def iter_wsj_dep_column_sentences(blocks, lower_case=False, vocabulary=None):
+    """
+    Yield sentences from blocks of a WSJ .dep file (see iter_conll_column_blocks, with WSJ_DEP_COLUMNS)
+
+    If vocabulary (a Vocabulary) is given, tokens are stored as its word ids
+    """
+
+    for start_lines, offsets, (tokens, poses, labels), parents in blocks:
+        if lower_case and tokens:
+            tokens = '\n'.join(tokens).lower().split('\n')
+        if vocabulary is not None:
+            tokens = vocabulary.get_ids(tokens)
+        for i, start_line in enumerate(start_lines):
+            start, end = offsets[i], offsets[i+1]
+            s = EnglishSentence(tokens[start:end], poses[start:end], labels[start:end], parents[start:end])
+            s.set_start_line(start_line)
+            yield s
 
 
-def read_wsj_dep_file(wsj_dep_filename, lower_case=False):
+def iter_wsj_dep_sentences(lines, lower_case=False, first_line=0, vocabulary=None):
+    """
+    Yield sentences from the lines of a WSJ .dep file (any iterable of lines)
+
+    first_line is the line number of the first line, used for setting the sentences' start lines
+    If vocabulary (a Vocabulary) is given, tokens are stored as its word ids
+    """
+
+    return iter_wsj_dep_column_sentences(iter_conll_line_blocks(lines, WSJ_DEP_COLUMNS, first_line), lower_case, vocabulary)
+
+
+def iter_wsj_dep_file(wsj_dep_filename, lower_case=False, vocabulary=None, shard=None):
+    """
+    Read a WSJ .dep file, or only a shard of it (see get_sentence_shards), and yield sentences one at a time
+
+    The input file is a WSJ file converted to dependency format by the Penn2Dep converter
+    """
+
+    return iter_wsj_dep_column_sentences(iter_conll_file_column_blocks(wsj_dep_filename, WSJ_DEP_COLUMNS, None, shard), lower_case, vocabulary)
+
+
+def read_wsj_dep_file(wsj_dep_filename, lower_case=False, vocabulary=None):
     """
     Read a WSJ .dep file and return list of sentences
 
     The input file is a WSJ file converted to dependency format by the Penn2Dep converter
     """
 
-    f = open(wsj_dep_filename)
-    lines = f.readlines()
-    f.close()
-    sentences = []
-    tokens = []
-    poses = []
-    labels = []
-    parents = []
+    return list(iter_wsj_dep_file(wsj_dep_filename, lower_case, vocabulary))
+
+
+def count_newlines(f, start_offset, end_offset, block_size=READ_BLOCK_SIZE):
+    """
+    Count the newlines of a file object between two byte offsets, reading it in blocks
+    """
+
+    f.seek(start_offset)
+    num_newlines = 0
+    remaining = end_offset - start_offset
+    while remaining > 0:
+        block = f.read(min(block_size, remaining))
+        if not block:
+            break
+        num_newlines += block.count('\n')
+        remaining -= len(block)
+    return num_newlines
+
+
+def get_sentence_shards(filename, num_shards, block_lines=None):
+    """
+    Split a file into about num_shards byte ranges that start and end at sentence boundaries
+
+    Sentences are separated by empty lines, or, if block_lines is given, are blocks of block_lines lines (SPMRL files)
+    Each shard ends at the first sentence boundary after its target size, found by seeking there and reading forward,
+    so only the newlines before it are counted (in blocks) instead of the file being read line by line
+    Return a list of (start_offset, end_offset, start_line) triples, where start_line is the 0-based line number
+    of the first line in the shard
+    """
+
+    file_size = os.path.getsize(filename)
+    target_size = max(1, file_size // max(1, num_shards))
+    shards = []
+    start_offset = 0
     start_line = 0
-    for i in xrange(len(lines)):
-        line = lines[i]
-        if line.strip() == '':
-            s = EnglishSentence(tokens, poses, labels, parents)
-            s.set_start_line(start_line)
-            start_line = i+1
-            sentences.append(s)
-            tokens = []
-            poses = []
-            labels = []
-            parents = []
-        else:
-            splt = line.strip().split()
-            tok = splt[1]
-            if lower_case:
-                tok = tok.lower()
-            tokens.append(tok)
-            poses.append(splt[3])
-            labels.append(splt[7])
-            parents.append(int(splt[6]))
-    return sentences
+    with open(filename, 'rb') as f:
+        while start_offset + target_size < file_size:
+            # go to the start of the first line after the target offset
+            f.seek(start_offset + target_size - 1)
+            offset = start_offset + target_size - 1 + len(f.readline())
+            line_num = start_line + count_newlines(f, start_offset, offset)
+            at_boundary = False
+            while not at_boundary:
+                line = f.readline()
+                if not line:
+                    break
+                offset += len(line)
+                line_num += 1
+                if block_lines:
+                    at_boundary = line_num % block_lines == 0
+                else:
+                    at_boundary = line.strip() == ''
+            if not at_boundary:
+                break
+            shards.append((start_offset, offset, start_line))
+            start_offset = offset
+            start_line = line_num
+    if file_size > start_offset:
+        shards.append((start_offset, file_size, start_line))
+    return shards
+
+
+def get_content_defined_shards(filename, shard_size, block_lines=None):
+    """
+    Split a file into byte ranges of whole sentences, with boundaries that depend only on nearby content
+
+    A shard ends after a sentence whose hash falls below a threshold proportional to the sentence's size, so shards
+    have about shard_size bytes; shards have at least shard_size/4 bytes and at most about 4*shard_size bytes
+    Editing a sentence changes only the shards around it, so other shards keep the same contents
+    Return a list of (start_offset, end_offset, start_line) triples, as in get_sentence_shards
+    """
+
+    min_size = shard_size // 4
+    max_size = 4 * shard_size
+    shards = []
+    start_offset = 0
+    start_line = 0
+    sentence_offset = 0
+    offset = 0
+    crc = 0
+    with open(filename, 'rb') as f:
+        for i, line in enumerate(f):
+            offset += len(line)
+            crc = zlib.crc32(line, crc)
+            if block_lines:
+                at_boundary = (i + 1) % block_lines == 0
+            else:
+                at_boundary = line.strip() == ''
+            if not at_boundary:
+                continue
+            size = offset - start_offset
+            threshold = (1 << 32) * (offset - sentence_offset) // max(1, shard_size)
+            if (size >= min_size and (crc & 0xffffffff) < threshold) or size >= max_size:
+                shards.append((start_offset, offset, start_line))
+                start_offset = offset
+                start_line = i + 1
+            sentence_offset = offset
+            crc = 0
+    if offset > start_offset:
+        shards.append((start_offset, offset, start_line))
+    return shards
+
+
+def iter_file_lines(filename, start_offset, end_offset, encoding=None):
+    """
+    Yield the lines of a file between two byte offsets (as returned by get_sentence_shards)
+
+    If encoding is given, lines are decoded
+    """
+
+    with open(filename, 'rb') as f:
+        f.seek(start_offset)
+        offset = start_offset
+        while offset < end_offset:
+            line = f.readline()
+            if not line:
+                break
+            offset += len(line)
+            yield line.decode(encoding) if encoding else line
 
 
 def argmax_two(vals):
@@ -216,11 +573,69 @@ def argmax_two(vals):
     return arg_best, arg_second_best
 
 
+def bw2utf8_char_table():
+    """
+    Get a unicode.translate table from Buckwalter characters to Arabic code points
+
+    Covers the standard Buckwalter scheme and the XML-safe variants I, O, W (for <, >, &)
+    """
+
+    pairs = [('\'', 0x0621), ('|', 0x0622), ('>', 0x0623), ('&', 0x0624), ('<', 0x0625), ('}', 0x0626), ('A', 0x0627), \
+             ('b', 0x0628), ('p', 0x0629), ('t', 0x062A), ('v', 0x062B), ('j', 0x062C), ('H', 0x062D), ('x', 0x062E), \
+             ('d', 0x062F), ('*', 0x0630), ('r', 0x0631), ('z', 0x0632), ('s', 0x0633), ('$', 0x0634), ('S', 0x0635), \
+             ('D', 0x0636), ('T', 0x0637), ('Z', 0x0638), ('E', 0x0639), ('g', 0x063A), ('_', 0x0640), ('f', 0x0641), \
+             ('q', 0x0642), ('k', 0x0643), ('l', 0x0644), ('m', 0x0645), ('n', 0x0646), ('h', 0x0647), ('w', 0x0648), \
+             ('Y', 0x0649), ('y', 0x064A), ('F', 0x064B), ('N', 0x064C), ('K', 0x064D), ('a', 0x064E), ('u', 0x064F), \
+             ('i', 0x0650), ('~', 0x0651), ('o', 0x0652), ('`', 0x0670), ('{', 0x0671), ('I', 0x0625), ('O', 0x0623), \
+             ('W', 0x0624)]
+    return dict((ord(c), unichr(code)) for c, code in pairs)
+
+
+BW2UTF8_TABLE = bw2utf8_char_table()
+BW2UTF8_CACHE_MAX_SIZE = 1000000  # number of memoized words, the cache is cleared when it grows beyond this
+_bw2utf8_cache = dict()
+
+
+def bw2utf8_word(word_bw):
+    """
+    Transliterate one Buckwalter word (or any string) to Arabic script, memoizing the result
+
+    Characters without a Buckwalter mapping (e.g. digits, punctuation, whitespace) are kept as is
+    """
+
+    word_utf8 = _bw2utf8_cache.get(word_bw)
+    if word_utf8 is None:
+        word = word_bw if isinstance(word_bw, unicode) else word_bw.decode('utf-8')
+        word_utf8 = word.translate(BW2UTF8_TABLE)
+        if len(_bw2utf8_cache) >= BW2UTF8_CACHE_MAX_SIZE:
+            _bw2utf8_cache.clear()
+        _bw2utf8_cache[word_bw] = word_utf8
+    return word_utf8
+
+
 def bw2utf8(words_bw_str):
-    pipe = subprocess.Popen(['perl', 'bw2utf8.pl', words_bw_str], stdout=subprocess.PIPE)
-    words_utf8_str = pipe.stdout.read()
-    words_utf8_str = words_utf8_str.decode('utf-8')  # fix for str -> unicode conversion
-    return words_utf8_str
+    """
+    Transliterate a Buckwalter string to a unicode Arabic string
+    """
+
+    return bw2utf8_word(words_bw_str)
+
+
+def bw2utf8_batch(words_bw):
+    """
+    Transliterate a sequence of Buckwalter words, returning a list
+    """
+
+    return [bw2utf8_word(word) for word in words_bw]
+
+
+def iter_bw2utf8(words_bw):
+    """
+    Transliterate Buckwalter words one at a time, e.g. from the lines of a large vocabulary file
+    """
+
+    for word in words_bw:
+        yield bw2utf8_word(word)
 
 
 def get_utf8_map(words_bw):
@@ -230,12 +645,7 @@ def get_utf8_map(words_bw):
     words_bw is a set of words
     """
 
-    words_bw_list = list(words_bw)
-    words_bw_str = ' '.join(words_bw_list)
-    words_utf8_str = bw2utf8(words_bw_str)
-    words_utf8_list = words_utf8_str.split()
-    m = dict(zip(words_bw_list, words_utf8_list))
-    return m
+    return dict((word, bw2utf8_word(word)) for word in words_bw)
 
 
 def get_utf8_list(words_bw):
@@ -245,11 +655,7 @@ def get_utf8_list(words_bw):
     words_bw is a set of words or phrases (could be multi words)
     """
 
-    words_bw_list = list(words_bw)
-    words_bw_str = '\t'.join(words_bw_list)  # here separator must be '\t' and not space
-    words_utf8_str = bw2utf8(words_bw_str)
-    words_utf8_list = words_utf8_str.split('\t')
-    return words_utf8_list
+    return bw2utf8_batch(words_bw)
 
 
 def get_lemma(el):
@@ -370,8 +776,10 @@ def load_word_vectors(word_vectors_filename):
     """
 
     print 'loading word vectors'
+    if word_vectors_filename.endswith('.npy'):
+        return load_word_vectors_npy(word_vectors_filename)
     m = dict()
-    with open(word_vectors_filename) as f:
+    with open_file(word_vectors_filename) as f:
         for line in f:
             splt = line.strip().split()
             word = splt[0]
@@ -381,12 +789,13 @@ def load_word_vectors(word_vectors_filename):
 
 
 def get_top_words_from_vectors_vec(word_vectors, vec, n):
-    word_distances = dict()
-    for w in word_vectors:
-        dist = np.dot(word_vectors[w], vec)
-        word_distances[w] = dist
-    sorted_word_distances = sorted(word_distances.iteritems(), key=operator.itemgetter(1), reverse=True)
-    return sorted_word_distances[:n]
+    """
+    Get n words with highest dot product with vec
+
+    For repeated queries, build a NearestNeighbors instance once and query it directly
+    """
+
+    return NearestNeighbors(word_vectors).query(vec, n)
 
 
 def get_top_words_from_vectors(word_vectors, word, n):
@@ -409,13 +818,18 @@ def cosine_similarity(vec1, vec2):
 def get_word_vectors(word_vectors_filename):
     """
     Get word vectors from a word2vec generated file
+
+    If the file is a .npy cache created by convert_word_vectors_to_npy, a memory-mapped view is returned
+    Text files may be compressed (see open_file)
     """
 
     if 'utf8' in word_vectors_filename:
         return get_word_vectors_utf8(word_vectors_filename)
+    if word_vectors_filename.endswith('.npy'):
+        return load_word_vectors_npy(word_vectors_filename)
 
     word_vectors = dict()
-    with open(word_vectors_filename) as f:
+    with open_file(word_vectors_filename) as f:
         for line in f:
             splt = line.strip().split()
             word = splt[0]
@@ -429,8 +843,11 @@ def get_word_vectors_utf8(word_vectors_filename, encoding='utf-8'):
     Get word vectors from a word2vec generated file
     """
 
+    if word_vectors_filename.endswith('.npy'):
+        return load_word_vectors_npy(word_vectors_filename, encoding)
+
     word_vectors = dict()
-    with codecs.open(word_vectors_filename, encoding=encoding) as f:
+    with open_file(word_vectors_filename, encoding=encoding) as f:
         for line in f:
             splt = line.strip().split()
             word = splt[0]
@@ -442,13 +859,54 @@ def get_word_vectors_utf8(word_vectors_filename, encoding='utf-8'):
     return word_vectors
 
 
+def get_word_vectors_for_vocab(word_vectors_filename, vocab, encoding=None, output_filename=None):
+    """
+    Get word vectors only for words in vocab, streaming over the word vectors file
+
+    If encoding is given, words are decoded (as in get_word_vectors_utf8)
+    If output_filename is given, the kept vectors are also written there in word2vec text format
+    """
+
+    print 'loading word vectors for vocabulary of size', len(vocab), 'from:', word_vectors_filename
+    word_vectors = dict()
+    if word_vectors_filename.endswith('.npy'):
+        all_word_vectors = load_word_vectors_npy(word_vectors_filename, encoding)
+        for word in vocab:
+            if word in all_word_vectors:
+                word_vectors[word] = all_word_vectors[word].tolist()
+        lines = (word + ' ' + ' '.join([str(el) for el in vector]) + '\n' for word, vector in word_vectors.iteritems())
+    else:
+        lines = []
+        f = open_file(word_vectors_filename, encoding=encoding)
+        for line in f:
+            splt = line.strip().split()
+            if not splt or splt[0] not in vocab:
+                continue
+            try:
+                vector = [float(el) for el in splt[1:]]
+            except ValueError:
+                continue
+            word_vectors[splt[0]] = vector
+            if output_filename:
+                lines.append(line)
+        f.close()
+    if output_filename:
+        print 'writing filtered word vectors to:', output_filename
+        g = open_file(output_filename, 'w', encoding)
+        for line in lines:
+            g.write(line)
+        g.close()
+    print 'found vectors for', len(word_vectors), 'words'
+    return word_vectors
+
+
 def get_map_from_file(filename):
     """
     Format: first word in each line is the key, followed by all its values
     """
 
     m = dict()
-    for line in open(filename).readlines():
+    for line in open_file(filename).readlines():
         splt = line.strip().split()
         if len(splt) < 2:
             continue
@@ -459,7 +917,7 @@ def get_map_from_file(filename):
 def get_brown_clusters(filename):
 
     word_clusters = dict()
-    with codecs.open(filename, encoding='utf-8') as f:
+    with open_file(filename, encoding='utf-8') as f:
         for line in f:
             # e.g. 110 dog 2
             splt = line.strip().split()
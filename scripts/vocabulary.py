@@ -0,0 +1,108 @@
+# corpus-wide vocabulary: words are mapped to dense integer ids when read, and turned back into strings only when written
+
+from array import array
+
+from word_vectors import VocabularyCollector
+
+
+class WordIdSet(set):
+    """
+    Set of word ids, always true (like a non-empty word vectors map) so it can stand in for word vectors
+    """
+
+    def __nonzero__(self):
+        return True
+
+
+class CollectorView(object):
+    """
+    Stand-in for a VocabularyCollector that accepts word ids and records their words in the collector
+    """
+
+    def __init__(self, vocabulary, collector):
+        self.vocabulary = vocabulary
+        self.collector = collector
+
+    def __contains__(self, word_id):
+        return self.vocabulary.words[word_id] in self.collector
+
+    def __nonzero__(self):
+        return True
+
+
+class Vocabulary(object):
+    """
+    Map between words and dense integer ids (in order of first occurrence)
+
+    Each word is hashed once per lookup here, and then only its id is stored in sentences and attachments;
+    membership in word vectors is also checked once per word (see get_word_vectors_ids)
+    """
+
+    def __init__(self, words=()):
+        self.ids = dict()
+        self.words = []
+        self.vector_ids = []  # (word vectors, WordIdSet of the ids of words in them), kept up to date as words are added
+        for word in words:
+            self.add(word)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return word in self.ids
+
+    def add(self, word):
+        """
+        Add a word if new, and return its id
+        """
+
+        word_id = self.ids.get(word)
+        if word_id is None:
+            word_id = len(self.words)
+            self.ids[word] = word_id
+            self.words.append(word)
+            for word_vectors, word_ids in self.vector_ids:
+                if word in word_vectors:
+                    word_ids.add(word_id)
+        return word_id
+
+    def get_ids(self, words):
+        """
+        Get an array of the ids of words, adding new ones
+        """
+
+        ids = self.ids
+        try:
+            return array('i', map(ids.__getitem__, words))  # most sentences have no new words
+        except KeyError:
+            return array('i', [ids[w] if w in ids else self.add(w) for w in words])
+
+    def get_words(self, word_ids):
+        words = self.words
+        return [words[i] for i in word_ids]
+
+    def get_word_vectors_ids(self, word_vectors):
+        """
+        Get a stand-in for word vectors that answers membership of word ids instead of words
+
+        This is the set of ids of words in word_vectors, kept up to date as words are added; for a VocabularyCollector,
+        a view that records the words looked up (so only the words of attachments are collected)
+        """
+
+        if word_vectors is None:
+            return None
+        if isinstance(word_vectors, VocabularyCollector):
+            return CollectorView(self, word_vectors)
+        for vectors, word_ids in self.vector_ids:
+            if vectors is word_vectors:
+                return word_ids
+        word_ids = WordIdSet(i for i, w in enumerate(self.words) if w in word_vectors)
+        self.vector_ids.append((word_vectors, word_ids))
+        return word_ids
+
+    def get_id_map(self, words):
+        """
+        Get a list mapping the ids of another vocabulary (given by its words) to ids in this one
+        """
+
+        return list(self.get_ids(words))
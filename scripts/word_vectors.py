@@ -0,0 +1,341 @@
+# binary word vector cache: a float32 .npy matrix plus a vocabulary file, loaded as a dict-like view
+
+import argparse
+import bisect
+from compressed_files import open_file
+import hashlib
+import itertools
+import numpy as np
+import operator
+import os
+
+
+class WordVectors(object):
+    """
+    Dict-like view of word vectors stored as rows of one matrix
+
+    The matrix is typically memory-mapped, so loading is fast and pages are shared across processes
+    Words are found by binary search in the sorted vocabulary, so no dict over the whole vocabulary is built
+    """
+
+    def __init__(self, vocab, matrix, encoding=None, rows=None, fingerprint=None):
+        """
+        vocab - sorted list of words (byte strings); vocab[i] is the word of row i of matrix, or of row rows[i] if rows is given
+        encoding - if given, words are unicode and are encoded to be looked up in vocab
+        fingerprint - sha1 hex digest of the vocabulary, if known (see get_vocab_fingerprint in extraction_cache)
+        """
+
+        self.vocab = vocab
+        self.matrix = matrix
+        self.encoding = encoding
+        self.rows = rows
+        self.fingerprint = fingerprint
+        self.found_rows = dict()  # matrix row of each word looked up so far (None if not in the vocabulary)
+        self.decoded_words = None
+
+    def get_row(self, word):
+        """
+        Get the matrix row of word, or None if it is not in the vocabulary
+        """
+
+        if word in self.found_rows:
+            return self.found_rows[word]
+        row = None
+        key = word
+        if isinstance(word, unicode):
+            try:
+                key = word.encode(self.encoding or 'ascii')
+            except UnicodeError:
+                key = None
+        if key is not None:
+            i = bisect.bisect_left(self.vocab, key)
+            if i < len(self.vocab) and self.vocab[i] == key:
+                row = i if self.rows is None else self.rows[i]
+        self.found_rows[word] = row
+        return row
+
+    def __contains__(self, word):
+        return self.get_row(word) is not None
+
+    def __getitem__(self, word):
+        row = self.get_row(word)
+        if row is None:
+            raise KeyError(word)
+        return self.matrix[row]
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def __iter__(self):
+        return iter(self.words)
+
+    def get(self, word, default=None):
+        row = self.get_row(word)
+        if row is None:
+            return default
+        return self.matrix[row]
+
+    def keys(self):
+        return list(self.words)
+
+    def iterkeys(self):
+        return iter(self.words)
+
+    def iteritems(self):
+        for i, word in enumerate(self.words):
+            yield word, self.matrix[i if self.rows is None else self.rows[i]]
+
+    def items(self):
+        return list(self.iteritems())
+
+    @property
+    def words(self):
+        """
+        Words in vocabulary order, decoded on first use if encoding is given
+        """
+
+        if self.decoded_words is None:
+            self.decoded_words = [w.decode(self.encoding) for w in self.vocab] if self.encoding else self.vocab
+        return self.decoded_words
+
+    @property
+    def dim(self):
+        return self.matrix.shape[1]
+
+
+class NearestNeighbors(object):
+    """
+    Nearest neighbour search over word vectors stored as one pre-normalized float32 matrix
+
+    Queries are answered with one matrix multiply and argpartition, scoring by dot product or cosine similarity
+    """
+
+    def __init__(self, word_vectors):
+        if isinstance(word_vectors, WordVectors):
+            self.words = word_vectors.words
+            matrix = word_vectors.matrix if word_vectors.rows is None else word_vectors.matrix[word_vectors.rows]
+            matrix = np.asarray(matrix, dtype=np.float32)
+        else:
+            self.words = list(word_vectors)
+            matrix = np.array([word_vectors[w] for w in self.words], dtype=np.float32)
+        self.word2idx = dict((w, i) for i, w in enumerate(self.words))
+        self.norms = np.linalg.norm(matrix, axis=1)
+        safe_norms = np.where(self.norms > 0, self.norms, 1)
+        self.matrix = matrix / safe_norms[:, np.newaxis]
+
+    def query_batch(self, vecs, n, metric='dot', batch_size=1024):
+        """
+        Get the n closest words for each row of vecs
+
+        metric - 'dot' or 'cosine'
+        Queries are processed batch_size rows at a time to bound the size of the score matrix
+        Return a list with a list of (word, score) pairs for each query, best first
+        """
+
+        if metric not in ('dot', 'cosine'):
+            raise ValueError('unknown metric: ' + metric)
+        vecs = np.atleast_2d(np.asarray(vecs, dtype=np.float32))
+        n = min(n, len(self.words))
+        results = []
+        if n <= 0:
+            return [[] for _ in xrange(vecs.shape[0])]
+        for start in xrange(0, vecs.shape[0], batch_size):
+            batch = vecs[start:start+batch_size]
+            scores = batch.dot(self.matrix.T)
+            if metric == 'dot':
+                scores *= self.norms
+            else:
+                query_norms = np.linalg.norm(batch, axis=1)
+                scores /= np.where(query_norms > 0, query_norms, 1)[:, np.newaxis]
+            top = np.argpartition(-scores, n-1, axis=1)[:, :n]
+            rows = np.arange(batch.shape[0])[:, np.newaxis]
+            top_scores = scores[rows, top]
+            order = np.argsort(-top_scores, axis=1)
+            top = top[rows, order]
+            top_scores = top_scores[rows, order]
+            for i in xrange(batch.shape[0]):
+                results.append([(self.words[j], float(score)) for j, score in zip(top[i], top_scores[i])])
+        return results
+
+    def query(self, vec, n, metric='dot'):
+        """
+        Get the n closest words to vec, as a list of (word, score) pairs
+        """
+
+        return self.query_batch([vec], n, metric)[0]
+
+    def query_words(self, words, n, metric='dot', batch_size=1024):
+        """
+        Get the n closest words for each of words (an empty list for words without vectors)
+        """
+
+        known = [w for w in words if w in self.word2idx]
+        if not known:
+            return [[] for _ in words]
+        indices = [self.word2idx[w] for w in known]
+        vecs = self.matrix[indices] * self.norms[indices][:, np.newaxis]
+        known_results = dict(zip(known, self.query_batch(vecs, n, metric, batch_size)))
+        return [known_results.get(w, []) for w in words]
+
+
+class VocabularyCollector(object):
+    """
+    Stand-in for a word vectors map that accepts every word and records the words looked up
+
+    Passing it as word_vectors to the extraction functions collects the vocabulary of the attachments
+    """
+
+    def __init__(self):
+        self.vocab = set()
+
+    def __contains__(self, word):
+        self.vocab.add(word)
+        return True
+
+    def __nonzero__(self):
+        return True
+
+    def __len__(self):
+        return len(self.vocab)
+
+
+def get_vocab_filename(npy_filename):
+    """
+    Get the name of the vocabulary file that goes with a word vectors .npy file
+    """
+
+    if npy_filename.endswith('.npy'):
+        return npy_filename[:-len('.npy')] + '.vocab'
+    return npy_filename + '.vocab'
+
+
+def get_fingerprint_filename(npy_filename):
+    """
+    Get the name of the file with the sha1 of the vocabulary file that goes with a word vectors .npy file
+    """
+
+    return get_vocab_filename(npy_filename) + '.sha1'
+
+
+def parse_word_vector_line(line, dim=None):
+    """
+    Parse one line of a word2vec text file
+
+    Return (word, vector) or None if the line is not a vector of dimension dim (e.g. a word2vec header line)
+    """
+
+    splt = line.strip().split()
+    if len(splt) < 2:
+        return None
+    if dim and len(splt) - 1 != dim:
+        return None
+    try:
+        vector = [float(el) for el in splt[1:]]
+    except ValueError:
+        return None
+    return splt[0], vector
+
+
+def convert_word_vectors_to_npy(word_vectors_filename, npy_filename=None):
+    """
+    Convert a word2vec text file to a float32 .npy matrix and a vocabulary file (one word per line)
+
+    The vocabulary is written sorted, with the matrix rows in the same order, so words can be found by binary search
+    (see WordVectors); if a word appears more than once, its last vector is kept, as in get_word_vectors
+    The text file is read twice (once to find the vocabulary and matrix size, once to fill the matrix), and the matrix
+    is written through a memory map, so it is never held in memory
+    Return the name of the .npy file
+    """
+
+    if not npy_filename:
+        npy_filename = word_vectors_filename + '.npy'
+    vocab_filename = get_vocab_filename(npy_filename)
+    print 'converting word vectors from:', word_vectors_filename, 'to:', npy_filename
+
+    dim = None
+    line_words = []
+    with open_file(word_vectors_filename) as f:
+        for line in f:
+            if dim is None:
+                splt = line.strip().split()
+                if len(splt) == 2 and splt[0].isdigit() and splt[1].isdigit():  # word2vec header
+                    continue
+                dim = len(splt) - 1
+            parsed = parse_word_vector_line(line, dim)
+            if parsed:
+                line_words.append(parsed[0])
+    if not line_words:
+        raise ValueError('no word vectors found in ' + word_vectors_filename)
+    last_line = dict((word, i) for i, word in enumerate(line_words))
+    vocab = sorted(last_line)
+    line_rows = dict((last_line[word], row) for row, word in enumerate(vocab))
+
+    matrix = np.lib.format.open_memmap(npy_filename, mode='w+', dtype=np.float32, shape=(len(vocab), dim))
+    i = 0
+    with open_file(word_vectors_filename) as f:
+        for line in f:
+            parsed = parse_word_vector_line(line, dim)
+            if not parsed:
+                continue
+            if i in line_rows:
+                matrix[line_rows[i]] = parsed[1]
+            i += 1
+    matrix.flush()
+    del matrix
+    # the fingerprint of the sorted vocabulary is stored, so the extraction cache does not hash it on every run
+    sha = hashlib.sha1()
+    with open(vocab_filename, 'w') as g:
+        for word in vocab:
+            g.write(word + '\n')
+            sha.update(word + '\n')
+    with open(get_fingerprint_filename(npy_filename), 'w') as g:
+        g.write(sha.hexdigest() + '\n')
+    print 'converted', len(vocab), 'word vectors of dimension', dim
+    return npy_filename
+
+
+def is_sorted(items):
+
+    return all(itertools.imap(operator.le, items, itertools.islice(items, 1, None)))
+
+
+def load_word_vectors_npy(npy_filename, encoding=None, mmap_mode='r'):
+    """
+    Load word vectors converted by convert_word_vectors_to_npy
+
+    Return a WordVectors view; if encoding is given, words are decoded to unicode
+    """
+
+    matrix = np.load(npy_filename, mmap_mode=mmap_mode)
+    vocab_filename = get_vocab_filename(npy_filename)
+    # split on newlines only; decoded lines would also be split at other unicode line breaks
+    with open(vocab_filename, 'rb') as f:
+        vocab = f.read().split('\n')
+    if vocab and vocab[-1] == '':
+        vocab.pop()
+    if len(vocab) != matrix.shape[0]:
+        raise ValueError('vocabulary size does not match matrix in ' + npy_filename)
+    rows = None
+    if not is_sorted(vocab):
+        # converted before vocabularies were sorted; sort a copy and keep the matrix as is
+        print 'sorting unsorted vocabulary of:', npy_filename, '(convert the word vectors again to avoid this)'
+        rows = sorted(xrange(len(vocab)), key=vocab.__getitem__)
+        vocab = [vocab[row] for row in rows]
+    fingerprint = None
+    fingerprint_filename = get_fingerprint_filename(npy_filename)
+    if rows is None and os.path.exists(fingerprint_filename):
+        with open(fingerprint_filename) as f:
+            fingerprint = f.read().strip()
+    return WordVectors(vocab, matrix, encoding, rows, fingerprint)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert word2vec text vectors to a binary .npy cache')
+    parser.add_argument('word_vectors_file', help='Word vectors in word2vec text format')
+    parser.add_argument('-o', '--output_file', help='Output .npy file (default: word_vectors_file.npy)')
+    args = parser.parse_args()
+    convert_word_vectors_to_npy(args.word_vectors_file, args.output_file)
+
+
+if __name__=='__main__':
+    main()